@@ -112,7 +112,7 @@ class AdminServer(threading.Thread,):
                 return True if len(cloud_resources.user_vm_limits) > 0 else False
             def cloud_alias_reload(self):
                 if config.target_cloud_alias_file:
-                    cloud_resources.target_cloud_aliases = cloud_resources.load_cloud_aliases(config.target_cloud_alias_file)
+                    cloud_resources.set_cloud_aliases(cloud_resources.load_cloud_aliases(config.target_cloud_alias_file))
                     return True if len(cloud_resources.target_cloud_aliases) > 0 else False
                 else:
                     return False
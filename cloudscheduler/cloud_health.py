@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## CLOUD HEALTH
+##
+## Keeps track of how well each cloud has been doing at booting and
+## destroying VMs, and scores clouds for ranking the fitting resources of a
+## job, lowest score first.
+##
+## For each cloud the time taken by create calls, the time from a create
+## until the VM registers with condor, and the share of failed create and
+## destroy calls are kept as exponentially weighted moving averages, so
+## the score follows the cloud as it recovers or degrades.
+##
+## score = cloud_rank_fill_weight * slot_fill_ratio
+##       + cloud_rank_boot_weight * minutes to create and register a VM
+##       + cloud_rank_failure_weight * (create failure rate + destroy failure rate)
+##
+from __future__ import with_statement
+
+import threading
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+
+class CloudHealth():
+    """Moving averages of the VM create and destroy behaviour of a cloud."""
+
+    # Weight given to the newest sample
+    SMOOTHING = 0.2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.creates = 0
+        self.create_failures = 0
+        self.destroys = 0
+        self.destroy_failures = 0
+        self.registrations = 0
+        self.create_latency = None
+        self.register_latency = None
+        self.create_failure_rate = 0.0
+        self.destroy_failure_rate = 0.0
+
+    def __getstate__(self):
+        """Override to work with pickle module."""
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        """Override to work with pickle module."""
+        self.__dict__ = state
+        self.lock = threading.Lock()
+
+    def _average(self, average, sample):
+        if average == None:
+            return float(sample)
+        return self.SMOOTHING * sample + (1 - self.SMOOTHING) * average
+
+    def record_create(self, seconds, succeeded):
+        """Record a create call that took seconds and succeeded or failed."""
+        with self.lock:
+            self.creates += 1
+            if succeeded:
+                self.create_latency = self._average(self.create_latency, seconds)
+            else:
+                self.create_failures += 1
+            self.create_failure_rate = self._average(self.create_failure_rate, 0 if succeeded else 1)
+
+    def record_registered(self, seconds):
+        """Record a VM that registered with condor seconds after its create."""
+        with self.lock:
+            self.registrations += 1
+            self.register_latency = self._average(self.register_latency, seconds)
+
+    def record_destroy(self, succeeded):
+        with self.lock:
+            self.destroys += 1
+            if not succeeded:
+                self.destroy_failures += 1
+            self.destroy_failure_rate = self._average(self.destroy_failure_rate, 0 if succeeded else 1)
+
+    def boot_minutes(self):
+        """Average minutes from create call to condor registration."""
+        return ((self.create_latency or 0.0) + (self.register_latency or 0.0)) / 60
+
+    def failure_rate(self):
+        return self.create_failure_rate + self.destroy_failure_rate
+
+
+def cloud_score(cluster):
+    """Returns the ranking score of cluster, lower is better."""
+    health = cluster.health
+    return config.cloud_rank_fill_weight * cluster.slot_fill_ratio() + \
+           config.cloud_rank_boot_weight * health.boot_minutes() + \
+           config.cloud_rank_failure_weight * health.failure_rate()
+
+
+def get_cloud_health_info(clusters):
+    """Returns a formatted report of the health and score of clusters."""
+    output = ["%-20s %8s %8s %10s %10s %8s %8s %9s %8s\n" % ("Cloud", "Creates", "Failed", "Create s",
+              "Register s", "Fail %", "Destroys", "Failed", "Score")]
+    for cluster in sorted(clusters, key=cloud_score):
+        health = cluster.health
+        output.append("%-20s %8d %8d %10s %10s %7.1f%% %8d %9d %8.3f\n" % (cluster.name,
+                      health.creates, health.create_failures,
+                      "%.1f" % health.create_latency if health.create_latency != None else "-",
+                      "%.1f" % health.register_latency if health.register_latency != None else "-",
+                      health.create_failure_rate * 100, health.destroys, health.destroy_failures,
+                      cloud_score(cluster)))
+    return ''.join(output)
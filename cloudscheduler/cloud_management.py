@@ -19,8 +19,8 @@ import os
 import re
 import sys
 import json
-import time
 import shlex
+import socket
 import string
 import logging
 import threading
@@ -63,8 +63,13 @@ import cloudscheduler.config as config
 from cloudscheduler.utilities import determine_path
 from cloudscheduler.utilities import get_or_none
 from cloudscheduler.utilities import ErrTrackQueue
-from cloudscheduler.utilities import splitnstrip
 import cloudscheduler.utilities as utilities
+from cloudscheduler.warm_pool import WarmPool
+from cloudscheduler.fit_index import FitIndex
+from cloudscheduler.poll_schedule import PollSchedule
+from cloudscheduler.destroy_executor import VMDestroyExecutor
+from cloudscheduler.cloud_health import cloud_score
+from cloudscheduler.cloud_health import get_cloud_health_info
 
 ##
 ## GLOBALS
@@ -126,8 +131,28 @@ class ResourcePool:
         self.setup_lock = threading.Lock()
         self.setup_queued = False
         self.non_cs_condor_machines = set()
+        self.warm_pool = WarmPool()
+        self.fit_index = FitIndex()
+        self.poll_schedule = PollSchedule()
+        self.destroyer = VMDestroyExecutor()
+        # Potential fit results keyed by (config_generation, requirements),
+        # only valid while the cluster configuration does not change
+        self.potential_fit_lock = threading.Lock()
+        self.config_generation = 0
+        self.potential_fits = {}
+        # Lookup tables rebuilt by rebuild_lookup_tables, name -> cluster and
+        # alias -> set of cloud names
+        self.target_cloud_aliases = {}
+        self.clusters_by_name = {}
+        self.alias_targets = {}
         self.missing_vm_condor_machines = set()
 
+        for module in config.cloud_driver_modules:
+            try:
+                __import__(module)
+            except:
+                log.exception("Couldn't load cloud driver module %s" % module)
+
         if not condor_query_type:
             condor_query_type = config.condor_retrieval_method
 
@@ -158,9 +183,7 @@ class ResourcePool:
         if config.ban_tracking:
             self.load_banned_job_resource()
         if config.target_cloud_alias_file:
-            self.target_cloud_aliases = self.load_cloud_aliases(config.target_cloud_alias_file)
-        else:
-            self.target_cloud_aliases = {}
+            self.set_cloud_aliases(self.load_cloud_aliases(config.target_cloud_alias_file))
         self.load_persistence()
 
 
@@ -219,6 +242,8 @@ class ResourcePool:
                     cluster.net_slots = {}
             old_resources.append(cluster)
             self.resources.remove(cluster)
+        self.fit_index.rebuild(self.resources)
+        self.rebuild_lookup_tables()
 
         # Update resources
         # Do this by replacing each updated cluster object with the
@@ -232,6 +257,7 @@ class ResourcePool:
                         for new_cluster in new_resources:
                             if new_cluster.name == updated_name:
 
+                                new_cluster.health = old_cluster.health
                                 new_cluster.vms = sorted(old_cluster.vms, key=lambda vm: vm.id)
                                 new_cluster.vms = sorted(new_cluster.vms, key=lambda vm: vm.status)
                                 while 1:
@@ -267,6 +293,10 @@ class ResourcePool:
                             cluster.vm_destroy(vm, return_resources=False, reason="%s has been removed from system." % cluster.name)
                     old_resources.remove(cluster)
 
+        self.fit_index.rebuild(self.resources)
+        self.rebuild_lookup_tables()
+        self.bump_config_generation()
+
         self.setup_lock.release()
         if self.setup_queued:
             self.setup_queued = False
@@ -300,144 +330,21 @@ class ResourcePool:
                 log.error("%s hypervisor not supported." % hypervisor)
                 return None
 
-        if cloud_type == "Nimbus":
-            nets = splitnstrip(",", get_or_none(config, cluster, "networks"))
-            if len(nets) > 1:
-                # Split the vm_slots too
-                slots = map(int, splitnstrip(",", get_or_none(config, cluster, "vm_slots")))
-            else:
-                slots = [int(get_or_none(config, cluster, "vm_slots"))]
-            net_slots = {}
-            for x in range(len(nets)):
-                net_slots[nets[x]] = slots[x]
-            total_slots = sum(slots)
-            return nimbuscluster.NimbusCluster(name = cluster,
-                    host = get_or_none(config, cluster, "host"),
-                    port = get_or_none(config, cluster, "port"),
-                    cloud_type = get_or_none(config, cluster, "cloud_type"),
-                    memory = map(int, splitnstrip(",", get_or_none(config, cluster, "memory"))),
-                    max_vm_mem = max_vm_mem,
-                    cpu_archs = splitnstrip(",", get_or_none(config, cluster, "cpu_archs")),
-                    networks = nets,
-                    vm_slots = total_slots,
-                    cpu_cores = int(get_or_none(config, cluster, "cpu_cores")),
-                    storage = int(get_or_none(config, cluster, "storage")),
-                    max_vm_storage = max_vm_storage,
-                    netslots = net_slots,
-                    hypervisor = hypervisor,
-                    vm_lifetime = get_or_none(config, cluster, "vm_lifetime"),
-                    image_attach_device = get_or_none(config, cluster, "image_attach_device"),
-                    scratch_attach_device = get_or_none(config, cluster, "scratch_attach_device"),
-                    boot_timeout = get_or_none(config, cluster, "boot_timeout"),
-                    total_cpu_cores = total_cpu_cores,
-                    temp_lease_storage = get_or_none(config, cluster, "temp_lease_storage"),
-                    )
-
-        elif cloud_type == "AmazonEC2" or cloud_type == "Eucalyptus" or cloud_type == "OpenStack":
-            return ec2cluster.EC2Cluster(name = cluster,
-                    host = get_or_none(config, cluster, "host"),
-                    cloud_type = get_or_none(config, cluster, "cloud_type"),
-                    memory = map(int, splitnstrip(",", get_or_none(config, cluster, "memory"))),
-                    max_vm_mem = max_vm_mem if max_vm_mem != None else -1,
-                    cpu_archs = splitnstrip(",", get_or_none(config, cluster, "cpu_archs")),
-                    networks = splitnstrip(",", get_or_none(config, cluster, "networks")),
-                    vm_slots = int(get_or_none(config, cluster, "vm_slots")),
-                    cpu_cores = int(get_or_none(config, cluster, "cpu_cores")),
-                    storage = int(get_or_none(config, cluster, "storage")),
-                    access_key_id = get_or_none(config, cluster, "access_key_id"),
-                    secret_access_key = get_or_none(config, cluster, "secret_access_key"),
-                    security_group = splitnstrip(",", get_or_none(config, cluster, "security_group")),
-                    hypervisor = hypervisor,
-                    key_name = get_or_none(config, cluster, "key_name"),
-                    boot_timeout = get_or_none(config, cluster, "boot_timeout"),
-                    secure_connection = get_or_none(config, cluster, "secure_connection"),
-                    regions = map(str, splitnstrip(",", get_or_none(config, cluster, "regions"))),
-                    vm_domain_name = get_or_none(config, cluster, "vm_domain_name"),
-                    reverse_dns_lookup = get_or_none(config, cluster, "reverse_dns_lookup"),
-                    placement_zone = get_or_none(config, cluster, "placement_zone"),
-                    )
-
-        elif cloud_type == "StratusLab" and stratuslab_support:
-            return stratuslabcluster.StratusLabCluster(name = cluster,
-                    host = get_or_none(config, cluster, "host"),
-                    cloud_type = get_or_none(config, cluster, "cloud_type"),
-                    memory = map(int, splitnstrip(",", get_or_none(config, cluster, "memory"))),
-                    max_vm_mem = max_vm_mem if max_vm_mem != None else -1,
-                    cpu_archs = splitnstrip(",", get_or_none(config, cluster, "cpu_archs")),
-                    networks = splitnstrip(",", get_or_none(config, cluster, "networks")),
-                    vm_slots = int(get_or_none(config, cluster, "vm_slots")),
-                    cpu_cores = int(get_or_none(config, cluster, "cpu_cores")),
-                    storage = int(get_or_none(config, cluster, "storage")),
-                    hypervisor = hypervisor,
-                    contextualization = get_or_none(config, cluster, "contextualization")
-                    )
-
-        elif cloud_type.lower() == "ibmsmartcloud":
-            return ibmcluster.IBMCluster(name= cluster,
-                    host= get_or_none(config, cluster, "host"),
-                    cloud_type= get_or_none(config, cluster, "cloud_type"),
-                    memory= map(int, splitnstrip(",", get_or_none(config, cluster, "memory"))),
-                    max_vm_mem= max_vm_mem if max_vm_mem != None else -1,
-                    cpu_archs= splitnstrip(",", get_or_none(config, cluster, "cpu_archs")),
-                    networks= splitnstrip(",", get_or_none(config, cluster, "networks")),
-                    vm_slots= int(get_or_none(config, cluster, "vm_slots")),
-                    cpu_cores= int(get_or_none(config, cluster, "cpu_cores")),
-                    storage= int(get_or_none(config, cluster, "storage")),
-                    hypervisor= hypervisor,
-                    username= get_or_none(config, cluster, "username"),
-                    password= get_or_none(config, cluster, "password"),
-                    )
-        elif cloud_type.lower() == "googlecomputeengine" or cloud_type.lower() == "gce":
-            return googlecluster.GoogleComputeEngineCluster(name = cluster,
-                    cloud_type = get_or_none(config, cluster, "cloud_type"),
-                    memory = map(int, splitnstrip(",", get_or_none(config, cluster, "memory"))),
-                    max_vm_mem = max_vm_mem if max_vm_mem != None else -1,
-                    cpu_archs = splitnstrip(",", get_or_none(config, cluster, "cpu_archs")),
-                    networks = splitnstrip(",", get_or_none(config, cluster, "networks")),
-                    vm_slots = int(get_or_none(config, cluster, "vm_slots")),
-                    cpu_cores = int(get_or_none(config, cluster, "cpu_cores")),
-                    storage = int(get_or_none(config, cluster, "storage")),
-                    auth_dat_file = get_or_none(config, cluster, "auth_dat_file"),
-                    secret_file = get_or_none(config, cluster, "secret_file"),
-                    security_group = splitnstrip(",", get_or_none(config, cluster, "security_group")),
-                    boot_timeout = get_or_none(config, cluster, "boot_timeout"),
-                    project_id = get_or_none(config, cluster, "project_id"),
-                    )
-        elif cloud_type == "OpenStackNative":
-            return openstackcluster.OpenStackCluster(name = cluster,
-                    host = get_or_none(config, cluster, "host"),
-                    cloud_type = get_or_none(config, cluster, "cloud_type"),
-                    memory = map(int, splitnstrip(",", get_or_none(config, cluster, "memory"))),
-                    max_vm_mem = max_vm_mem if max_vm_mem != None else -1,
-                    cpu_archs = splitnstrip(",", get_or_none(config, cluster, "cpu_archs")),
-                    networks = splitnstrip(",", get_or_none(config, cluster, "networks")),
-                    vm_slots = int(get_or_none(config, cluster, "vm_slots")),
-                    cpu_cores = int(get_or_none(config, cluster, "cpu_cores")),
-                    storage = int(get_or_none(config, cluster, "storage")),
-                    access_key_id = get_or_none(config, cluster, "access_key_id"),
-                    secret_access_key = get_or_none(config, cluster, "secret_access_key"),
-                    username = get_or_none(config, cluster, "username"),
-                    password = get_or_none(config, cluster, "password"),
-                    tenant_name = get_or_none(config, cluster, "tenant_name"),
-                    auth_url = get_or_none(config, cluster, "auth_url"),
-                    security_group = splitnstrip(",", get_or_none(config, cluster, "security_group")),
-                    hypervisor = hypervisor,
-                    key_name = get_or_none(config, cluster, "key_name"),
-                    boot_timeout = get_or_none(config, cluster, "boot_timeout"),
-                    secure_connection = get_or_none(config, cluster, "secure_connection"),
-                    regions = map(str, splitnstrip(",", get_or_none(config, cluster, "regions"))),
-                    vm_domain_name = get_or_none(config, cluster, "vm_domain_name"),
-                    reverse_dns_lookup = get_or_none(config, cluster, "reverse_dns_lookup"),
-                    placement_zone = get_or_none(config, cluster, "placement_zone"),
-                    )
-        else:
+        factory = cluster_tools.cloud_type_factory(cloud_type)
+        if not factory:
             log.error("ResourcePool.setup doesn't know what to do with the %s cloud_type" % cloud_type)
             return None
+        common = {'max_vm_mem': max_vm_mem, 'max_vm_storage': max_vm_storage,
+                  'total_cpu_cores': total_cpu_cores, 'hypervisor': hypervisor}
+        return factory(config, cluster, common)
 
 
     def add_resource(self, cluster):
         """Add a cluster resource to the pool's resource list."""
         self.resources.append(cluster)
+        self.fit_index.rebuild(self.resources)
+        self.rebuild_lookup_tables()
+        self.bump_config_generation()
 
     def log_list(self, clusters):
         """Log a list of clusters.
@@ -551,96 +458,19 @@ class ResourcePool:
             log.debug("Pool is empty... Cannot return list of fitting resources")
             return []
 
+        candidates = self.fit_index.fitting(network, memory, cpucores, storage, ami, imageloc, hypervisor,
+                                            self.filter_resources_by_names(targets) if len(targets) > 0 else None,
+                                            blocked)
+
+        # Enabled and banned change without touching capacity so are not indexed
         fitting_clusters = []
-        if len(targets) > 0:
-            clusters = self.filter_resources_by_names(targets)
-        else:
-            clusters = self.resources
-        for cluster in clusters:
-            log.verbose("Trying with cluster %s (Name: %s)" % (str(cluster), cluster.name))
+        for cluster in candidates:
             if not cluster.enabled:
                 continue
-            if cluster.name in blocked:
-                log.verbose("get_fitting_resources - %s is blocked." % cluster.name)
-                continue
-            if cluster.__class__.__name__ == "NimbusCluster":
-                # If not valid image file to download
-                if imageloc == "":
-                    continue
-                # If required network is NOT in cluster's network associations
-                # if network is undefined then it means pick whatever, so we
-                # just always okay it.
-                if network and (network not in cluster.network_pools):
-                    log.verbose("get_fitting_resources - No matching networks in %s" % cluster.name)
-                    continue
-                if network and network in cluster.net_slots.keys() and cluster.net_slots[network] <= 0:
-                    log.verbose("get_fitting_resources - No Slots left in network %s on %s" % (network, cluster.name))
-                    continue
-                if not network:
-                    full = True
-                    for net in cluster.net_slots.keys():
-                        if cluster.net_slots[net] > 0:
-                            full = False
-                    if full:
-                        log.verbose("get_fitting_resources - No Slots left on %s" % cluster.name)
-                        continue
-                if imageloc in self.banned_job_resource.keys():
-                    if cluster.name in self.banned_job_resource[imageloc]:
-                        log.verbose("get_fitting_resources - %s cloud is banned for image location" % cluster.name)
-                        continue
-                if cluster.max_vm_storage != -1 and storage > cluster.max_vm_storage:
-                    log.verbose("get_fitting_resources - Storage request exceeds max_vm_storage for %s" % cluster.name)
-                    continue
-                if cluster.total_cpu_cores != -1 and cpucores > cluster.total_cpu_cores:
-                    log.verbose("get_fitting_resources - cpu request greater than total available cores on %s" % cluster.name)
-                    continue
-                if cluster.hypervisor not in hypervisor:
-                    log.verbose("get_fitting_resources - Wrong hypervisor on %s" % cluster.name)
-                    continue
-            elif cluster.__class__.__name__ == "EC2Cluster":
-                # If no valid ami to boot from
-                if ami == "":
-                    continue
-                # If ami banned from cluster
-                if ami in self.banned_job_resource.keys():
-                    if cluster.name in self.banned_job_resource[ami]:
-                        log.verbose("get_fitting_resources - %s ami banned on %s" % (ami, cluster.name))
-                        continue
-            
-            elif cluster.__class__.__name__ == "StratusLabCluster" and stratuslab_support:
-                # If not valid image file
-                if imageloc == "":
-                    continue
-                if imageloc in self.banned_job_resource.keys():
-                    if cluster.name in self.banned_job_resource[imageloc]:
-                        continue
-                if (not Image.isDiskId(imageloc)) and (not Image.isImageId(imageloc)):
-                    continue
-            
-            # If the cluster has no open VM slots
-            if (cluster.vm_slots <= 0):
-                log.verbose("get_fitting_resources - No free slots in %s" % cluster.name)
-                continue
-            # If the cluster does not have the required CPU architecture
-            #if (cpuarch not in cluster.cpu_archs):
-                #log.verbose("get_fitting_resources - No matching CPU archs in %s" % cluster.name)
-                #continue
-            # If request exceeds the max vm memory on cluster
-            if memory > cluster.max_vm_mem and cluster.max_vm_mem != -1:
-                continue
-            # If the cluster has no sufficient memory entries for the VM
-            if (cluster.find_mementry(memory) < 0):
-                log.verbose("get_fitting_resources - No available memory entry in %s" % cluster.name)
-                continue
-            # If the cluster does not have sufficient CPU cores
-            if (cpucores > cluster.cpu_cores):
-                log.verbose("get_fitting_resources - Not enough CPU Cores in %s" % cluster.name)
-                continue
-            # If the cluster does not have sufficient storage capacity
-            if (storage > cluster.storageGB):
-                log.verbose("get_fitting_resources - Not enough storage in %s" % cluster.name)
+            image = cluster.banned_image(ami, imageloc)
+            if image != None and cluster.name in self._banned_clusters(image):
+                log.verbose("get_fitting_resources - %s banned on %s" % (image, cluster.name))
                 continue
-            # Add cluster to the list to be returned (meets all job reqs)
             fitting_clusters.append(cluster)
 
         # Return the list clusters that fit given requirements
@@ -650,6 +480,14 @@ class ResourcePool:
         return fitting_clusters
 
 
+    def _banned_clusters(self, image):
+        """Names of the clusters image (an image location or ami) is banned from."""
+        try:
+            return self.banned_job_resource.get(image, [])
+        except TypeError:
+            # A job's ami dict can't be a ban key
+            return []
+
     def get_resourceBF(self, network, cpuarch, memory, cpucores, storage, ami, imageloc, targets=[], hypervisor=['xen'], blocked=[]):
         """
         Returns a resource that fits given requirements and fits some balance
@@ -695,10 +533,32 @@ class ResourcePool:
             log.verbose("Only one cluster fits parameters. Returning that cluster.")
             return fitting_clusters
 
-        # sort them based on how full and return the list
-        fitting_clusters.sort(key=lambda cluster: cluster.slot_fill_ratio())
+        # sort them by score (how full, how fast and how reliable) and return the list
+        fitting_clusters.sort(key=cloud_score)
         return fitting_clusters
 
+    def bump_config_generation(self):
+        """Start a new cluster configuration generation, dropping the cached
+        potential fits. Must be called whenever clusters are added, removed,
+        enabled or disabled, the cloud aliases are reloaded or bans change."""
+        with self.potential_fit_lock:
+            self.config_generation += 1
+            self.potential_fits = {}
+
+    def _cached_potential_fit(self, requirements, find):
+        """Returns the cached result for requirements, calling find to get it
+        on a miss."""
+        with self.potential_fit_lock:
+            key = (self.config_generation, requirements)
+            if key in self.potential_fits:
+                return self.potential_fits[key]
+        result = find()
+        with self.potential_fit_lock:
+            # Don't store a result computed against an older generation
+            if key[0] == self.config_generation:
+                self.potential_fits[key] = result
+        return result
+
     def resourcePF(self, network, cpuarch, memory=0, disk=0, hypervisor=['xen']):
         """
         Check that a cluster will be able to meet the static requirements.
@@ -712,6 +572,10 @@ class ResourcePool:
                 Otherwise, returns False
 
         """
+        return self._cached_potential_fit(("PF", network, memory, disk, tuple(hypervisor)),
+                lambda: self._resourcePF(network, cpuarch, memory, disk, hypervisor))
+
+    def _resourcePF(self, network, cpuarch, memory, disk, hypervisor):
         potential_fit = False
 
         for cluster in self.resources:
@@ -728,9 +592,7 @@ class ResourcePool:
                 continue
             if not cluster.find_potential_mementry(memory):
                 continue
-            if cluster.__class__.__name__ == "NimbusCluster" and cluster.max_vm_storage != -1 and disk > cluster.max_vm_storage:
-                continue
-            if cluster.__class__.__name__ == "NimbusCluster" and cluster.hypervisor not in hypervisor:
+            if not cluster.fits_vm(network, disk, hypervisor):
                 continue
             # Cluster meets network and cpu reqs and may have enough memory
             potential_fit = True
@@ -753,6 +615,13 @@ class ResourcePool:
         Return:
             list of clusters that fit requirements
         """
+        requirements = (network, memory, disk, tuple(targets), tuple(hypervisor), cpucores, tuple(blocked))
+        return list(self._cached_potential_fit(requirements,
+                lambda: self._get_potential_fitting_resources(network, cpuarch, memory, disk,
+                                                              targets, hypervisor, cpucores, blocked)))
+
+    def _get_potential_fitting_resources(self, network, cpuarch, memory, disk, targets,
+                                         hypervisor, cpucores, blocked):
         fitting = []
         clusters = []
         if len(targets) == 0:
@@ -764,8 +633,6 @@ class ResourcePool:
                 continue
             if cluster.name in blocked:
                 continue
-            if cluster.__class__.__name__ == "NimbusCluster" and cluster.hypervisor not in hypervisor:
-                continue
             #if not (cpuarch in cluster.cpu_archs):
                 #continue
             # If required network is NOT in cluster's network associations
@@ -778,7 +645,7 @@ class ResourcePool:
                 continue
             if disk > cluster.max_storageGB:
                 continue
-            if cluster.__class__.__name__ == "NimbusCluster" and cluster.max_vm_storage != -1 and disk > cluster.max_vm_storage:
+            if not cluster.fits_vm(network, disk, hypervisor):
                 continue
 
             fitting.append(cluster)
@@ -786,22 +653,34 @@ class ResourcePool:
 
     def filter_resources_by_names(self, names):
         """Return list of clusters that match names."""
-        expanded_names = self.resolve_target_cloud_alias(names)
-        clusters = []
-        for name in expanded_names:
-            cluster = self.get_cluster(name)
-            if cluster != None:
-                clusters.append(cluster)
-            else:
-                log.debug("No Cluster with name %s in system" % name)
-        return clusters
+        expanded_names = set(self.resolve_target_cloud_alias(names))
+        clusters_by_name = self.clusters_by_name
+        for name in expanded_names.difference(clusters_by_name):
+            log.debug("No Cluster with name %s in system" % name)
+        return [clusters_by_name[name] for name in expanded_names.intersection(clusters_by_name)]
 
     def get_cluster(self, cluster_name):
         """Return cluster that matches cluster_name."""
-        for cluster in self.resources:
-            if cluster.name == cluster_name:
-                return cluster
-        return None
+        return self.clusters_by_name.get(cluster_name)
+
+    def rebuild_lookup_tables(self):
+        """Rebuild the cluster name and cloud alias tables. Must be called
+        whenever the resources list or the cloud aliases change."""
+        clusters_by_name = {}
+        for cluster in reversed(self.resources):
+            clusters_by_name[cluster.name] = cluster
+        alias_targets = {}
+        for (alias, names) in self.target_cloud_aliases.iteritems():
+            alias_targets[alias] = frozenset(names)
+        # Swap whole tables so readers never see a half built one
+        self.clusters_by_name = clusters_by_name
+        self.alias_targets = alias_targets
+
+    def set_cloud_aliases(self, aliases):
+        """Replace the cloud aliases, as returned by load_cloud_aliases."""
+        self.target_cloud_aliases = aliases
+        self.rebuild_lookup_tables()
+        self.bump_config_generation()
 
     def get_cluster_with_vm(self, vm):
         """Find cluster that contains vm."""
@@ -1040,15 +919,19 @@ class ResourcePool:
 
 
     def get_vmtypes_count_internal(self):
-        """Get a dictionary of uservmtypes of VMs the scheduler is currently tracking."""
+        """Get a dictionary of uservmtypes of VMs the scheduler is currently tracking,
+        including VMs still being created."""
         types = defaultdict(int)
         for cluster in self.resources:
             for vm in cluster.vms:
                 types[vm.uservmtype] += 1
+            for reservation in cluster.reservations:
+                types[reservation.uservmtype] += 1
         return types
 
     def get_vmtypes_count_cpu_slots(self):
-        """Get a dictionary of uservmtypes of VMs the scheduler is currently tracking."""
+        """Get a dictionary of uservmtypes of VMs the scheduler is currently tracking,
+        including VMs still being created."""
         types = defaultdict(int)
         for cluster in self.resources:
             for vm in cluster.vms:
@@ -1056,13 +939,15 @@ class ResourcePool:
                     types[vm.uservmtype] += vm.cpucores
                 else:
                     types[vm.uservmtype] += 1
+            for reservation in cluster.reservations:
+                types[reservation.uservmtype] += reservation.cpu_slots
         return types
 
     def get_vm_count_user(self, user):
-        """Get a count of the number of VMs for specified user."""
+        """Get a count of the number of VMs for specified user, including VMs being created."""
         count = 0
         for cluster in self.resources:
-            for vm in cluster.vms:
+            for vm in cluster.vms + cluster.reservations:
                 if vm.user == user:
                     count += 1
         return count
@@ -1261,6 +1146,17 @@ class ResourcePool:
             changed[n] = changed[n].split('.')[0]
         return changed
 
+    def machines_changed(self, current, previous):
+        """Take the current and previous VMMachine lists
+        return True if machines have been added or removed, or if any has
+        changed job, state or activity.
+        """
+        if len(current) != len(previous):
+            return True
+        auxCurrent = set((d.name, d.global_job_id, d.state, d.activity) for d in current)
+        auxPrevious = set((d.name, d.global_job_id, d.state, d.activity) for d in previous)
+        return auxCurrent != auxPrevious
+
     def save_persistence(self):
         """
         save_persistence - pickle the resources list to the persistence file
@@ -1388,6 +1284,7 @@ class ResourcePool:
                             self.banned_job_resource[img].append(cq.name)
                             banned_changed = True
             if banned_changed:
+                self.bump_config_generation()
                 self.save_banned_job_resource()
                 log.verbose("Updating Banned job file")
 
@@ -1455,6 +1352,7 @@ class ResourcePool:
                                 if foundit:
                                     break
             self.banned_job_resource = updated_ban
+            self.bump_config_generation()
 
     def load_user_limits(self, path=None):
             limit_file = None
@@ -1652,6 +1550,10 @@ class ResourcePool:
                 break
         return vm_match
 
+    def get_vm_hostname_index(self):
+        """Build a VMHostnameIndex of all the VMs in the system."""
+        return VMHostnameIndex(self.get_all_vms())
+
     def retiring_vms_of_type(self, vmtype):
         """Get a list of the VMs in the Retiring state of the given type."""
         retiring = []
@@ -1683,9 +1585,10 @@ class ResourcePool:
         return starting
     
     def get_num_starting_vms(self):
-        """Count the number of starting state VMs."""
+        """Count the number of starting state VMs, including VMs being created."""
         num_starting = 0
         for cluster in self.resources:
+            num_starting += len(cluster.reservations)
             for vm in cluster.vms:
                 if vm.status == "Starting" or vm.status == "Unpropagated":
                     num_starting += 1
@@ -1759,18 +1662,18 @@ class ResourcePool:
         if cluster:
             vm = cluster.get_vm(vmid)
             if vm:
-                # found the vm - shutdown
-                # move the vmdestroycmd thread into a better place and import so avilable here
-                thread = VMDestroyCmd(cluster, vm, reason="Shutdown request from admin client.")
-                thread.start()
-                while thread.is_alive():
-                    time.sleep(1)
-                if not thread.is_alive():
-                    if thread.get_result() != 0:
-                        output = "Destroying VM %s failed. Leaving it for now." % thread.get_vm().id
-                    else:
-                        output = "VM %s has been Destroyed." % thread.get_vm().id
-                    thread.join()
+                # found the vm - shutdown, once, even if it was given up on before
+                task = self.destroyer.destroy(cluster, vm, reason="Shutdown request from admin client.",
+                                              retries=0, retry_dead=True)
+                if task == None:
+                    output = "VM %s is already being destroyed." % vm.id
+                elif task.wait() != 0:
+                    output = "Destroying VM %s failed. Leaving it for now." % vm.id
+                elif vm in cluster.vms:
+                    # Left by the driver to finish in the background
+                    output = "VM %s is shutting down and will be destroyed shortly." % vm.id
+                else:
+                    output = "VM %s has been Destroyed." % vm.id
             else:
                 output = "Could not find VM with ID: %s on Cluster: %s." % (vmid, clustername)
         else:
@@ -1780,25 +1683,23 @@ class ResourcePool:
     def shutdown_cluster_all(self, clustername):
         """Manually shutdown all VMs on a cluster, for use by cloud_admin."""
         output = ""
-        vmdesth = {}
         cluster = self.get_cluster(clustername)
         if cluster:
-            for vm in cluster.vms:
-                th = VMDestroyCmd(cluster, vm, reason="Shutdown request from admin client.")
-                vmdesth[vm.id] = th
-                th.start()
-            while len(vmdesth) > 0:
-                to_remove = []
-                for k, thread in vmdesth.iteritems():
-                    if not thread.is_alive():
-                        if thread.get_result() != 0:
-                            output += "Destroying VM %s failed. Leaving it for now.\n" % thread.get_vm().id
-                        else:
-                            output += "VM %s has been Destroyed.\n" % thread.get_vm().id
-                        thread.join()
-                        to_remove.append(k)
-                for k in to_remove:
-                    del vmdesth[k]
+            # Leave the VMs the destroyer is already destroying to it
+            vms = []
+            for vm in list(cluster.vms):
+                if self.destroyer.is_pending(cluster, vm, dead=False):
+                    output += "VM %s is already being destroyed.\n" % vm.id
+                else:
+                    vms.append(vm)
+            th = VMBatchDestroyCmd(cluster, vms, reason="Shutdown request from admin client.")
+            th.start()
+            th.join()
+            for (vm, result) in th.get_results():
+                if result != 0:
+                    output += "Destroying VM %s failed. Leaving it for now.\n" % vm.id
+                else:
+                    output += "VM %s has been Destroyed.\n" % vm.id
         else:
             output = "Could not find a Cluster with name: %s." % clustername
         return output
@@ -1874,12 +1775,39 @@ class ResourcePool:
             output = "Cloud not find Cloud %s." % cloudname
         return output
 
+    def get_cloud_health_info(self):
+        return get_cloud_health_info(self.resources)
+
+    def get_memory_fragmentation_info(self):
+        """Returns a formatted report of the memory entries of each cluster."""
+        output = ["%-20s %-10s %8s %12s %12s %14s %8s %9s %12s\n" % ("Cloud", "Policy", "Entries",
+                  "Free MB", "Largest MB", "Fragmentation", "Finds", "Failures", "Fragmented")]
+        for cluster in self.resources:
+            (policy, entries, free, largest, fragmentation, finds, failures, fragmented) = cluster.get_memory_stats()
+            output.append("%-20s %-10s %8d %12d %12d %13.1f%% %8d %9d %12d\n" % (cluster.name, policy,
+                          entries, free, largest, fragmentation * 100, finds, failures, fragmented))
+        return ''.join(output)
+
+    def get_connection_info(self):
+        """Returns a formatted report of the API connections made to each
+        cluster reusing its connections."""
+        output = ["%-20s %8s %8s %8s %8s %8s %10s %10s\n" % ("Cloud", "Uses", "Connects", "Failed",
+                  "Expired", "Auth Err", "Avg s", "Max s")]
+        for cluster in self.resources:
+            (gets, connects, failed, expired, auth_failures, average, longest) = cluster.connections.get_stats()
+            if not gets:
+                continue
+            output.append("%-20s %8d %8d %8d %8d %8d %10.3f %10.3f\n" % (cluster.name, gets, connects,
+                          failed, expired, auth_failures, average, longest))
+        return ''.join(output)
+
     def disable_cluster(self, clustername):
         """Toggles the enabled flag for a cluster, for use by cloud_admin."""
         cluster = self.get_cluster(clustername)
         ret = ""
         if cluster:
             cluster.enabled = False
+            self.bump_config_generation()
             ret = "Cloud: %s disabled." % clustername
         else:
             ret = "Could not find cloud %s." % clustername
@@ -1891,6 +1819,7 @@ class ResourcePool:
         ret = ""
         if cluster:
             cluster.enabled = True
+            self.bump_config_generation()
             ret = "Cloud: %s enabled." % clustername
         else:
             ret = "Could not find cloud %s." % clustername
@@ -1978,34 +1907,39 @@ class ResourcePool:
         return vm_machine_list
 
     def resolve_target_cloud_alias(self, targets):
-        expanded_targets = []
+        alias_targets = self.alias_targets
+        expanded_targets = set()
         for cloud in targets:
-            if cloud in self.target_cloud_aliases.keys():
-                expanded_targets.extend(self.target_cloud_aliases[cloud])
+            if cloud in alias_targets:
+                expanded_targets |= alias_targets[cloud]
             else:
-                expanded_targets.append(cloud)
-        trimmed_targets = list(set(expanded_targets))
-        return trimmed_targets
+                expanded_targets.add(cloud)
+        return list(expanded_targets)
     
-class VMDestroyCmd(threading.Thread):
+class VMBatchDestroyCmd(threading.Thread):
     """
-    VMCmd - passing shutdown and destroy requests to a separate thread 
+    VMBatchDestroyCmd - destroy a list of VMs of a cluster together in a
+    separate thread, with as few calls as the cluster's driver allows
     """
 
-    def __init__(self, cluster, vm, reason=""):
+    def __init__(self, cluster, vms, reason=""):
         threading.Thread.__init__(self, name=self.__class__.__name__)
         self.cluster = cluster
-        self.vm = vm
-        self.result = None
+        self.vms = list(vms)
+        self.results = [None] * len(self.vms)
         self.reason = reason
     def run(self):
-        self.result = self.cluster.vm_destroy(self.vm, reason=self.reason)
-        if self.result != 0:
-            log.error("Failed to destroy vm %s on %s" % (self.vm.id, self.vm.clusteraddr))
-    def get_result(self):
-        return self.result
-    def get_vm(self):
-        return self.vm
+        try:
+            self.results = self.cluster.vm_destroy_batch(self.vms, reason=self.reason)
+        except:
+            log.exception("Unexpected error destroying vms on %s" % self.cluster.name)
+        for (vm, result) in zip(self.vms, self.results):
+            self.cluster.health.record_destroy(result == 0)
+            if result != 0:
+                log.error("Failed to destroy vm %s on %s" % (vm.id, vm.clusteraddr))
+    def get_results(self):
+        """Returns (vm, result) for each VM."""
+        return zip(self.vms, self.results)
 
 class VMMachine():
     """
@@ -2046,3 +1980,39 @@ class VMMachine():
     
     def get_uservmtype(self):
         return ''.join([self.remote_owner, self.vmtype])
+
+class VMHostnameIndex():
+    """
+    VMHostnameIndex - hash index of VMs by hostname for matching condor machine names
+
+    Lookups follow the same rules as utilities.match_host_with_condor_host:
+    an exact match on the hostname without the slot, otherwise, unless the
+    condor name is an IP address, a match on the first part of the hostname.
+    """
+
+    def __init__(self, vms):
+        self.by_hostname = {}
+        self.by_short_hostname = {}
+        for vm in vms:
+            if not vm.hostname:
+                continue
+            self.by_hostname.setdefault(vm.hostname, vm)
+            if not self._is_ip(vm.hostname):
+                self.by_short_hostname.setdefault(vm.hostname.split('.')[0], vm)
+
+    @staticmethod
+    def _is_ip(hostname):
+        try:
+            socket.inet_aton(hostname)
+            return True
+        except:
+            return False
+
+    def find(self, condor_name):
+        """Return the VM matching the condor machine name or None."""
+        condor_name = condor_name.split('@')[-1]
+        if condor_name in self.by_hostname:
+            return self.by_hostname[condor_name]
+        if self._is_ip(condor_name):
+            return None
+        return self.by_short_hostname.get(condor_name.split('.')[0])
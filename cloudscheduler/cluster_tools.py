@@ -26,14 +26,44 @@ import threading
 
 from subprocess import Popen
 from urlparse import urlparse
+from contextlib import contextmanager
 
 import nimbus_xml
 import config
 import cloudscheduler.utilities as utilities
 from cloudscheduler.utilities import get_cert_expiry_time
+from cloudscheduler.mem_allocator import MemoryAllocator
+from cloudscheduler.cloud_health import CloudHealth
+from cloudscheduler.connection_manager import ConnectionManager
 
 log = utilities.get_cloudscheduler_logger()
 
+# cloud_type (lower case) -> function building a cluster from the cloud
+# resources config, see register_cloud_type
+_cloud_types = {}
+
+
+def register_cloud_type(cloud_type, factory):
+    """Register the driver for a cloud_type of the cloud resources config.
+
+    factory(config, section, common) returns the ICluster subclass instance
+    for a cloud, or None if it can't be set up. config is the ConfigParser of
+    the cloud resources file, section the cloud's name, and common a dict of
+    the options parsed the same way for every cloud type: max_vm_mem,
+    max_vm_storage, total_cpu_cores and hypervisor.
+
+    Drivers outside of Cloud Scheduler register themselves when imported,
+    through the cloud_driver_modules option.
+    """
+    _cloud_types[cloud_type.lower()] = factory
+
+
+def cloud_type_factory(cloud_type):
+    """Returns the factory registered for cloud_type, or None."""
+    if not cloud_type:
+        return None
+    return _cloud_types.get(cloud_type.lower())
+
 
 class VM:
     """
@@ -113,6 +143,7 @@ class VM:
         self.last_state_change = None
         self.initialize_time = int(time.time())
         self.startup_time = None
+        self.register_time = None
         self.keep_alive = keep_alive
         self.idle_start = None
         self.spot_id = spot_id
@@ -269,6 +300,32 @@ class VM:
             env = {'X509_USER_PROXY':self.get_proxy_file()}
         return env
 
+# The reservations, if any, held by the create call running on this thread,
+# see ICluster.holding
+_held = threading.local()
+
+
+class Reservation:
+    """
+    The resources checked out of a cluster for a VM whose create call has not
+    finished yet, so that other placements don't count on them meanwhile.
+    Counted as a Starting VM of uservmtype for user until the VM takes it
+    over or it is released.
+    """
+
+    def __init__(self, cluster, memory, storage, mementry, uservmtype="", user="", cpu_slots=1):
+        self.cluster = cluster
+        self.name = "reservation for %s" % uservmtype
+        self.id = None
+        self.memory = memory
+        self.storage = storage
+        self.mementry = mementry
+        self.uservmtype = uservmtype
+        self.user = user
+        self.cpu_slots = cpu_slots
+        self.status = "Starting"
+
+
 class NoResourcesError(Exception):
     """Exception raised for errors where not enough resources are available
 
@@ -289,6 +346,9 @@ class ICluster:
     and vm_destroy
     """
 
+    # Most distinct user data kept by vm_userdata
+    MAX_USERDATA = 100
+
     def __init__(self, name="Dummy Cluster", host="localhost",
                  cloud_type="Dummy", memory=[], max_vm_mem= -1, cpu_archs=[], networks=[],
                  vm_slots=0, cpu_cores=0, storage=0, hypervisor='xen', boot_timeout=None):
@@ -314,6 +374,12 @@ class ICluster:
         self.connection_fail_disable_time = config.connection_fail_disable_time
         self.connection_problem = False
         self.errorconnect = None
+        self.fit_index = None
+        self.mem_allocator = MemoryAllocator(self.memory)
+        self.health = CloudHealth()
+        self.reservations = []
+        self.connections = ConnectionManager(self)
+        self.userdata = {}
 
         self.setup_logging()
         log.debug("New cluster %s created" % self.name)
@@ -323,6 +389,10 @@ class ICluster:
         state = self.__dict__.copy()
         del state['vms_lock']
         del state['res_lock']
+        state.pop('fit_index', None)
+        state.pop('mem_allocator', None)
+        state.pop('reservations', None)
+        state.pop('userdata', None)
         return state
 
     def __setstate__(self, state):
@@ -330,6 +400,14 @@ class ICluster:
         self.__dict__ = state
         self.vms_lock = threading.RLock()
         self.res_lock = threading.RLock()
+        self.fit_index = None
+        self.mem_allocator = MemoryAllocator(self.memory)
+        self.reservations = []
+        self.userdata = {}
+        if 'health' not in state:
+            self.health = CloudHealth()
+        if 'connections' not in state:
+            self.connections = ConnectionManager(self)
 
     def __repr__(self):
         return self.name
@@ -434,30 +512,161 @@ class ICluster:
         log.debug('This method should be defined by all subclasses of Cluster\n')
         assert 0, 'Must define workspace_poll'
 
+    def _connect(self):
+        """Return a new authenticated client for the cloud's API, or None if
+        one can't be made. Drivers reusing their client through
+        self.connections (a ConnectionManager) override this."""
+        return None
+
+    def _auth_error(self, error):
+        """Returns True if error, raised by a call to the cloud's API, means
+        the client has to authenticate again."""
+        return False
+
+    def vm_poll_all(self, vms):
+        """Poll a list of VMs of the cluster, returning the new status of
+        each, in order. The default polls them one at a time with vm_poll;
+        drivers that can query many VMs in a single call override it."""
+        return [self.vm_poll(vm) for vm in vms]
+
+    def vm_poll_interruptions(self):
+        """Check the cluster's VMs for notice that the cloud is taking them
+        back (spot or preemptible instances), marking them with an
+        'Interrupted' override status. Called every polling cycle whatever
+        the poll schedule of the VMs. Returns the VMs newly interrupted. The
+        default finds none."""
+        return []
+
+    def vm_batch_key(self, args):
+        """Returns a key shared by the vm_create arguments of VMs the cloud
+        can boot together in one vm_create_batch call, or None if the VM
+        must be created on its own. The default never batches."""
+        return None
+
+    def vm_create_batch(self, args_list):
+        """Create a VM for each keyword arguments of args_list, which share
+        a vm_batch_key. Returns the vm_create return code of each, in order.
+        The default calls vm_create for each."""
+        return [self.vm_create(**args) for args in args_list]
+
+    def vm_destroy_batch(self, vms, return_resources=True, reason=""):
+        """Destroy a list of VMs of the cluster, returning the vm_destroy
+        return code of each, in order. The default destroys them one at a
+        time; drivers that can terminate many VMs in a single call override
+        it."""
+        return [self.vm_destroy(vm, return_resources, reason) for vm in vms]
+
+    def finish_destroys(self):
+        """Wait for the destroys vm_destroy left to finish in the background,
+        if the driver leaves any, before the scheduler exits."""
+        pass
+
+    def vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations):
+        """Returns the keyword arguments of vm_create to boot a VM of the given
+        size for job. Subclasses add the image and options their cloud needs to
+        the ones every cloud takes."""
+        customizations.append((self.context_cloud_type(), "/var/lib/cloud_type"))
+        return {'vm_name':job.req_image,
+                'vm_type':job.req_vmtype,
+                'vm_user':job.user,
+                'vm_networkassoc':job.req_network,
+                'vm_cpuarch':job.req_cpuarch,
+                'vm_mem':vm_mem,
+                'vm_cores':vm_cores,
+                'vm_storage':vm_storage,
+                'customization':customizations,
+                'vm_keepalive':job.keep_alive,
+                'job_per_core':job.job_per_core}
+
+    def context_cloud_type(self):
+        """The cloud type written to /var/lib/cloud_type on the VM."""
+        return self.cloud_type
+
+    def vm_userdata(self, customization):
+        """Returns the user data of a VM with the customization files, as
+        nimbus_xml.ws_optional. As the customizations only differ by the
+        user and VM type of the job, the assembled user data is kept per
+        distinct customizations, for the launches of the same user and type
+        on this cloud to share."""
+        key = tuple(customization)
+        user_data = self.userdata.get(key)
+        if user_data == None:
+            user_data = nimbus_xml.ws_optional(customization)
+            if len(self.userdata) >= self.MAX_USERDATA:
+                self.userdata = {}
+            self.userdata[key] = user_data
+        return user_data
+
+
+    # Matching methods
+    #-!------------------------------------------------------------------------
+    # Subclasses override these to declare which VMs their cloud can boot,
+    # beyond the slot, memory, cpu core and storage checks the ResourcePool
+    # does for every cloud. fits_image and fits_vm must only depend on the
+    # cluster configuration, as their results are indexed until it changes.
+    #-!------------------------------------------------------------------------
+
+    def fits_image(self, ami, imageloc):
+        """Returns True if the cloud can boot a VM from the job's image,
+        given as an ami dict and an image location url."""
+        return True
+
+    def fits_vm(self, network, storage, hypervisor):
+        """Returns True if the cloud allows a VM on network with storage GB of
+        scratch space and one of the hypervisor list."""
+        return True
+
+    def fits_capacity(self, network, cpucores):
+        """Returns True if the cloud has the capacity left, beyond VM slots,
+        memory and storage, for a VM on network with cpucores cores."""
+        return True
+
+    def banned_image(self, ami, imageloc):
+        """Returns the image bans of the job on this cloud are tracked under,
+        or None if the cloud is never banned."""
+        return None
+
 
     ## Private VM methods
 
+    def _allocator(self):
+        """Returns the memory allocator, re-indexing it if the 'memory' list
+        was replaced."""
+        if self.mem_allocator.source is not self.memory:
+            self.mem_allocator.reset(self.memory)
+        return self.mem_allocator
+
     def find_mementry(self, memory):
         """Finds a memory entry in the Cluster's 'memory' list which supports the
-        requested amount of memory for the VM. If multiple memory entries fit
-        the request, returns the first suitable entry. Returns an exact fit if
-        one exists.
+        requested amount of memory for the VM, chosen by the memory_allocation
+        policy. With the default firstfit policy returns an exact fit if one
+        exists, else the first suitable entry.
         Parameters: memory - the memory required for VM creation
-        Return: The index of the first fitting entry in the Cluster's 'memory'
-        list.
+        Return: The index of the chosen entry in the Cluster's 'memory' list.
         If no fitting memory entries are found, returns -1 (error!)
         """
-        # Check for exact fit
-        if (memory in self.memory):
-            return self.memory.index(memory)
-
-        # Scan for any fit
-        for i in range(len(self.memory)):
-            if self.memory[i] >= memory:
-                return i
-
-        # If no entries found, return error code.
-        return(-1)
+        with self.res_lock:
+            reservation = self._held_reservation(memory)
+            if reservation:
+                return reservation.mementry
+            return self._allocator().find(memory)
+
+    def set_mementry(self, index, free):
+        """Set the free memory of an entry of the Cluster's 'memory' list.
+        All changes to entries must go through here to keep the allocator
+        in step."""
+        with self.res_lock:
+            allocator = self._allocator()
+            self.memory[index] = free
+            allocator.set(index, free)
+            self.capacity_changed()
+
+    def get_memory_stats(self):
+        """Returns the allocation policy followed by MemoryAllocator.get_stats
+        for the Cluster's 'memory' list."""
+        with self.res_lock:
+            allocator = self._allocator()
+            return (allocator.policy,) + allocator.get_stats()
 
     def find_potential_mementry(self, memory):
         """Check if a cluster contains a memory entry with adequate space for given memory value.
@@ -484,6 +693,10 @@ class ICluster:
         """
         log.debug("Checking out resources for VM %s from Cluster %s" % (vm.name, self.name))
         with self.res_lock:
+            # A VM created under a reservation takes over its resources
+            reservation = self._held_reservation(vm.memory, vm.mementry)
+            if reservation:
+                self.release(reservation)
 
             remaining_vm_slots = self.vm_slots - 1
             if remaining_vm_slots < 0:
@@ -500,7 +713,7 @@ class ICluster:
             # Otherwise, we can check out these resources
             self.vm_slots = remaining_vm_slots
             self.storageGB = remaining_storage
-            self.memory[vm.mementry] = remaining_memory
+            self.set_mementry(vm.mementry, remaining_memory)
 
     def resource_return(self, vm):
         """Returns the resources taken by the passed in VM to the Cluster's internal
@@ -514,7 +727,63 @@ class ICluster:
             self.storageGB += vm.storage
             # ISSUE: No way to know what mementry a VM is running on
             try:
-                self.memory[vm.mementry] += vm.memory
+                self.set_mementry(vm.mementry, self.memory[vm.mementry] + vm.memory)
             except:
                 log.warning("Couldn't return memory because I don't know about that mem entry anymore...")
+            self.capacity_changed()
+
+    def reserve(self, memory, storage, uservmtype="", user="", cpu_slots=1):
+        """Check out a VM slot, storage and memory for a VM about to be
+        created on the cluster, until its create call finishes.
+        Returns the Reservation, or None if the cluster can't hold the VM.
+        """
+        with self.res_lock:
+            mementry = self._allocator().find(memory)
+            if mementry < 0:
+                return None
+            reservation = Reservation(self, memory, storage, mementry, uservmtype, user, cpu_slots)
+            try:
+                ICluster.resource_checkout(self, reservation)
+            except NoResourcesError, e:
+                log.verbose("Not enough %s left on %s to reserve for a VM" % (e.resource, self.name))
+                return None
+            self.reservations.append(reservation)
+            return reservation
+
+    def release(self, reservation):
+        """Return the resources of reservation to the cluster, unless a VM
+        took them over already."""
+        with self.res_lock:
+            if reservation in self.reservations:
+                self.reservations.remove(reservation)
+                ICluster.resource_return(self, reservation)
+
+    @contextmanager
+    def holding(self, *reservations):
+        """Run a create call for the VMs reservations were made for. Within
+        it, find_mementry and resource_checkout on this thread hand the
+        reserved resources over to the new VMs, one reservation each.
+        Whatever wasn't taken over is released at the end."""
+        _held.reservations = reservations
+        try:
+            yield reservations
+        finally:
+            _held.reservations = ()
+            for reservation in reservations:
+                self.release(reservation)
+
+    def _held_reservation(self, memory, mementry=None):
+        """The first reservation on this cluster held by the current thread
+        and not taken over yet which covers memory, on mementry if given."""
+        for reservation in getattr(_held, 'reservations', ()):
+            if reservation.cluster is self and memory <= reservation.memory and \
+               (mementry == None or reservation.mementry == mementry) and \
+               reservation in self.reservations:
+                return reservation
+        return None
+
+    def capacity_changed(self):
+        """Tell the fit index, if any, that the free resources of the cluster changed."""
+        if self.fit_index:
+            self.fit_index.update(self)
 
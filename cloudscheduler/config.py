@@ -65,6 +65,26 @@ clean_shutdown_idle = False
 getclouds = False
 scheduling_metric = "slot"
 scheduling_algorithm = "fairshare"
+placement_policy = "balanced"
+reservation_wait = -1
+job_per_core_packing = False
+forecast_window = -1
+forecast_max_prelaunch = 5
+warm_pool_size = 0
+warm_pool_hold_time = 10 * 60 # 10 minutes default
+warm_pool_budget = -1
+memory_allocation = "firstfit"
+cloud_driver_modules = []
+cloud_rank_fill_weight = 1.0
+cloud_rank_boot_weight = 0.0
+cloud_rank_failure_weight = 0.0
+vm_create_threads = 10
+vm_create_threads_per_cloud = 2
+connection_lifetime = 3600
+vm_poll_intervals = {"Starting": 120, "Unpropagated": 120, "Running": 900}
+vm_poll_jitter = 0.1
+vm_poll_budget = -1
+userdata_cache_ttl = 300
 job_distribution_type = "normal"
 high_priority_job_support = False
 high_priority_job_weight = 1
@@ -86,12 +106,17 @@ vm_start_running_timeout = -1 # Unlimited time
 vm_idle_threshold = 5 * 60 # 5 minute default
 max_starting_vm = -1
 max_destroy_threads = 10
+destroy_threads_per_cloud = 3
+destroy_retries = 3
+destroy_retry_backoff = 30
 myproxy_logon_command = 'myproxy-logon'
 proxy_cache_dir = None
 override_vmtype = False
 vm_reqs_from_condor_reqs = False
 adjust_insufficient_resources = False
 connection_fail_disable_time = 60 * 60 * 2 # 2 hour default
+profile_history = 100
+slow_cycle_threshold = 30
 
 default_VMType= "default"
 default_VMNetwork= ""
@@ -174,6 +199,26 @@ def setup(path=None):
     global getclouds
     global scheduling_metric
     global scheduling_algorithm
+    global placement_policy
+    global reservation_wait
+    global job_per_core_packing
+    global forecast_window
+    global forecast_max_prelaunch
+    global warm_pool_size
+    global warm_pool_hold_time
+    global warm_pool_budget
+    global memory_allocation
+    global cloud_driver_modules
+    global cloud_rank_fill_weight
+    global cloud_rank_boot_weight
+    global cloud_rank_failure_weight
+    global vm_create_threads
+    global vm_create_threads_per_cloud
+    global connection_lifetime
+    global vm_poll_intervals
+    global vm_poll_jitter
+    global vm_poll_budget
+    global userdata_cache_ttl
     global job_distribution_type
     global high_priority_job_support
     global high_priority_job_weight
@@ -194,11 +239,17 @@ def setup(path=None):
     global vm_start_running_timeout
     global vm_idle_threshold
     global max_starting_vm
+    global max_destroy_threads
+    global destroy_threads_per_cloud
+    global destroy_retries
+    global destroy_retry_backoff
     global proxy_cache_dir
     global myproxy_logon_command
     global override_vmtype
     global vm_reqs_from_condor_reqs
     global adjust_insufficient_resources
+    global profile_history
+    global slow_cycle_threshold
 
     global default_VMType
     global default_VMNetwork
@@ -532,6 +583,158 @@ def setup(path=None):
     if config_file.has_option("global", "scheduling_algorithm"):
         scheduling_algorithm = config_file.get("global", "scheduling_algorithm")
 
+    if config_file.has_option("global", "placement_policy"):
+        placement_policy = config_file.get("global", "placement_policy")
+
+    if config_file.has_option("global", "reservation_wait"):
+        try:
+            reservation_wait = config_file.getint("global", "reservation_wait")
+        except ValueError:
+            print "Configuration file problem: reservation_wait must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "job_per_core_packing"):
+        try:
+            job_per_core_packing = config_file.getboolean("global", "job_per_core_packing")
+        except ValueError:
+            print "Configuration file problem: job_per_core_packing must be a " \
+                  "boolean value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "forecast_window"):
+        try:
+            forecast_window = config_file.getint("global", "forecast_window")
+        except ValueError:
+            print "Configuration file problem: forecast_window must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "forecast_max_prelaunch"):
+        try:
+            forecast_max_prelaunch = config_file.getint("global", "forecast_max_prelaunch")
+        except ValueError:
+            print "Configuration file problem: forecast_max_prelaunch must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "warm_pool_size"):
+        try:
+            warm_pool_size = config_file.getint("global", "warm_pool_size")
+        except ValueError:
+            print "Configuration file problem: warm_pool_size must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "warm_pool_hold_time"):
+        try:
+            warm_pool_hold_time = config_file.getint("global", "warm_pool_hold_time")
+        except ValueError:
+            print "Configuration file problem: warm_pool_hold_time must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "warm_pool_budget"):
+        try:
+            warm_pool_budget = config_file.getint("global", "warm_pool_budget")
+        except ValueError:
+            print "Configuration file problem: warm_pool_budget must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "memory_allocation"):
+        memory_allocation = config_file.get("global", "memory_allocation")
+
+    if config_file.has_option("global", "cloud_driver_modules"):
+        cloud_driver_modules = utilities.splitnstrip(",", config_file.get("global", "cloud_driver_modules"))
+
+    if config_file.has_option("global", "cloud_rank_fill_weight"):
+        try:
+            cloud_rank_fill_weight = config_file.getfloat("global", "cloud_rank_fill_weight")
+        except ValueError:
+            print "Configuration file problem: cloud_rank_fill_weight must be a " \
+                  "float value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "cloud_rank_boot_weight"):
+        try:
+            cloud_rank_boot_weight = config_file.getfloat("global", "cloud_rank_boot_weight")
+        except ValueError:
+            print "Configuration file problem: cloud_rank_boot_weight must be a " \
+                  "float value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "cloud_rank_failure_weight"):
+        try:
+            cloud_rank_failure_weight = config_file.getfloat("global", "cloud_rank_failure_weight")
+        except ValueError:
+            print "Configuration file problem: cloud_rank_failure_weight must be a " \
+                  "float value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "vm_create_threads"):
+        try:
+            vm_create_threads = config_file.getint("global", "vm_create_threads")
+            if vm_create_threads <= 0:
+                vm_create_threads = 1
+        except ValueError:
+            print "Configuration file problem: vm_create_threads must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "vm_create_threads_per_cloud"):
+        try:
+            vm_create_threads_per_cloud = config_file.getint("global", "vm_create_threads_per_cloud")
+            if vm_create_threads_per_cloud <= 0:
+                vm_create_threads_per_cloud = 1
+        except ValueError:
+            print "Configuration file problem: vm_create_threads_per_cloud must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "connection_lifetime"):
+        try:
+            connection_lifetime = config_file.getint("global", "connection_lifetime")
+        except ValueError:
+            print "Configuration file problem: connection_lifetime must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "vm_poll_intervals"):
+        try:
+            vm_poll_intervals = {}
+            for entry in utilities.splitnstrip(",", config_file.get("global", "vm_poll_intervals")):
+                (state, interval) = utilities.splitnstrip(":", entry)
+                vm_poll_intervals[state] = int(interval)
+        except ValueError:
+            print "Configuration file problem: vm_poll_intervals must be a list " \
+                  "of state:seconds pairs with integer seconds."
+            sys.exit(1)
+
+    if config_file.has_option("global", "vm_poll_jitter"):
+        try:
+            vm_poll_jitter = config_file.getfloat("global", "vm_poll_jitter")
+        except ValueError:
+            print "Configuration file problem: vm_poll_jitter must be a " \
+                  "float value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "vm_poll_budget"):
+        try:
+            vm_poll_budget = config_file.getint("global", "vm_poll_budget")
+        except ValueError:
+            print "Configuration file problem: vm_poll_budget must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "userdata_cache_ttl"):
+        try:
+            userdata_cache_ttl = config_file.getint("global", "userdata_cache_ttl")
+        except ValueError:
+            print "Configuration file problem: userdata_cache_ttl must be an " \
+                  "integer value."
+            sys.exit(1)
+
     if config_file.has_option("global", "high_priority_job_support"):
         try:
             high_priority_job_support = config_file.getboolean("global", "high_priority_job_support")
@@ -672,6 +875,32 @@ def setup(path=None):
                   "integer value."
             sys.exit(1)
 
+    if config_file.has_option("global", "destroy_threads_per_cloud"):
+        try:
+            destroy_threads_per_cloud = config_file.getint("global", "destroy_threads_per_cloud")
+            if destroy_threads_per_cloud <= 0:
+                destroy_threads_per_cloud = 1
+        except ValueError:
+            print "Configuration file problem: destroy_threads_per_cloud must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "destroy_retries"):
+        try:
+            destroy_retries = config_file.getint("global", "destroy_retries")
+        except ValueError:
+            print "Configuration file problem: destroy_retries must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "destroy_retry_backoff"):
+        try:
+            destroy_retry_backoff = config_file.getint("global", "destroy_retry_backoff")
+        except ValueError:
+            print "Configuration file problem: destroy_retry_backoff must be an " \
+                  "integer value."
+            sys.exit(1)
+
     if config_file.has_option("global", "proxy_cache_dir"):
         proxy_cache_dir = config_file.get("global", "proxy_cache_dir")
 
@@ -707,6 +936,24 @@ def setup(path=None):
                   "integer value."
             sys.exit(1)
 
+    if config_file.has_option("global", "profile_history"):
+        try:
+            profile_history = config_file.getint("global", "profile_history")
+            if profile_history <= 0:
+                profile_history = 1
+        except ValueError:
+            print "Configuration file problem: profile_history must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "slow_cycle_threshold"):
+        try:
+            slow_cycle_threshold = config_file.getint("global", "slow_cycle_threshold")
+        except ValueError:
+            print "Configuration file problem: slow_cycle_threshold must be an " \
+                  "integer value."
+            sys.exit(1)
+
 
 
     # Default Logging options
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## CLOUD API CONNECTIONS
+##
+## Keeps the authenticated API clients (boto connection, nova client,
+## libcloud driver...) of a cluster for reuse by the threads working with the
+## cluster, the VM poller, the scheduler's create threads and the destroy
+## threads, instead of connecting and authenticating for every call.
+##
+## The clients aren't safe to use from several threads at once, so each
+## thread gets its own: a thread's client is made by the cluster's _connect
+## method the first time the thread needs one, and made again once it is
+## older than connection_lifetime seconds (set it below the lifetime of the
+## cloud's auth tokens), or after a call from any thread failed with an error
+## the cluster's _auth_error method reports as an authentication problem.
+##
+from __future__ import with_statement
+
+import sys
+import time
+import threading
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+
+class ConnectionManager():
+    """The reused API clients of a cluster, one per thread, with counts and
+    timings of the connections made."""
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.lock = threading.Lock()
+        # The client of the calling thread, when it was made and the
+        # generation it was made in
+        self.local = threading.local()
+        # Bumped to drop the clients of every thread
+        self.generation = 0
+        self.gets = 0
+        self.connects = 0
+        self.connect_failures = 0
+        self.expired = 0
+        self.auth_failures = 0
+        self.connect_time = 0.0
+        self.max_connect_time = 0.0
+
+    def __getstate__(self):
+        """Override to work with pickle module."""
+        state = self.__dict__.copy()
+        del state['lock']
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        """Override to work with pickle module."""
+        state.pop('client', None)
+        state.pop('created', None)
+        state.setdefault('generation', 0)
+        self.__dict__ = state
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get(self):
+        """Returns the calling thread's client, connecting if it has none yet
+        or it expired. Returns None if a connection couldn't be made."""
+        local = self.local
+        with self.lock:
+            self.gets += 1
+            generation = self.generation
+            client = getattr(local, 'client', None)
+            if client != None and local.generation != generation:
+                client = None
+            elif client != None and config.connection_lifetime > 0 and \
+                 time.time() - local.created >= config.connection_lifetime:
+                log.verbose("Connection to %s expired, reconnecting" % self.cluster.name)
+                self.expired += 1
+                client = None
+        if client != None:
+            return client
+
+        # Connect outside the lock, other threads have their own clients
+        local.client = None
+        start = time.time()
+        try:
+            client = self.cluster._connect()
+        except:
+            log.exception("Problem connecting to %s" % self.cluster.name)
+            client = None
+        elapsed = time.time() - start
+        with self.lock:
+            self.connects += 1
+            self.connect_time += elapsed
+            self.max_connect_time = max(self.max_connect_time, elapsed)
+            if client == None:
+                self.connect_failures += 1
+                return None
+        local.client = client
+        local.created = time.time()
+        local.generation = generation
+        return client
+
+    def invalidate(self):
+        """Drop the clients of every thread, so that they connect again."""
+        with self.lock:
+            self.generation += 1
+
+    def failed(self, error=None):
+        """Tell the manager a call made with a client raised error (by
+        default the exception being handled). If it is an authentication
+        error, the clients of every thread are dropped to be made again on
+        next use."""
+        if error == None:
+            error = sys.exc_info()[1]
+        if error != None and self.cluster._auth_error(error):
+            log.debug("Authentication problem with %s, will reconnect: %s" % (self.cluster.name, error))
+            with self.lock:
+                self.auth_failures += 1
+                self.generation += 1
+
+    def get_stats(self):
+        """Returns (gets, connections made, failed connections, expired
+        clients, auth failures, average and max seconds to connect)."""
+        with self.lock:
+            average = self.connect_time / self.connects if self.connects else 0.0
+            return (self.gets, self.connects, self.connect_failures, self.expired,
+                    self.auth_failures, average, self.max_connect_time)
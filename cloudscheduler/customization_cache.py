@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## VM CUSTOMIZATION CACHE
+##
+## Keeps the files put on every VM (the cert, key, CA files and the admin's
+## userdata scripts) and the users' userdata fetched from URLs, so that
+## launching many VMs doesn't read and download the same payloads for each.
+##
+## Contents are stored once by their SHA-1 digest, whatever paths or URLs
+## they came from. A file is read again only when its modification time or
+## size changes; a URL is fetched again once its copy is older than
+## userdata_cache_ttl seconds, or, while fetching it fails, every
+## RETRY_INTERVAL seconds. Handing out the same string objects for the
+## same contents also keeps the userdata each cluster assembles from them
+## cheap to look up (see ICluster.vm_userdata).
+##
+from __future__ import with_statement
+
+import os
+import time
+import urllib2
+import hashlib
+import threading
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+
+class CustomizationCache():
+    """Content addressed cache of local files and fetched URLs."""
+
+    # Oldest copy of a URL kept to fall back on when fetching it fails
+    MAX_STALE = 86400
+    # Seconds the old copy of a URL is used after fetching it again failed,
+    # before trying again
+    RETRY_INTERVAL = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # digest -> content
+        self.blobs = {}
+        # path -> (modification time, size, digest)
+        self.files = {}
+        # url -> (time fetched, digest)
+        self.urls = {}
+        # url -> time fetching it may be tried again, after a failure
+        self.retry_after = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, content):
+        """Returns the digest of content and the copy of it kept. The lock
+        must be held."""
+        digest = hashlib.sha1(content).hexdigest()
+        return (digest, self.blobs.setdefault(digest, content))
+
+    def _prune(self):
+        """Drop the contents no file or URL refers to any more. The lock must
+        be held."""
+        used = set([entry[2] for entry in self.files.values()]) | set([entry[1] for entry in self.urls.values()])
+        for digest in self.blobs.keys():
+            if digest not in used:
+                del self.blobs[digest]
+
+    def read_file(self, path):
+        """Returns the contents of the local file path, read again only if it
+        changed. Raises the IOError or OSError of reading it, as open does."""
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.files.get(path)
+            if entry and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+                self.hits += 1
+                return self.blobs[entry[2]]
+        content = open(path).read()
+        with self.lock:
+            self.misses += 1
+            (digest, content) = self._store(content)
+            self.files[path] = (stat.st_mtime, stat.st_size, digest)
+            if entry and entry[2] != digest:
+                self._prune()
+        return content
+
+    def fetch_url(self, url, now=None):
+        """Returns the contents at url, fetched again once older than
+        userdata_cache_ttl seconds. If fetching it again fails the old copy
+        is returned, without trying again for RETRY_INTERVAL seconds; raises
+        the error if there is none."""
+        now = now if now != None else time.time()
+        with self.lock:
+            entry = self.urls.get(url)
+            if entry and (now - entry[0] < config.userdata_cache_ttl or now < self.retry_after.get(url, 0)):
+                self.hits += 1
+                return self.blobs[entry[1]]
+        try:
+            content = urllib2.urlopen(url).read()
+        except:
+            if not entry:
+                raise
+            log.warning("Couldn't fetch %s again, using the copy from %d seconds ago" % (url, now - entry[0]))
+            with self.lock:
+                self.retry_after[url] = now + self.RETRY_INTERVAL
+                return self.blobs[self.urls.get(url, entry)[1]]
+        with self.lock:
+            self.misses += 1
+            (digest, content) = self._store(content)
+            self.urls[url] = (now, digest)
+            self.retry_after.pop(url, None)
+            stale = [old for (old, (fetched, _)) in self.urls.items() if now - fetched > self.MAX_STALE]
+            for old in stale:
+                del self.urls[old]
+                self.retry_after.pop(old, None)
+            if stale or (entry and entry[1] != digest):
+                self._prune()
+        return content
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## VM DESTROY EXECUTOR
+##
+## Runs the VM destroys asked for by the VM poller, the cleanup thread and
+## cloud_admin on a bounded pool of worker threads, instead of a new thread
+## per VM, so that a storm of destroys can't start an unbounded number of
+## threads.
+##
+## At most max_destroy_threads destroys run at once, and at most
+## destroy_threads_per_cloud of them against any one cloud, the clouds taking
+## turns as in the VM creation executor. A VM is only queued once: asking
+## again to destroy a VM already queued, being destroyed or waiting for a
+## retry does nothing.
+##
+## A failed destroy is tried again up to destroy_retries times, after
+## destroy_retry_backoff seconds doubled on each retry and varied by up to
+## half, so the retries of VMs that failed together spread out. VMs that
+## still couldn't be destroyed are put on a dead letter list, shown by
+## 'cloud_status -z', and aren't queued again unless cloud_admin asks.
+##
+from __future__ import with_statement
+
+import time
+import heapq
+import random
+import threading
+from collections import defaultdict, deque
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+
+class DestroyTask():
+    """A VM to destroy, with its attempts so far."""
+
+    def __init__(self, cluster, vm, reason="", retries=0):
+        self.cluster = cluster
+        self.vm = vm
+        self.reason = reason
+        self.retries = retries
+        self.attempts = 0
+        self.result = None
+        self.error = ""
+        self.failed_time = None
+        self.finished = threading.Event()
+        # The VM object, as its id changes when a spot request is fulfilled
+        # and is empty for every spot VM until then
+        self.key = (cluster.name, id(vm))
+
+    def run(self):
+        """Try to destroy the VM once. Returns True if it was destroyed."""
+        self.attempts += 1
+        try:
+            self.result = self.cluster.vm_destroy(self.vm, reason=self.reason)
+            self.error = "" if self.result == 0 else "vm_destroy returned %s" % self.result
+        except Exception, e:
+            log.exception("Unexpected error destroying vm %s on %s" % (self.vm.id, self.cluster.name))
+            self.result = -1
+            self.error = str(e)
+        self.cluster.health.record_destroy(self.result == 0)
+        return self.result == 0
+
+    def wait(self, timeout=None):
+        """Wait until the VM is destroyed or given up on. Returns the result
+        of the last attempt, or None if it hasn't finished."""
+        self.finished.wait(timeout)
+        return self.result if self.finished.isSet() else None
+
+
+class VMDestroyExecutor():
+    """Bounded pool of destroy worker threads with per cloud limits,
+    retries and a dead letter list."""
+
+    # Most dead letters kept
+    MAX_DEAD_LETTERS = 1000
+
+    def __init__(self, max_workers=None, max_per_cloud=None):
+        self.max_workers = max(1, max_workers if max_workers != None else config.max_destroy_threads)
+        self.max_per_cloud = max(1, max_per_cloud if max_per_cloud != None else config.destroy_threads_per_cloud)
+        self.condition = threading.Condition()
+        # (cloud name, id of the vm) -> task, for every task queued, running or waiting to retry
+        self.pending = {}
+        self.queues = defaultdict(deque)
+        self.turns = deque()
+        self.running = defaultdict(int)
+        # (time of the retry, sequence number, task)
+        self.delayed = []
+        self.sequence = 0
+        # (cloud name, id of the vm) -> task given up on
+        self.dead = {}
+        self.destroyed = 0
+        self.retried = 0
+        self.workers = []
+        self.idle = 0
+        self.quit = False
+
+    def destroy(self, cluster, vm, reason="", retries=None, retry_dead=False):
+        """Queue vm of cluster to be destroyed, with up to retries (by default
+        destroy_retries) more attempts if it fails. Returns the DestroyTask,
+        or None if the VM is already pending or, unless retry_dead, was given
+        up on."""
+        task = DestroyTask(cluster, vm, reason, retries if retries != None else config.destroy_retries)
+        key = task.key
+        with self.condition:
+            if self.quit:
+                log.debug("Not destroying VM %s, the destroy executor is shut down" % vm.id)
+                return None
+            if key in self.pending:
+                log.verbose("Already destroying VM %s on %s" % (vm.id, cluster.name))
+                return None
+            if key in self.dead:
+                if not retry_dead:
+                    log.verbose("Not destroying VM %s on %s again, it is on the dead letter list" % (vm.id, cluster.name))
+                    return None
+                del self.dead[key]
+            self.pending[key] = task
+            self._queue(task)
+            if self.idle == 0 and len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, name="VMDestroy-%d" % len(self.workers))
+                worker.setDaemon(True)
+                self.workers.append(worker)
+                worker.start()
+            self.condition.notifyAll()
+        return task
+
+    def is_pending(self, cluster, vm, dead=True):
+        """True if vm is queued, being destroyed, waiting for a retry or, if
+        dead, on the dead letter list."""
+        key = (cluster.name, id(vm))
+        with self.condition:
+            return key in self.pending or (dead and key in self.dead)
+
+    def _queue(self, task):
+        """Put task in its cloud's queue. The condition must be held."""
+        cloud = task.cluster.name
+        self.queues[cloud].append(task)
+        if cloud not in self.turns:
+            self.turns.append(cloud)
+
+    def _next(self):
+        """Take the next task of a cloud under its limit, after queueing
+        the retries that are due, or None. The condition must be held."""
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            self._queue(heapq.heappop(self.delayed)[2])
+        for _ in range(len(self.turns)):
+            cloud = self.turns.popleft()
+            if self.running[cloud] >= self.max_per_cloud:
+                self.turns.append(cloud)
+                continue
+            queue = self.queues[cloud]
+            task = queue.popleft()
+            if queue:
+                self.turns.append(cloud)
+            else:
+                del self.queues[cloud]
+            self.running[cloud] += 1
+            return task
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                task = self._next()
+                while task == None:
+                    if self.quit and not self.queues:
+                        return
+                    self.idle += 1
+                    if self.delayed:
+                        self.condition.wait(max(0.01, self.delayed[0][0] - time.time()))
+                    else:
+                        self.condition.wait()
+                    self.idle -= 1
+                    task = self._next()
+            destroyed = False
+            try:
+                if task.attempts and task.vm not in task.cluster.vms:
+                    # Gone since the last attempt, destroyed some other way
+                    destroyed = True
+                else:
+                    destroyed = task.run()
+            except:
+                log.exception("Unexpected error destroying vm %s on %s" % (task.vm.id, task.cluster.name))
+            with self.condition:
+                cloud = task.cluster.name
+                self.running[cloud] -= 1
+                if not self.running[cloud]:
+                    del self.running[cloud]
+                try:
+                    self._finish(task, destroyed)
+                except:
+                    log.exception("Problem finishing the destroy of vm %s on %s" % (task.vm.id, cloud))
+                    self.pending.pop(task.key, None)
+                    task.finished.set()
+                self.condition.notifyAll()
+
+    def _finish(self, task, destroyed):
+        """Retire, retry or give up on task after an attempt. The condition
+        must be held."""
+        key = task.key
+        if destroyed:
+            self.destroyed += 1
+        elif task.attempts <= task.retries and not self.quit:
+            delay = config.destroy_retry_backoff * 2 ** (task.attempts - 1) * random.uniform(0.5, 1.5)
+            log.warning("Failed to destroy vm %s on %s (%s), trying again in %.0fs" %
+                        (task.vm.id, task.cluster.name, task.error, delay))
+            self.retried += 1
+            self.sequence += 1
+            heapq.heappush(self.delayed, (time.time() + delay, self.sequence, task))
+            return
+        else:
+            log.error("Failed to destroy vm %s on %s after %d attempts, leaving it: %s" %
+                      (task.vm.id, task.cluster.name, task.attempts, task.error))
+            task.failed_time = time.time()
+            if len(self.dead) >= self.MAX_DEAD_LETTERS:
+                oldest = min(self.dead.values(), key=lambda dead: dead.failed_time)
+                del self.dead[oldest.key]
+            self.dead[key] = task
+        del self.pending[key]
+        task.finished.set()
+
+    def in_flight(self, cloud=None):
+        """Number of VMs queued, being destroyed or waiting for a retry, on
+        cloud if given."""
+        with self.condition:
+            return len([key for key in self.pending if cloud == None or key[0] == cloud])
+
+    def get_dead_letters(self):
+        """Returns the tasks given up on, of the VMs still known, oldest first."""
+        with self.condition:
+            for (key, task) in self.dead.items():
+                if task.vm not in task.cluster.vms:
+                    del self.dead[key]
+            return sorted(self.dead.values(), key=lambda task: task.failed_time)
+
+    def get_destroy_info(self):
+        """Returns a formatted report of the destroys under way and the VMs
+        that couldn't be destroyed."""
+        dead = self.get_dead_letters()
+        with self.condition:
+            output = ["VM destroys: %d pending, %d waiting to retry, %d done, %d retries, %d given up on\n" %
+                      (len(self.pending), len(self.delayed), self.destroyed, self.retried, len(dead))]
+        if dead:
+            output.append("%-20s %-40s %8s %-20s %s\n" % ("Cloud", "VM ID", "Attempts", "Failed", "Last Error"))
+            for task in dead:
+                output.append("%-20s %-40s %8d %-20s %s\n" % (task.cluster.name, task.vm.id, task.attempts,
+                              time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(task.failed_time)), task.error))
+        return ''.join(output)
+
+    def shutdown(self, wait=True):
+        """Stop taking VMs and drop the retries waiting. The queued VMs are
+        still destroyed; if wait, returns once they have been."""
+        with self.condition:
+            self.quit = True
+            for (_, _, task) in self.delayed:
+                del self.pending[task.key]
+                task.finished.set()
+            self.delayed = []
+            self.condition.notifyAll()
+        if wait:
+            for worker in list(self.workers):
+                worker.join()
@@ -4,11 +4,12 @@ import time
 import string
 import shutil
 import logging
-import nimbus_xml
 import subprocess
 import cluster_tools
 import cloudscheduler.config as config
 import cloudscheduler.utilities as utilities
+from cloudscheduler.utilities import get_or_none
+from cloudscheduler.utilities import splitnstrip
 from cloudscheduler.job_management import _attr_list_to_dict
 log = utilities.get_cloudscheduler_logger()
 try:
@@ -23,6 +24,81 @@ from subprocess import Popen
 from urlparse import urlparse
 
 
+class SpotRequestTracker():
+    """
+    Snapshot of the spot instance requests of an EC2 cluster's VMs, fetched
+    with one describe call per poll (per POLL_BATCH requests), from which the
+    state of each spot VM is driven: open requests wait for an instance,
+    fulfilled ones give the VM its instance id, and requests whose status
+    says EC2 is taking the instance back mark the VM Interrupted.
+    """
+
+    # Most age, in seconds, of a snapshot reused instead of describing again
+    MAX_AGE = 30
+
+    # Request status codes meaning the instance is being or was taken back
+    INTERRUPTION_CODES = ("marked-for-termination", "marked-for-stop",
+                          "instance-terminated-by-price", "instance-terminated-no-capacity",
+                          "instance-terminated-capacity-oversubscribed",
+                          "instance-terminated-launch-group-constraint",
+                          "instance-stopped-by-price", "instance-stopped-no-capacity")
+    # Request states that will never start an instance
+    CLOSED_STATES = ("cancelled", "closed", "failed")
+
+    def __init__(self):
+        # spot id -> (state, status code, instance id)
+        self.requests = {}
+        self.fetched = 0
+        self.calls = 0
+
+    def __getstate__(self):
+        """Override to work with pickle module."""
+        state = self.__dict__.copy()
+        state['requests'] = {}
+        state['fetched'] = 0
+        return state
+
+    def refresh(self, connection, spot_ids, batch):
+        """Describe the requests spot_ids, batch ids per call, replacing the
+        snapshot."""
+        requests = {}
+        for start in range(0, len(spot_ids), batch):
+            self.calls += 1
+            for request in connection.get_all_spot_instance_requests(
+                    filters={'spot-instance-request-id': spot_ids[start:start + batch]}):
+                code = request.status.code if getattr(request, 'status', None) else None
+                requests[request.id] = (request.state, code, request.instance_id)
+        self.requests = requests
+        self.fetched = time.time()
+
+    def ensure(self, connection, spot_ids, batch):
+        """Refresh the snapshot unless it is recent and holds all of spot_ids."""
+        if time.time() - self.fetched > self.MAX_AGE or \
+           [spot_id for spot_id in spot_ids if spot_id not in self.requests]:
+            self.refresh(connection, spot_ids, batch)
+
+    def apply(self, vm):
+        """Bring spot VM vm up to date with its request in the snapshot.
+        Returns True if the VM has an instance to poll."""
+        if vm.spot_id not in self.requests:
+            log.debug("Spot request %s isn't known to EC2." % vm.spot_id)
+            return bool(vm.id)
+        (state, code, instance_id) = self.requests[vm.spot_id]
+        if code in self.INTERRUPTION_CODES and vm.override_status != "Interrupted":
+            log.info("Spot VM %s (%s) is being interrupted: %s" % (instance_id, vm.spot_id, code))
+            vm.override_status = "Interrupted"
+        if instance_id:
+            vm.id = str(instance_id)
+            return True
+        if state in self.CLOSED_STATES:
+            log.error("Spot request %s is %s (%s) without an instance, setting status to Error" % (vm.spot_id, state, code))
+            vm.status = "Error"
+            vm.last_state_change = int(time.time())
+        else:
+            log.debug("Spot request %s doesn't have a VM id yet (%s)." % (vm.spot_id, code))
+        return False
+
+
 class EC2Cluster(cluster_tools.ICluster):
 
     VM_STATES = {
@@ -34,12 +110,23 @@ class EC2Cluster(cluster_tools.ICluster):
     }
 
     ERROR = 1
+    # Most instance ids in a single describe call (the limit on filter values)
+    POLL_BATCH = 200
     DEFAULT_INSTANCE_TYPE = config.default_VMInstanceType if config.default_VMInstanceType else "m1.small"
     DEFAULT_INSTANCE_TYPE_LIST = _attr_list_to_dict(config.default_VMInstanceTypeList)
 
     def _get_connection(self):
         """
-            _get_connection - get a boto connection object to this cluster
+            _get_connection - get the boto connection object to this cluster,
+                              reused until it expires
+
+            returns a boto connection object, or none in the case of an error
+        """
+        return self.connections.get()
+
+    def _connect(self):
+        """
+            _connect - make a new boto connection object to this cluster
 
             returns a boto connection object, or none in the case of an error
         """
@@ -111,6 +198,11 @@ class EC2Cluster(cluster_tools.ICluster):
 
         return connection
 
+    def _auth_error(self, error):
+        """Returns True if error is EC2 rejecting the connection's credentials."""
+        return isinstance(error, boto.exception.BotoServerError) and \
+               (error.status == 401 or error.error_code in ("AuthFailure", "RequestExpired"))
+
     def __init__(self, name="Dummy Cluster", host="localhost", cloud_type="Dummy",
                  memory=[], max_vm_mem= -1, cpu_archs=[], networks=[], vm_slots=0,
                  cpu_cores=0, storage=0,
@@ -142,16 +234,160 @@ class EC2Cluster(cluster_tools.ICluster):
         self.vm_domain_name = vm_domain_name if vm_domain_name != None else ""
         self.reverse_dns_lookup = reverse_dns_lookup in ['True', 'true', 'TRUE']
         self.placement_zone = placement_zone
+        self.spot_tracker = SpotRequestTracker()
+
+    def __setstate__(self, state):
+        """Override to work with pickle module."""
+        cluster_tools.ICluster.__setstate__(self, state)
+        if 'spot_tracker' not in state:
+            self.spot_tracker = SpotRequestTracker()
+
+    def vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations):
+        args = cluster_tools.ICluster.vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations)
+        args.update({'vm_image':job.req_ami,
+                     'instance_type':job.instance_type,
+                     'maximum_price':job.maximum_price,
+                     'securitygroup':job.req_security_group,
+                     'key_name': job.key_name})
+        return args
+
+    def fits_image(self, ami, imageloc):
+        return ami != ""
+
+    def banned_image(self, ami, imageloc):
+        return ami
 
     def vm_create(self, vm_name, vm_type, vm_user, vm_networkassoc, vm_cpuarch,
                   vm_image, vm_mem, vm_cores, vm_storage, customization=None,
                   vm_keepalive=0, instance_type="", maximum_price=0,
                   job_per_core=False, securitygroup=[],key_name=""):
         """Attempt to boot a new VM on the cluster."""
-        #print vm_image
-        #print instance_type
-        #print securitygroup
         log.verbose("Trying to boot %s on %s" % (vm_type, self.network_address))
+        params = self._launch_params(vm_image, instance_type, securitygroup, key_name,
+                                     customization, vm_networkassoc)
+        if params == None:
+            return
+        (vm_ami, instance_type, key_name, user_data, addressing_type, sec_group) = params
+
+        spot_id = ""
+        try:
+            connection = self._get_connection()
+            image = self._find_image(connection, vm_ami)
+
+            if image:
+                if maximum_price is 0: # don't request a spot instance
+                    try:
+                        reservation = image.run(1,1, key_name=key_name,
+                                                addressing_type=addressing_type,
+                                                user_data=user_data,
+                                                placement=self.placement_zone,
+                                                security_groups=sec_group,
+                                                instance_type=instance_type)
+                        instance_id = reservation.instances[0].id
+                        log.debug("Booted VM %s" % instance_id)
+                    except:
+                        log.exception("There was a problem creating an EC2 instance...")
+                        self.connections.failed()
+                        return self.ERROR
+
+                else: # get a spot instance of no more than maximum_price
+                    try:
+                        price_in_dollars = str(float(maximum_price) / 100)
+                        reservation = connection.request_spot_instances(
+                                                  price_in_dollars,
+                                                  image.id,
+                                                  key_name=key_name,
+                                                  user_data=user_data,
+                                                  placement=self.placement_zone,
+                                                  addressing_type=addressing_type,
+                                                  security_groups=self.sec_group,
+                                                  instance_type=instance_type)
+                        spot_id = str(reservation[0].id)
+                        instance_id = ""
+                        log.debug("Reserved instance %s at no more than %s" % (spot_id, price_in_dollars))
+                    except AttributeError:
+                        log.exception("Your version of boto doesn't seem to support "\
+                                  "spot instances. You need at least 1.9")
+                        return self.ERROR
+                    except:
+                        log.exception("Problem creating an EC2 spot instance...")
+                        self.connections.failed()
+                        return self.ERROR
+
+
+            else:
+                log.error("Couldn't find image %s on %s" % (vm_image, self.name))
+                return self.ERROR
+
+        except:
+            log.exception("Problem creating EC2 instance on on %s" % self.name)
+            self.connections.failed()
+            return self.ERROR
+
+        return self._add_vm(instance_id, spot_id, vm_name, vm_type, vm_user, vm_networkassoc,
+                            vm_cpuarch, vm_image, vm_mem, vm_cores, vm_storage,
+                            vm_keepalive, job_per_core)
+
+    def vm_batch_key(self, args):
+        """On demand instances booting the same AMI with the same instance
+        type, security groups, key and user data can be started by a single
+        run_instances call. Spot requests are made one at a time."""
+        if args.get('maximum_price', 0):
+            return None
+        return (utilities.hashable(args.get('vm_image')), utilities.hashable(args.get('instance_type', "")),
+                tuple(args.get('securitygroup', [])), args.get('key_name', ""),
+                args.get('vm_networkassoc'), tuple(args.get('customization') or ()))
+
+    def vm_create_batch(self, args_list):
+        """Boot a VM for each of args_list, which share a vm_batch_key, with
+        a single run_instances call asking for len(args_list) instances, and
+        map the instances started back to the VM of each."""
+        if len(args_list) == 1:
+            return [self.vm_create(**args_list[0])]
+        first = args_list[0]
+        log.verbose("Trying to boot %d x %s on %s" % (len(args_list), first['vm_type'], self.network_address))
+        params = self._launch_params(first['vm_image'], first.get('instance_type', ""),
+                                     first.get('securitygroup', []), first.get('key_name', ""),
+                                     first.get('customization'), first['vm_networkassoc'])
+        if params == None:
+            return [None] * len(args_list)
+        (vm_ami, instance_type, key_name, user_data, addressing_type, sec_group) = params
+
+        try:
+            connection = self._get_connection()
+            image = self._find_image(connection, vm_ami)
+            if not image:
+                log.error("Couldn't find image %s on %s" % (first['vm_image'], self.name))
+                return [self.ERROR] * len(args_list)
+            reservation = image.run(1, len(args_list), key_name=key_name,
+                                    addressing_type=addressing_type,
+                                    user_data=user_data,
+                                    placement=self.placement_zone,
+                                    security_groups=sec_group,
+                                    instance_type=instance_type)
+            instance_ids = [instance.id for instance in reservation.instances]
+            log.debug("Booted VMs %s" % ", ".join(instance_ids))
+        except:
+            log.exception("There was a problem creating %d EC2 instances on %s" % (len(args_list), self.name))
+            self.connections.failed()
+            return [self.ERROR] * len(args_list)
+
+        if len(instance_ids) < len(args_list):
+            log.warning("Only %d of %d instances requested were started on %s" %
+                        (len(instance_ids), len(args_list), self.name))
+        results = []
+        for (i, args) in enumerate(args_list):
+            if i < len(instance_ids):
+                results.append(self._add_vm(instance_ids[i], "", **args))
+            else:
+                results.append(self.ERROR)
+        return results
+
+    def _launch_params(self, vm_image, instance_type, securitygroup, key_name,
+                       customization, vm_networkassoc):
+        """Work out what to ask EC2 for to boot a VM. Returns (ami, instance
+        type, key name, user data, addressing type, security groups), or None
+        if there is no AMI for this cluster."""
         if len(securitygroup) != 0:
             sec_group = []
             for group in securitygroup:
@@ -186,7 +422,7 @@ class EC2Cluster(cluster_tools.ICluster):
                     vm_ami = vm_default_ami["default"]
                 except:
                     log.exception("Can't find a suitable AMI")
-                    return
+                    return None
 
         try:
             if self.name in instance_type.keys():
@@ -209,11 +445,10 @@ class EC2Cluster(cluster_tools.ICluster):
             except:
                 log.debug("No default instance type found for %s, trying single default" % self.network_address)
                 i_type = self.DEFAULT_INSTANCE_TYPE
-        instance_type = i_type
         if key_name == None:
             key_name = self.key_name
         if customization:
-            user_data = nimbus_xml.ws_optional(customization)
+            user_data = self.vm_userdata(customization)
         else:
             user_data = ""
 
@@ -222,72 +457,30 @@ class EC2Cluster(cluster_tools.ICluster):
             addressing_type = "public"
         else:
             addressing_type = vm_networkassoc
-
-        try:
-            connection = self._get_connection()
-            image = None
-
-            if not "Eucalyptus" == self.cloud_type:
-                image = connection.get_image(vm_ami)
-
-            else: #HACK: for some reason Eucalyptus won't respond properly to
-                  #      get_image("whateverimg"). Use a linear search until
-                  #      this is fixed
-                  # This is Eucalyptus bug #495670
-                  # https://bugs.launchpad.net/eucalyptus/+bug/495670
-                images = connection.get_all_images()
-                for potential_match in images:
-                    if potential_match.id == vm_ami:
-                        image = potential_match
-                        break
-
-            if image:
-                if maximum_price is 0: # don't request a spot instance
-                    try:
-                        reservation = image.run(1,1, key_name=key_name,
-                                                addressing_type=addressing_type,
-                                                user_data=user_data,
-                                                placement=self.placement_zone,
-                                                security_groups=sec_group,
-                                                instance_type=instance_type)
-                        instance_id = reservation.instances[0].id
-                        log.debug("Booted VM %s" % instance_id)
-                    except:
-                        log.exception("There was a problem creating an EC2 instance...")
-                        return self.ERROR
-
-                else: # get a spot instance of no more than maximum_price
-                    try:
-                        price_in_dollars = str(float(maximum_price) / 100)
-                        reservation = connection.request_spot_instances(
-                                                  price_in_dollars,
-                                                  image.id,
-                                                  key_name=key_name,
-                                                  user_data=user_data,
-                                                  placement=self.placement_zone,
-                                                  addressing_type=addressing_type,
-                                                  security_groups=self.sec_group,
-                                                  instance_type=instance_type)
-                        spot_id = str(reservation[0].id)
-                        instance_id = ""
-                        log.debug("Reserved instance %s at no more than %s" % (spot_id, price_in_dollars))
-                    except AttributeError:
-                        log.exception("Your version of boto doesn't seem to support "\
-                                  "spot instances. You need at least 1.9")
-                        return self.ERROR
-                    except:
-                        log.exception("Problem creating an EC2 spot instance...")
-                        return self.ERROR
-
-
-            else:
-                log.error("Couldn't find image %s on %s" % (vm_image, self.name))
-                return self.ERROR
-
-        except:
-            log.exception("Problem creating EC2 instance on on %s" % self.name)
-            return self.ERROR
-
+        return (vm_ami, i_type, key_name, user_data, addressing_type, sec_group)
+
+    def _find_image(self, connection, vm_ami):
+        """Returns the boto image of vm_ami, or None if it isn't found."""
+        if not "Eucalyptus" == self.cloud_type:
+            return connection.get_image(vm_ami)
+
+        #HACK: for some reason Eucalyptus won't respond properly to
+        #      get_image("whateverimg"). Use a linear search until
+        #      this is fixed
+        # This is Eucalyptus bug #495670
+        # https://bugs.launchpad.net/eucalyptus/+bug/495670
+        images = connection.get_all_images()
+        for potential_match in images:
+            if potential_match.id == vm_ami:
+                return potential_match
+        return None
+
+    def _add_vm(self, instance_id, spot_id, vm_name, vm_type, vm_user, vm_networkassoc,
+                vm_cpuarch, vm_image, vm_mem, vm_cores, vm_storage, vm_keepalive=0,
+                job_per_core=False, **unused):
+        """Record the VM booted as instance_id (or spot request spot_id) and
+        check its resources out of the cluster. Returns the vm_create
+        return code."""
         vm_mementry = self.find_mementry(vm_mem)
         if (vm_mementry < 0):
             #TODO: this is kind of pointless with EC2...
@@ -302,12 +495,8 @@ class EC2Cluster(cluster_tools.ICluster):
                     cpuarch = vm_cpuarch, image= vm_image,
                     memory = vm_mem, mementry = vm_mementry,
                     cpucores = vm_cores, storage = vm_storage, 
-                    keep_alive = vm_keepalive, job_per_core = job_per_core)
-
-        try:
-            new_vm.spot_id = spot_id
-        except:
-            log.verbose("No spot ID to add to VM %s" % instance_id)
+                    keep_alive = vm_keepalive, job_per_core = job_per_core,
+                    spot_id = spot_id)
 
         try:
             self.resource_checkout(new_vm)
@@ -329,16 +518,15 @@ class EC2Cluster(cluster_tools.ICluster):
 
             if vm.spot_id:
                 try:
-                    spot_reservation = connection.get_all_spot_instance_requests(vm.spot_id)[0]
-                    if spot_reservation.instance_id == None:
-                        log.debug("Spot reservation %s doesn't have a VM id yet." % vm.spot_id)
-                        return vm.status
-                    vm.id = str(spot_reservation.instance_id)
+                    self.spot_tracker.ensure(connection, [vm.spot_id], self.POLL_BATCH)
                 except AttributeError:
                     log.exception("Problem getting spot VM info. Do you have boto 2.0+?")
                     return vm.status
                 except:
                     log.exception("Problem getting information for spot vm %s" % vm.spot_id)
+                    self.connections.failed()
+                    return vm.status
+                if not self.spot_tracker.apply(vm):
                     return vm.status
 
             instance = None
@@ -352,14 +540,109 @@ class EC2Cluster(cluster_tools.ICluster):
                 return vm.status
             except Exception, e:
                 log.exception("Unexpected error polling %s: %s" % (vm.id, e))
+                self.connections.failed(e)
                 if e.status == 400 and e.error_code == 'InstanceNotFound':
                     vm.status = self.VM_STATES['error']
                 return vm.status
 
         except boto.exception.EC2ResponseError, e:
             log.error("Couldn't update status because: %s" % e.error_message)
+            self.connections.failed(e)
             return vm.status
 
+        return self._update_vm(vm, instance)
+
+    def vm_poll_all(self, vms):
+        """Query the cloud service for all of the VMs in vms at once: one
+        describe call for the spot requests and one for the instances, paged
+        by POLL_BATCH ids. Returns the new status of each VM, in order."""
+        try:
+            log.verbose("Polling %d vms on %s" % (len(vms), self.name))
+            connection = self._get_connection()
+
+            spot_ids = [vm.spot_id for vm in vms if vm.spot_id]
+            if spot_ids:
+                try:
+                    self.spot_tracker.ensure(connection, spot_ids, self.POLL_BATCH)
+                except AttributeError:
+                    log.exception("Problem getting spot VM info. Do you have boto 2.0+?")
+                except:
+                    log.exception("Problem getting information for spot vms on %s" % self.name)
+                    self.connections.failed()
+
+            waiting = [vm for vm in vms if vm.spot_id and not self.spot_tracker.apply(vm)]
+            instance_ids = [vm.id for vm in vms if vm not in waiting]
+            instances = self._describe_instances(connection, instance_ids)
+
+        except boto.exception.EC2ResponseError, e:
+            log.error("Couldn't update status because: %s" % e.error_message)
+            self.connections.failed(e)
+            return [vm.status for vm in vms]
+        except:
+            log.exception("Unexpected error polling vms on %s" % self.name)
+            self.connections.failed()
+            return [vm.status for vm in vms]
+
+        states = []
+        for vm in vms:
+            if vm in waiting:
+                states.append(vm.status)
+            elif vm.id not in instances:
+                log.error("%s on %s doesn't seem to exist anymore, setting status to Error" % (vm.id, self.network_address))
+                with self.vms_lock:
+                    vm.status = self.VM_STATES['error']
+                    vm.last_state_change = int(time.time())
+                states.append(vm.status)
+            else:
+                states.append(self._update_vm(vm, instances[vm.id]))
+        return states
+
+    def vm_poll_interruptions(self):
+        """Describe the spot requests of all the cluster's spot VMs in one
+        call, whatever their poll schedule, and return the VMs EC2 started
+        taking back since the last call."""
+        spot_vms = [vm for vm in self.vms if vm.spot_id]
+        if not spot_vms:
+            return []
+        try:
+            self.spot_tracker.refresh(self._get_connection(), [vm.spot_id for vm in spot_vms], self.POLL_BATCH)
+        except:
+            log.exception("Problem getting information for spot vms on %s" % self.name)
+            self.connections.failed()
+            return []
+        interrupted = []
+        for vm in spot_vms:
+            was_interrupted = vm.override_status == "Interrupted"
+            with self.vms_lock:
+                self.spot_tracker.apply(vm)
+            if vm.override_status == "Interrupted" and not was_interrupted:
+                interrupted.append(vm)
+        return interrupted
+
+    def _describe_instances(self, connection, instance_ids):
+        """Returns a dict of instance id to boto instance for those of
+        instance_ids that exist. Filtering on the ids, rather than asking for
+        them, leaves out the missing instances instead of failing the call."""
+        instances = {}
+        for start in range(0, len(instance_ids), self.POLL_BATCH):
+            batch = instance_ids[start:start + self.POLL_BATCH]
+            next_token = None
+            while True:
+                if next_token:
+                    reservations = connection.get_all_instances(filters={'instance-id': batch},
+                                                                next_token=next_token)
+                else:
+                    reservations = connection.get_all_instances(filters={'instance-id': batch})
+                for reservation in reservations:
+                    for instance in reservation.instances:
+                        instances[instance.id] = instance
+                next_token = getattr(reservations, 'next_token', None)
+                if not next_token:
+                    break
+        return instances
+
+    def _update_vm(self, vm, instance):
+        """Update vm from the boto instance describing it, returning its status."""
         with self.vms_lock:
             if vm.status != self.VM_STATES.get(instance.state, "Starting"):
 
@@ -406,6 +689,7 @@ class EC2Cluster(cluster_tools.ICluster):
         except boto.exception.EC2ResponseError, e:
             returnError = True
             log.exception("Couldn't connect to cloud to destroy VM: %s !" % vm.id)
+            self.connections.failed(e)
             if e.status == 400 and e.error_code == 'InstanceNotFound':
                 log.exception("VM %s no longer exists... removing from system")
                 returnError = False
@@ -422,6 +706,56 @@ class EC2Cluster(cluster_tools.ICluster):
 
         return 0
 
+    def vm_destroy_batch(self, vms, return_resources=True, reason=""):
+        """
+        Shutdown, destroy and return resources of a list of VMs of the
+        cluster, with one call cancelling their spot requests and one
+        terminate call per POLL_BATCH instances. Falls back to destroying
+        them one at a time if a batch is refused, and leaves them all, in
+        error, if it fails some other way.
+
+        Returns the vm_destroy return code of each VM, in order.
+        """
+        if len(vms) == 1:
+            return [self.vm_destroy(vms[0], return_resources, reason)]
+        log.info("Destroying %d VMs on %s: %s Reason: %s" % (len(vms), self.name,
+                 ", ".join([vm.id or vm.spot_id for vm in vms]), reason))
+
+        try:
+            connection = self._get_connection()
+
+            spot_ids = [vm.spot_id for vm in vms if vm.spot_id]
+            if spot_ids:
+                connection.cancel_spot_instance_requests(spot_ids)
+
+            instance_ids = [vm.id for vm in vms if vm.id]
+            for start in range(0, len(instance_ids), self.POLL_BATCH):
+                connection.terminate_instances(instance_ids=instance_ids[start:start + self.POLL_BATCH])
+
+        except boto.exception.EC2ResponseError, e:
+            log.warning("Couldn't destroy VMs on %s together, destroying them one at a time: %s" %
+                        (self.name, e.error_message))
+            self.connections.failed(e)
+            return [self.vm_destroy(vm, return_resources, reason) for vm in vms]
+        except:
+            # Some may not have been terminated: keep them all to be
+            # destroyed again rather than lose track of running instances
+            log.exception("Unexpected error destroying VMs on %s, leaving them for now" % self.name)
+            self.connections.failed()
+            return [self.ERROR] * len(vms)
+
+        # Delete references to these VMs, unless destroyed meanwhile
+        for vm in vms:
+            with self.vms_lock:
+                if vm not in self.vms:
+                    log.verbose("VM %s was already removed from %s" % (vm.id, self.name))
+                    continue
+                self.vms.remove(vm)
+            if return_resources:
+                self.resource_return(vm)
+
+        return [0] * len(vms)
+
     def _extract_host_from_dig(self, dig_out):
         at_answer_line = False
         hostname = ""
@@ -470,3 +804,33 @@ class EC2Cluster(cluster_tools.ICluster):
             except:
                 log.error("Problem running command, unexpected error.")
             return (-1, "", "")
+
+
+def _cluster_from_config(cloud_config, section, common):
+    """Build an EC2Cluster from its section of the cloud resources config."""
+    return EC2Cluster(name = section,
+            host = get_or_none(cloud_config, section, "host"),
+            cloud_type = get_or_none(cloud_config, section, "cloud_type"),
+            memory = map(int, splitnstrip(",", get_or_none(cloud_config, section, "memory"))),
+            max_vm_mem = common['max_vm_mem'],
+            cpu_archs = splitnstrip(",", get_or_none(cloud_config, section, "cpu_archs")),
+            networks = splitnstrip(",", get_or_none(cloud_config, section, "networks")),
+            vm_slots = int(get_or_none(cloud_config, section, "vm_slots")),
+            cpu_cores = int(get_or_none(cloud_config, section, "cpu_cores")),
+            storage = int(get_or_none(cloud_config, section, "storage")),
+            access_key_id = get_or_none(cloud_config, section, "access_key_id"),
+            secret_access_key = get_or_none(cloud_config, section, "secret_access_key"),
+            security_group = splitnstrip(",", get_or_none(cloud_config, section, "security_group")),
+            hypervisor = common['hypervisor'],
+            key_name = get_or_none(cloud_config, section, "key_name"),
+            boot_timeout = get_or_none(cloud_config, section, "boot_timeout"),
+            secure_connection = get_or_none(cloud_config, section, "secure_connection"),
+            regions = map(str, splitnstrip(",", get_or_none(cloud_config, section, "regions"))),
+            vm_domain_name = get_or_none(cloud_config, section, "vm_domain_name"),
+            reverse_dns_lookup = get_or_none(cloud_config, section, "reverse_dns_lookup"),
+            placement_zone = get_or_none(cloud_config, section, "placement_zone"),
+            )
+
+cluster_tools.register_cloud_type("AmazonEC2", _cluster_from_config)
+cluster_tools.register_cloud_type("Eucalyptus", _cluster_from_config)
+cluster_tools.register_cloud_type("OpenStack", _cluster_from_config)
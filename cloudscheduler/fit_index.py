@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## RESOURCE FIT INDEX
+##
+## Answers "which clusters fit this VM" for ResourcePool.get_fitting_resources
+## without walking every cluster through the chain of checks.
+##
+## Each cluster is given a bit. The checks that only depend on the cluster
+## configuration are precomputed as bitmasks: cpu_cores and max_vm_mem as
+## sorted thresholds so a bisect gives the mask of clusters allowing a value,
+## and the driver specific ICluster.fits_image and fits_vm once per distinct
+## set of requirements, kept until the clusters are reconfigured. The
+## remaining capacity of each cluster (slots, storage and largest free memory
+## entry) is kept in vectors updated whenever the cluster checks resources in
+## or out, and is only compared, along with ICluster.fits_capacity, for the
+## clusters left after the masks are applied. Results are memoized until the
+## capacity of any cluster changes.
+##
+from __future__ import with_statement
+
+import threading
+from bisect import bisect_left
+
+import cloudscheduler.utilities as utilities
+from cloudscheduler.utilities import hashable
+
+log = utilities.get_cloudscheduler_logger()
+
+UNLIMITED = float('inf')
+
+
+class ThresholdMask():
+    """Bitmask of the clusters whose limit is at least a given value."""
+    def __init__(self, limits):
+        """limits - list of (limit, bit) pairs"""
+        limits = sorted(limits)
+        self.values = [limit for (limit, bit) in limits]
+        # suffix[k] is the mask of the clusters with the k-th smallest limit or larger
+        self.suffix = [0] * (len(limits) + 1)
+        for k in range(len(limits) - 1, -1, -1):
+            self.suffix[k] = self.suffix[k + 1] | limits[k][1]
+
+    def at_least(self, value):
+        return self.suffix[bisect_left(self.values, value)]
+
+
+class FitIndex():
+    """Bitmask and capacity vector index of a list of clusters."""
+
+    # Number of requirement signatures memoized between capacity changes
+    MAX_CACHED = 5000
+
+    def __init__(self, clusters=[]):
+        self.lock = threading.RLock()
+        self.rebuild(clusters)
+
+    def rebuild(self, clusters):
+        """Recompute the masks from the configuration of clusters. Must be
+        called whenever the list of clusters or their configuration changes."""
+        with self.lock:
+            self.clusters = list(clusters)
+            self.bits = {}
+            self.name_bits = {}
+            cpu_cores = []
+            max_vm_mem = []
+            for (i, cluster) in enumerate(self.clusters):
+                bit = 1 << i
+                self.bits[id(cluster)] = i
+                self.name_bits[cluster.name] = self.name_bits.get(cluster.name, 0) | bit
+                cpu_cores.append((cluster.cpu_cores, bit))
+                max_vm_mem.append((cluster.max_vm_mem if cluster.max_vm_mem != -1 else UNLIMITED, bit))
+            self.cpu_cores = ThresholdMask(cpu_cores)
+            self.max_vm_mem = ThresholdMask(max_vm_mem)
+            self.driver_masks = {}
+
+            n = len(self.clusters)
+            self.slots_mask = 0
+            self.storage = [0] * n
+            self.free_memory = [-1] * n
+            self.cache = {}
+            for cluster in self.clusters:
+                cluster.fit_index = self
+        # Outside the lock: update takes the cluster's res_lock first, as the
+        # resource checkouts and returns calling it do
+        for cluster in self.clusters:
+            self.update(cluster)
+
+    def update(self, cluster):
+        """Refresh the capacity vectors of cluster after its resources changed.
+        Takes cluster.res_lock before the index's lock, never the other way."""
+        with cluster.res_lock:
+            slots = cluster.vm_slots
+            storage = cluster.storageGB
+            free_memory = max(cluster.memory) if cluster.memory else -1
+            with self.lock:
+                i = self.bits.get(id(cluster))
+                if i == None:
+                    return
+                if slots > 0:
+                    self.slots_mask |= 1 << i
+                else:
+                    self.slots_mask &= ~(1 << i)
+                self.storage[i] = storage
+                self.free_memory[i] = free_memory
+                self.cache = {}
+
+    def _driver_mask(self, network, storage, ami, imageloc, hypervisor):
+        """Mask of the clusters whose driver accepts the image and VM."""
+        key = (network, storage, hashable(ami), imageloc, tuple(hypervisor))
+        if key not in self.driver_masks:
+            if len(self.driver_masks) >= self.MAX_CACHED:
+                self.driver_masks = {}
+            mask = 0
+            for (i, cluster) in enumerate(self.clusters):
+                if cluster.fits_image(ami, imageloc) and cluster.fits_vm(network, storage, hypervisor):
+                    mask |= 1 << i
+            self.driver_masks[key] = mask
+        return self.driver_masks[key]
+
+    def fitting(self, network, memory, cpucores, storage, ami, imageloc, hypervisor,
+                targets=None, blocked=[]):
+        """Returns the clusters that fit the requirements, in cluster order or
+        in the order of targets if given. As get_fitting_resources, without
+        the enabled and banned checks which change without a capacity change
+        and are left to the caller."""
+        key = (network, memory, cpucores, storage, hashable(ami), imageloc, tuple(hypervisor),
+               tuple([id(c) for c in targets]) if targets != None else None, tuple(blocked))
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+            mask = self.slots_mask & self.cpu_cores.at_least(cpucores) & self.max_vm_mem.at_least(memory)
+            mask &= self._driver_mask(network, storage, ami, imageloc, hypervisor)
+
+            for name in blocked:
+                mask &= ~self.name_bits.get(name, 0)
+
+            if targets != None:
+                indexes = [self.bits[id(c)] for c in targets if id(c) in self.bits and mask & (1 << self.bits[id(c)])]
+            else:
+                indexes = []
+                while mask:
+                    low = mask & -mask
+                    indexes.append(low.bit_length() - 1)
+                    mask ^= low
+
+            fitting = []
+            for i in indexes:
+                if self.storage[i] < storage or self.free_memory[i] < memory:
+                    continue
+                if not self.clusters[i].fits_capacity(network, cpucores):
+                    continue
+                fitting.append(self.clusters[i])
+            if len(self.cache) >= self.MAX_CACHED:
+                self.cache = {}
+            self.cache[key] = fitting
+            return fitting
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## DEMAND FORECASTER
+##
+## Learns the rate at which jobs of each uservmtype arrive in the JobPool and
+## asks the Scheduler to boot a bounded number of VMs ahead of the expected
+## demand, so bursts of jobs do not each wait out a full VM boot and condor
+## registration.
+##
+## Time is divided into windows of forecast_window seconds. The number of
+## jobs of each type seen in a window is smoothed into a rate (an
+## exponentially weighted moving average), which is the prediction for the
+## next window. When a window closes its prediction is scored against the
+## jobs that actually arrived.
+##
+from __future__ import with_statement
+
+import math
+import time
+import threading
+from collections import defaultdict
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+
+class ForecastScore():
+    """Running totals of how well the predictions for a uservmtype matched."""
+    def __init__(self):
+        self.windows = 0
+        self.predicted = 0.0
+        self.actual = 0
+        self.abs_error = 0.0
+
+    def add(self, predicted, actual):
+        self.windows += 1
+        self.predicted += predicted
+        self.actual += actual
+        self.abs_error += abs(predicted - actual)
+
+    def mean_abs_error(self):
+        if self.windows == 0:
+            return 0.0
+        return self.abs_error / self.windows
+
+    def accuracy(self):
+        """1 - weighted absolute percentage error, 1.0 is a perfect forecast."""
+        total = max(self.actual, self.predicted)
+        if total == 0:
+            return 1.0
+        return max(0.0, 1.0 - self.abs_error / total)
+
+
+class DemandForecaster():
+    """Forecasts job arrivals per uservmtype and plans VM pre-launches."""
+
+    # Weight given to the newest window when updating the arrival rate
+    SMOOTHING = 0.3
+
+    def __init__(self, job_pool, resource_pool, window=None, max_prelaunch=None):
+        self.job_pool = job_pool
+        self.resource_pool = resource_pool
+        self.window = window if window != None else config.forecast_window
+        self.max_prelaunch = max_prelaunch if max_prelaunch != None else config.forecast_max_prelaunch
+        self.lock = threading.RLock()
+        self.window_start = time.time()
+        self.window_counts = defaultdict(int)
+        self.predictions = {}
+        self.rates = {}
+        self.prototypes = {}
+        self.scores = defaultdict(ForecastScore)
+        self.prelaunched = []
+
+    def enabled(self):
+        return self.window > 0
+
+    def update(self, now=None):
+        """Collect the arrivals seen by the JobPool and close the current
+        window, scoring its predictions, if it has ended."""
+        now = now if now != None else time.time()
+        (arrivals, prototypes) = self.job_pool.take_arrivals()
+        with self.lock:
+            for (uservmtype, count) in arrivals.iteritems():
+                self.window_counts[uservmtype] += count
+            self.prototypes.update(prototypes)
+            if now - self.window_start < self.window:
+                return
+            for uservmtype in set(self.predictions.keys()) | set(self.window_counts.keys()):
+                predicted = self.predictions.get(uservmtype, 0.0)
+                actual = self.window_counts.get(uservmtype, 0)
+                self.scores[uservmtype].add(predicted, actual)
+                self.rates[uservmtype] = self.SMOOTHING * actual + \
+                                         (1 - self.SMOOTHING) * self.rates.get(uservmtype, 0.0)
+                log.verbose("Forecast for %s: predicted %.1f jobs, %d arrived" % (uservmtype, predicted, actual))
+            for uservmtype in self.rates.keys():
+                if self.rates[uservmtype] < 0.01:
+                    del self.rates[uservmtype]
+                    self.prototypes.pop(uservmtype, None)
+            self.predictions = dict(self.rates)
+            self.window_counts = defaultdict(int)
+            self.window_start = now
+
+    def get_prelaunch_requests(self, now=None):
+        """Returns a list of (prototype job, number of VMs) to boot ahead of
+        the demand predicted for the next window.
+
+        The spare capacity of a type is its VM slots not taken by idle or
+        running jobs, plus the running jobs expected to finish within the
+        window given the average run time of the type. No more than
+        forecast_max_prelaunch VMs are pre-launched per window.
+        """
+        now = now if now != None else time.time()
+        with self.lock:
+            self.prelaunched = [t for t in self.prelaunched if now - t[0] < self.window]
+            budget = self.max_prelaunch - len(self.prelaunched)
+            if budget <= 0 or not self.predictions:
+                return []
+            slots = self.resource_pool.get_vmtypes_count_cpu_slots()
+            active = defaultdict(int)
+            running = defaultdict(int)
+            for job in self.job_pool.job_container.get_all_jobs():
+                if job.job_status <= self.job_pool.RUNNING:
+                    active[job.uservmtype] += 1
+                if job.job_status == self.job_pool.RUNNING:
+                    running[job.uservmtype] += 1
+
+            requests = []
+            for (uservmtype, expected) in sorted(self.predictions.items(), key=lambda x: x[1], reverse=True):
+                job = self.prototypes.get(uservmtype)
+                if not job or budget <= 0:
+                    continue
+                run_time = self.job_pool.get_type_run_time(uservmtype)
+                freed = 0.0
+                if run_time > 0:
+                    freed = running[uservmtype] * min(1.0, float(self.window) / run_time)
+                shortfall = expected - (slots.get(uservmtype, 0) - active[uservmtype] + freed)
+                if shortfall < 1:
+                    continue
+                per_vm = job.req_cpucores if job.job_per_core and job.req_cpucores > 0 else 1
+                count = min(int(math.ceil(shortfall / per_vm)), budget)
+                budget -= count
+                requests.append((job, count))
+            return requests
+
+    def record_prelaunch(self, uservmtype, now=None):
+        with self.lock:
+            self.prelaunched.append((now if now != None else time.time(), uservmtype))
+
+    def get_forecast_info(self):
+        """Returns a formatted report of the forecasts and their accuracy."""
+        with self.lock:
+            if not self.enabled():
+                return "Demand forecasting is disabled.\n"
+            output = ["Demand forecast, %d second windows, %d VMs pre-launched in the last window\n"
+                      % (self.window, len(self.prelaunched))]
+            output.append("%-40s %10s %8s %12s %12s %8s %9s\n" % ("UserVMType", "Predicted", "Windows",
+                          "Predicted", "Arrived", "MAE", "Accuracy"))
+            for uservmtype in sorted(set(self.predictions.keys()) | set(self.scores.keys())):
+                score = self.scores[uservmtype]
+                output.append("%-40s %10.1f %8d %12.1f %12d %8.2f %8.1f%%\n" % (uservmtype,
+                              self.predictions.get(uservmtype, 0.0), score.windows, score.predicted,
+                              score.actual, score.mean_abs_error(), score.accuracy() * 100))
+            return ''.join(output)
@@ -1,11 +1,12 @@
 import os
 import time
 import threading
-import nimbus_xml
 import ConfigParser
 import cluster_tools
 import cloudscheduler.config as config
 import cloudscheduler.utilities as utilities
+from cloudscheduler.utilities import get_or_none
+from cloudscheduler.utilities import splitnstrip
 from cloudscheduler.job_management import _attr_list_to_dict
 try:
     import httplib2
@@ -13,12 +14,105 @@ try:
     from oauth2client.file import Storage
     from oauth2client.tools import run
     from apiclient.discovery import build
+    from apiclient.http import BatchHttpRequest
 except:
     pass
 
 log = utilities.get_cloudscheduler_logger()
 
 
+class OperationWatcher():
+    """
+    Watches the pending zone and global operations of a GCE cluster from a
+    background thread, getting the status of all of them with one batch
+    request per tick, so that the calls starting them return at once.
+
+    callback(operation, error) is called on the watcher thread once an
+    operation is DONE, with error None if it succeeded, else a description
+    of its errors or of it timing out.
+    """
+
+    def __init__(self, cluster, interval=None, timeout=None):
+        self.cluster = cluster
+        self.interval = interval if interval != None else cluster.OPERATION_POLL_INTERVAL
+        self.timeout = timeout if timeout != None else cluster.OPERATION_TIMEOUT
+        self.condition = threading.Condition()
+        # operation name -> (operation, callback, time started)
+        self.pending = {}
+        self.thread = None
+        self.batches = 0
+
+    def watch(self, operation, callback):
+        """Call callback once operation, the response of the API call that
+        started it, is done."""
+        if operation.get('status') == 'DONE':
+            self._finish(operation, callback, self._errors(operation))
+            return
+        with self.condition:
+            self.pending[operation['name']] = (operation, callback, time.time())
+            if self.thread == None:
+                self.thread = threading.Thread(target=self._run, name="GCEOperations-%s" % self.cluster.name)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.thread = None
+                    return
+                self.condition.wait(self.interval)
+            self.tick()
+
+    def tick(self):
+        """Get the status of every pending operation in one batch request,
+        and finish those done or timed out."""
+        with self.condition:
+            pending = dict(self.pending)
+        if not pending:
+            return
+        responses = {}
+        def got(request_id, response, exception):
+            if exception:
+                log.debug("Problem getting status of gce operation %s: %s" % (request_id, exception))
+            else:
+                responses[request_id] = response
+        try:
+            batch = self.cluster._new_batch()
+            for (name, (operation, callback, started)) in pending.iteritems():
+                batch.add(self.cluster._operation_request(operation), callback=got, request_id=name)
+            batch.execute(http=self.cluster.auth_http)
+            self.batches += 1
+        except Exception, e:
+            log.error("Problem getting status of gce operations on %s: %s" % (self.cluster.name, e))
+
+        now = time.time()
+        for (name, (operation, callback, started)) in pending.iteritems():
+            response = responses.get(name)
+            if response and response.get('status') == 'DONE':
+                error = self._errors(response)
+                operation = response
+            elif now - started > self.timeout:
+                error = "timed out after %d seconds" % self.timeout
+            else:
+                continue
+            with self.condition:
+                self.pending.pop(name, None)
+            self._finish(operation, callback, error)
+
+    def _errors(self, operation):
+        if 'error' in operation:
+            return "; ".join([error.get('message', str(error)) for error in operation['error'].get('errors', [])]) \
+                   or str(operation['error'])
+        return None
+
+    def _finish(self, operation, callback, error):
+        try:
+            callback(operation, error)
+        except:
+            log.exception("Problem handling the end of gce operation %s" % operation.get('name'))
+
+
 class GoogleComputeEngineCluster(cluster_tools.ICluster):
     GCE_SCOPE = 'https://www.googleapis.com/auth/compute'
     
@@ -35,6 +129,14 @@ class GoogleComputeEngineCluster(cluster_tools.ICluster):
     DEFAULT_SCOPES = ['https://www.googleapis.com/auth/devstorage.full_control',
                   'https://www.googleapis.com/auth/compute']
 
+    # Most age, in seconds, of a zone's instance listing shared by vm_poll calls
+    LISTING_MAX_AGE = 30
+    # Seconds between checks of the pending operations, and until one is given up on
+    OPERATION_POLL_INTERVAL = 2
+    OPERATION_TIMEOUT = 600
+
+    ERROR = 1
+
     def __init__(self, name="Dummy Cluster", host="localhost",
                  cloud_type="Dummy", memory=[], max_vm_mem= -1, cpu_archs=[], networks=[],
                  vm_slots=0, cpu_cores=0, storage=0, hypervisor='xen', boot_timeout=None,
@@ -42,6 +144,15 @@ class GoogleComputeEngineCluster(cluster_tools.ICluster):
 
         self.gce_hostname_prefix = 'gce-cs-vm'
         self.gce_hostname_counter = 0
+        # zone -> (time listed, {instance id: instance})
+        self.listings = {}
+        self.listing_lock = threading.Lock()
+        # Instances with our name prefix but no VM, id -> name
+        self.unmanaged_instances = {}
+        self.operations = OperationWatcher(self)
+        # Names of the VMs whose delete operation hasn't finished, and failed
+        self.deleting = set()
+        self.delete_failed = set()
         self.security_group = security_group
         self.auth_dat_file_path = auth_dat_file
         self.secret_file_path = secret_file
@@ -70,6 +181,39 @@ class GoogleComputeEngineCluster(cluster_tools.ICluster):
                          vm_slots=vm_slots, cpu_cores=cpu_cores,
                          storage=storage, hypervisor=hypervisor, boot_timeout=boot_timeout)
 
+    def __getstate__(self):
+        """Override to work with pickle module."""
+        state = cluster_tools.ICluster.__getstate__(self)
+        state.pop('listing_lock', None)
+        state.pop('operations', None)
+        state['listings'] = {}
+        # The operations aren't watched after a restart, so deletes are asked for again
+        state['deleting'] = set()
+        return state
+
+    def __setstate__(self, state):
+        """Override to work with pickle module."""
+        cluster_tools.ICluster.__setstate__(self, state)
+        self.listing_lock = threading.Lock()
+        self.operations = OperationWatcher(self)
+        if 'listings' not in state:
+            self.listings = {}
+            self.unmanaged_instances = {}
+        if 'deleting' not in state:
+            self.deleting = set()
+            self.delete_failed = set()
+
+    def context_cloud_type(self):
+        return "gce"
+
+    def vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations):
+        args = cluster_tools.ICluster.vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations)
+        args.update({'vm_image':job.req_ami,
+                     'instance_type':job.instance_type,
+                     'maximum_price':job.maximum_price,
+                     'securitygroup':job.req_security_group})
+        return args
+
     def vm_create(self, vm_name, vm_type, vm_user, vm_networkassoc, vm_cpuarch,
                   vm_image, vm_mem, vm_cores, vm_storage, customization=None,
                   vm_keepalive=0, instance_type="", maximum_price=0,
@@ -113,12 +257,12 @@ class GoogleComputeEngineCluster(cluster_tools.ICluster):
               self.GCE_URL, self.project_id, vm_image_name)
         
         machine_type_url = '%s/zones/%s/machineTypes/%s' % (
-              self.project_url, self.DEFAULT_ZONE, vm_instance_type)
+              self.project_url, self.DEFAULT_ZONE, instance_type)
         #zone_url = '%s/zones/%s' % (self.project_url, self.DEFAULT_ZONE)
         network_url = '%s/global/networks/%s' % (self.project_url, self.DEFAULT_NETWORK)
 
         if customization:
-            user_data = nimbus_xml.ws_optional(customization)
+            user_data = self.vm_userdata(customization)
         else:
             user_data = ""
 
@@ -159,7 +303,6 @@ class GoogleComputeEngineCluster(cluster_tools.ICluster):
              project=self.project_id, body=instance, zone=self.DEFAULT_ZONE)
         try:
             response = request.execute(self.auth_http)
-            response = self._blocking_call(self.gce_service, self.auth_http, response)
         except Exception, e:
             log.error("Error creating VM on gce: %s" % e)
             pass
@@ -195,78 +338,163 @@ class GoogleComputeEngineCluster(cluster_tools.ICluster):
             return self.ERROR
     
         self.vms.append(new_vm)
+        # The VM boots in the background, its status kept up by the poller
+        self.operations.watch(response, lambda operation, error: self._create_done(new_vm, error))
         return 0
 
+    def _create_done(self, vm, error):
+        if error:
+            log.error("Creating gce VM %s failed: %s" % (vm.name, error))
+            with self.vms_lock:
+                vm.status = "Error"
+                vm.last_state_change = int(time.time())
+        else:
+            log.debug("gce VM %s created" % vm.name)
+
 
     def vm_destroy(self, vm, return_resources=True, reason=""):
+        """Start deleting the instance of vm. The VM is kept until the delete
+        operation finishes, and is kept in Error if it fails, so the poller
+        destroys it again."""
+        with self.vms_lock:
+            if vm.name in self.deleting:
+                log.verbose("Already deleting gce VM %s" % vm.name)
+                return 0
+            self.deleting.add(vm.name)
+            self.delete_failed.discard(vm.name)
         # Delete an Instance
         request = self.gce_service.instances().delete(
             project=self.project_id, instance=vm.name, zone=self.DEFAULT_ZONE)
         try:
             response = request.execute(self.auth_http)
-            response = self._blocking_call(self.gce_service, self.auth_http, response)
-        except:
-            log.error("Failure while destroying VM %s." % (vm.id))
-            return
+        except Exception, e:
+            if getattr(getattr(e, 'resp', None), 'status', None) == 404:
+                # An HttpError for an instance deleted outside cloud scheduler
+                log.warning("gce VM %s is already gone, removing it" % vm.name)
+                self._destroy_done(vm, None, return_resources)
+                return 0
+            log.error("Failure while destroying VM %s: %s" % (vm.id, e))
+            with self.vms_lock:
+                self.deleting.discard(vm.name)
+            return self.ERROR
 
-        if response and response['status'] == 'DONE':
-            # Delete references to this VM
-            if return_resources:
-                self.resource_return(vm)
+        self.operations.watch(response, lambda operation, error: self._destroy_done(vm, error, return_resources))
+        return 0
+
+    def _destroy_done(self, vm, error, return_resources):
+        with self.vms_lock:
+            self.deleting.discard(vm.name)
+        if error:
+            log.error("Error Destroying GCE VM %s: %s" % (vm.name, error))
+            self.health.record_destroy(False)
             with self.vms_lock:
+                self.delete_failed.add(vm.name)
+                vm.status = "Error"
+                vm.last_state_change = int(time.time())
+            return
+        log.debug("gce VM %s destroyed" % vm.name)
+        # Delete references to this VM
+        if return_resources:
+            self.resource_return(vm)
+        with self.vms_lock:
+            if vm in self.vms:
                 self.vms.remove(vm)
-            return 0
-        else:
-            log.debug("Error Destroying GCE VM: %s" % (vm.name))
-            return 1
 
     def vm_poll(self, vm):
-        #filter_str = ''.join(["id eq ", vm.id])
-        #request = self.gce_service.instances().list(project=self.project_id, filter=filter_str)
-        request = self.gce_service.instances().list(project=self.project_id, filter=None, zone=self.DEFAULT_ZONE)
+        """Update vm from the listing of its zone, listing the zone only if
+        no other poll did in the last LISTING_MAX_AGE seconds."""
         try:
-            response = request.execute(self.auth_http)
+            (listed, instances) = self._list_zone(self.DEFAULT_ZONE)
         except Exception as e:
             log.error("Problem polling gce vm %s error %s will retry later." % (vm.id, e))
-            return
+            return vm.status
+        return self._update_vm(vm, instances.get(vm.id), listed)
 
-        if response and 'items' in response:
-            instances = response['items']
-            for instance in instances:
-                if 'id' in instance and instance['id'] == vm.id:
-                    vm.status = instance['status']
-                    vm.ipaddress = instance['networkInterfaces'][0]['accessConfigs'][0]['natIP']
-                
-        else:
-            pass
+    def vm_poll_all(self, vms):
+        """List each zone once for the polling cycle and update every VM from
+        it, setting VMs missing from the listing to Error and noting the
+        instances named like ours that aren't any of the cluster's VMs."""
+        try:
+            (listed, instances) = self._list_zone(self.DEFAULT_ZONE, refresh=True)
+        except Exception as e:
+            log.error("Problem listing gce vms on %s error %s will retry later." % (self.name, e))
+            return [vm.status for vm in vms]
+        states = [self._update_vm(vm, instances.get(vm.id), listed) for vm in vms]
+        self._find_unmanaged(instances)
+        return states
 
+    def _list_zone(self, zone, refresh=False):
+        """Returns (time listed, dict of instance id to instance) for every
+        instance in zone, following the listing's pages. The listing is
+        kept for the other polls of the cycle unless refresh is set."""
+        with self.listing_lock:
+            cached = self.listings.get(zone)
+            if cached and not refresh and time.time() - cached[0] < self.LISTING_MAX_AGE:
+                return cached
+            listed = time.time()
+            instances = {}
+            page_token = None
+            while True:
+                if page_token:
+                    request = self.gce_service.instances().list(project=self.project_id, filter=None,
+                                                                zone=zone, pageToken=page_token)
+                else:
+                    request = self.gce_service.instances().list(project=self.project_id, filter=None, zone=zone)
+                response = request.execute(self.auth_http)
+                for instance in response.get('items', []):
+                    if 'id' in instance:
+                        instances[instance['id']] = instance
+                page_token = response.get('nextPageToken')
+                if not page_token:
+                    break
+            self.listings[zone] = (listed, instances)
+            return self.listings[zone]
 
-    def _blocking_call(self, gce_service, auth_http, response):
-        """Blocks until the operation status is done for the given operation."""
-        if 'status' in response:
-            status = response['status']
-            
-        while status != 'DONE' and response:
-            if 'name' in response:
-                operation_id = response['name']
-            else:
-                break
-            if 'zone' in response:
-                zone_name = response['zone'].split('/')[-1]
-                request = gce_service.zoneOperations().get(project=self.project_id, operation=operation_id, zone=zone_name)
-            else:
-                request = gce_service.globalOperations().get(project=self.project_id, operation=operation_id)
+    def _update_vm(self, vm, instance, listed):
+        """Update vm from its instance in a listing made at time listed."""
+        with self.vms_lock:
+            if instance == None:
+                # A VM created after the listing may just not be in it yet
+                if vm.initialize_time < int(listed) and vm.status != "Error":
+                    log.error("%s on %s doesn't seem to exist anymore, setting status to Error" % (vm.name, self.name))
+                    vm.status = "Error"
+                    vm.last_state_change = int(time.time())
+                return vm.status
+            status = instance['status'] if vm.name not in self.delete_failed else "Error"
+            if vm.status != status:
+                vm.last_state_change = int(time.time())
+            vm.status = status
             try:
-                response = request.execute(auth_http)
-            except:
+                vm.ipaddress = instance['networkInterfaces'][0]['accessConfigs'][0]['natIP']
+            except (KeyError, IndexError):
                 pass
-            
-            if response and 'status' in response:
-                status = response['status']
+            vm.lastpoll = int(time.time())
+        return vm.status
+
+    def _find_unmanaged(self, instances):
+        """Note the listed instances named like the ones this cluster boots
+        but matching none of its VMs, created or left over out of band."""
+        known = set([vm.id for vm in self.vms])
+        unmanaged = {}
+        for (instance_id, instance) in instances.iteritems():
+            name = instance.get('name', "")
+            if name.startswith(self.gce_hostname_prefix) and instance_id not in known:
+                if instance_id not in self.unmanaged_instances:
+                    log.warning("Instance %s (%s) on %s isn't managed by cloud scheduler" % (name, instance_id, self.name))
+                unmanaged[instance_id] = name
+        self.unmanaged_instances = unmanaged
+
+    def _operation_request(self, operation):
+        """The request getting the status of a zone or global operation."""
+        if 'zone' in operation:
+            zone_name = operation['zone'].split('/')[-1]
+            return self.gce_service.zoneOperations().get(project=self.project_id,
+                                                         operation=operation['name'], zone=zone_name)
+        return self.gce_service.globalOperations().get(project=self.project_id, operation=operation['name'])
+
+    def _new_batch(self):
+        return BatchHttpRequest()
 
-            time.sleep(1)
-        return response
-    
     def generate_next_instance_name(self):
         for _ in range(0,10):
             potential_name = ''.join([self.gce_hostname_prefix, str(self.gce_hostname_counter)])
@@ -286,4 +514,25 @@ class GoogleComputeEngineCluster(cluster_tools.ICluster):
         return potential_name
     def construct_hostname(self, instance_name):
         return ''.join([instance_name, '.c.', self.project_id, '.internal'])
-            
+
+
+def _cluster_from_config(cloud_config, section, common):
+    """Build a GoogleComputeEngineCluster from its section of the cloud resources config."""
+    return GoogleComputeEngineCluster(name = section,
+            cloud_type = get_or_none(cloud_config, section, "cloud_type"),
+            memory = map(int, splitnstrip(",", get_or_none(cloud_config, section, "memory"))),
+            max_vm_mem = common['max_vm_mem'],
+            cpu_archs = splitnstrip(",", get_or_none(cloud_config, section, "cpu_archs")),
+            networks = splitnstrip(",", get_or_none(cloud_config, section, "networks")),
+            vm_slots = int(get_or_none(cloud_config, section, "vm_slots")),
+            cpu_cores = int(get_or_none(cloud_config, section, "cpu_cores")),
+            storage = int(get_or_none(cloud_config, section, "storage")),
+            auth_dat_file = get_or_none(cloud_config, section, "auth_dat_file"),
+            secret_file = get_or_none(cloud_config, section, "secret_file"),
+            security_group = splitnstrip(",", get_or_none(cloud_config, section, "security_group")),
+            boot_timeout = get_or_none(cloud_config, section, "boot_timeout"),
+            project_id = get_or_none(cloud_config, section, "project_id"),
+            )
+
+cluster_tools.register_cloud_type("GoogleComputeEngine", _cluster_from_config)
+cluster_tools.register_cloud_type("GCE", _cluster_from_config)
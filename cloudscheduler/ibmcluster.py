@@ -1,5 +1,7 @@
 import cluster_tools
 import threading
+from cloudscheduler.utilities import get_or_none
+from cloudscheduler.utilities import splitnstrip
 
 class IBMCluster(cluster_tools.ICluster):
 
@@ -57,18 +59,47 @@ class IBMCluster(cluster_tools.ICluster):
         self.driver = get_driver(Provider.IBM)
 
     def _get_connection(self, username, password):
-        self.connection = self.driver(username, password)
+        """Returns a libcloud connection for the account. The one for the
+        cluster's own account is reused until it expires."""
+        if username == self.username and password == self.password:
+            return self.connections.get()
+        return self._new_connection(username, password)
+
+    def _connect(self):
+        return self._new_connection(self.username, self.password)
+
+    def _auth_error(self, error):
+        from libcloud.common.types import InvalidCredsError
+        return isinstance(error, InvalidCredsError)
+
+    def _new_connection(self, username, password):
+        """Returns a new libcloud connection for the account, refreshing the
+        cloud's locations, sizes and images. Connections are made by several
+        threads at once, so only the complete listings are stored."""
+        connection = self.driver(username, password)
         try:
-            self.locations = self.connection.list_locations()
-            self.locations_dict = {}
-            for loc in self.locations:
-                self.locations_dict[loc.id] = loc
-            #self.locations_dict = {loc.id: loc for loc in self.locations}
-            self.compute_sizes = self.connection.list_sizes()
-            self.images = self.connection.list_images()
+            locations = connection.list_locations()
+            locations_dict = {}
+            for loc in locations:
+                locations_dict[loc.id] = loc
+            compute_sizes = connection.list_sizes()
+            images = connection.list_images()
         except:
             return None
-        return self.connection
+        (self.locations, self.locations_dict, self.compute_sizes, self.images) = \
+            (locations, locations_dict, compute_sizes, images)
+        return connection
+
+    def context_cloud_type(self):
+        return "ibm"
+
+    def vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations):
+        args = cluster_tools.ICluster.vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations)
+        args.update({'vm_image':job.req_image_id,
+                     'instance_type':job.req_instance_type_ibm,
+                     'location':job.location,
+                     'vm_keyname':job.key_name})
+        return args
 
     def vm_create(self, vm_name, vm_type, vm_user, vm_networkassoc, vm_cpuarch,
                   vm_image, vm_mem, vm_cores, vm_storage, customization, 
@@ -102,7 +133,11 @@ class IBMCluster(cluster_tools.ICluster):
         instance = None
         vm_key = NodeAuthSSHKey(vm_keyname)
 
-        instance = conn.create_node(name=vm_name, image=image, size=vm_size, location=vm_location, auth=vm_key)
+        try:
+            instance = conn.create_node(name=vm_name, image=image, size=vm_size, location=vm_location, auth=vm_key)
+        except:
+            self.connections.failed()
+            raise
         if instance:
             new_vm = VM(name = vm_name, id = instance.uuid, vmtype = vm_type, user = vm_user,
                         clusteraddr = self.network_address,
@@ -125,10 +160,15 @@ class IBMCluster(cluster_tools.ICluster):
         return 0
 
     def vm_destroy(self, vm, return_resources=True, reason=""):
-        nodes = self.connection.list_nodes()
+        connection = self._get_connection(self.username, self.password)
+        try:
+            nodes = connection.list_nodes()
+        except:
+            self.connections.failed()
+            raise
         for node in nodes:
             if node.uuid == vm.id:
-                self.connection.destroy_node(node)
+                connection.destroy_node(node)
                 log.info("VM %s Destroyed: Reason: %s" % (vm.id, reason))
                 # return resources
                 if return_resources:
@@ -141,7 +181,11 @@ class IBMCluster(cluster_tools.ICluster):
     def vm_poll(self, vm):
         # libcloud does not seem to support polling individual VMs you simply list off what you have
         # ineffecient this way but is in line with other clouds
-        nodes = self.connection.list_nodes()
+        try:
+            nodes = self._get_connection(self.username, self.password).list_nodes()
+        except:
+            self.connections.failed()
+            raise
         for node in nodes:
             if node.uuid == vm.id:
                 if not vm.ipaddress:
@@ -166,3 +210,23 @@ class IBMCluster(cluster_tools.ICluster):
             else:
                 continue
         pass
+
+
+def _cluster_from_config(cloud_config, section, common):
+    """Build an IBMCluster from its section of the cloud resources config."""
+    return IBMCluster(name= section,
+            host= get_or_none(cloud_config, section, "host"),
+            cloud_type= get_or_none(cloud_config, section, "cloud_type"),
+            memory= map(int, splitnstrip(",", get_or_none(cloud_config, section, "memory"))),
+            max_vm_mem= common['max_vm_mem'],
+            cpu_archs= splitnstrip(",", get_or_none(cloud_config, section, "cpu_archs")),
+            networks= splitnstrip(",", get_or_none(cloud_config, section, "networks")),
+            vm_slots= int(get_or_none(cloud_config, section, "vm_slots")),
+            cpu_cores= int(get_or_none(cloud_config, section, "cpu_cores")),
+            storage= int(get_or_none(cloud_config, section, "storage")),
+            hypervisor= common['hypervisor'],
+            username= get_or_none(cloud_config, section, "username"),
+            password= get_or_none(cloud_config, section, "password"),
+            )
+
+cluster_tools.register_cloud_type("IBMSmartCloud", _cluster_from_config)
@@ -355,6 +355,26 @@ class InfoServer(threading.Thread,):
                     if count > 0:
                         output.extend([str(count), ' ', state, ','])
                 return ''.join(output)
+            def get_cycle_profile(self):
+                output = []
+                output.append(scheduler.profiler.get_report())
+                output.append("\n")
+                output.append(cleaner.profiler.get_report())
+                return ''.join(output)
+            def get_forecast(self):
+                return scheduler.forecaster.get_forecast_info()
+            def get_warm_pool(self):
+                return cloud_resources.warm_pool.get_warm_pool_info()
+            def get_memory_fragmentation(self):
+                return cloud_resources.get_memory_fragmentation_info()
+            def get_cloud_health(self):
+                return cloud_resources.get_cloud_health_info()
+            def get_connections(self):
+                return cloud_resources.get_connection_info()
+            def get_destroys(self):
+                return cloud_resources.destroyer.get_destroy_info()
+            def get_reservations(self):
+                return scheduler.planner.get_reservations_info()
 
         self.server.register_instance(externalFunctions())
 
@@ -1,5 +1,6 @@
 from abc import ABCMeta, abstractmethod
 from collections import defaultdict
+from bisect import bisect_left
 import time
 import threading
 import logging
@@ -166,6 +167,18 @@ class JobContainer():
     def get_unscheduled_jobs_sorted_by_id(self):
         pass
 
+    # Get up to N unscheduled jobs in arrival order (Condor cluster and proc id),
+    # or [] if there are no unscheduled jobs or N <= 0. If N is None, then all
+    # unscheduled jobs are returned. Only the returned jobs are visited.
+    @abstractmethod
+    def get_unscheduled_jobs_fifo(self, N=None):
+        pass
+
+    # Returns the number of scheduled jobs in the container.
+    @abstractmethod
+    def num_scheduled_jobs(self):
+        pass
+
     # Get a list of all unscheduled jobs per user.
     # Returns dictionary where the items are:
     # (user, [list of unscheduled jobs])
@@ -204,6 +217,12 @@ class JobContainer():
     def find_unscheduled_jobs_with_matching_reqs(self, user, job, N=0):
         pass
 
+    # Finds the unscheduled jobs of user that could share a job_per_core VM
+    # with the given job.
+    @abstractmethod
+    def find_unscheduled_jobs_sharing_vm(self, user, job):
+        pass
+
     # Returns True if the container has no jobs, returns False otherwise.
     @abstractmethod
     def is_empty(self):
@@ -230,6 +249,7 @@ class HashTableJobContainer(JobContainer):
     # class attributes
     all_jobs = None
     new_jobs = None
+    new_jobs_fifo = None
     sched_jobs = None
     jobs_by_user = None
 
@@ -238,6 +258,8 @@ class HashTableJobContainer(JobContainer):
         JobContainer.__init__(self)
         self.all_jobs = {}
         self.new_jobs = {}
+        # Sorted list of (cluster_id, proc_id, job id) of the unscheduled jobs
+        self.new_jobs_fifo = []
         self.sched_jobs = {}
         self.jobs_by_user = defaultdict(dict)
         log.verbose('HashTableJobContainer instance created.')
@@ -249,6 +271,22 @@ class HashTableJobContainer(JobContainer):
     def has_job(self, jobid):
         return self.get_job_by_id(jobid) != None
 
+    @staticmethod
+    def _fifo_key(job):
+        return (job.cluster_id, job.proc_id, job.id)
+
+    def _fifo_add(self, job):
+        key = self._fifo_key(job)
+        index = bisect_left(self.new_jobs_fifo, key)
+        if index == len(self.new_jobs_fifo) or self.new_jobs_fifo[index] != key:
+            self.new_jobs_fifo.insert(index, key)
+
+    def _fifo_remove(self, job):
+        key = self._fifo_key(job)
+        index = bisect_left(self.new_jobs_fifo, key)
+        if index < len(self.new_jobs_fifo) and self.new_jobs_fifo[index] == key:
+            del self.new_jobs_fifo[index]
+
     def add_job(self, job):
         with self.lock:
             self.all_jobs[job.id] = job
@@ -257,6 +295,7 @@ class HashTableJobContainer(JobContainer):
             # Update scheduled/unscheduled maps too:
             if(job.status == "Unscheduled"):
                 self.new_jobs[job.id] = job
+                self._fifo_add(job)
             else:
                 self.sched_jobs[job.id] = job
 
@@ -272,6 +311,7 @@ class HashTableJobContainer(JobContainer):
             self.all_jobs.clear()
             self.jobs_by_user.clear()
             self.new_jobs.clear()
+            del self.new_jobs_fifo[:]
             self.sched_jobs.clear()
             log.verbose('job container cleared')
 
@@ -285,6 +325,7 @@ class HashTableJobContainer(JobContainer):
                     del self.jobs_by_user[job.user]
             if job.id in self.new_jobs:
                 del self.new_jobs[job.id]
+                self._fifo_remove(job)
             if job.id in self.sched_jobs:
                 del self.sched_jobs[job.id]
             #log.debug('job %s removed from container' % job.id)
@@ -426,6 +467,14 @@ class HashTableJobContainer(JobContainer):
             return_value.append(jobid[1])
         return return_value
         
+    def get_unscheduled_jobs_fifo(self, N=None):
+        with self.lock:
+            keys = self.new_jobs_fifo[:max(N, 0)] if N != None else self.new_jobs_fifo
+            return [self.new_jobs[key[2]] for key in keys]
+
+    def num_scheduled_jobs(self):
+        return len(self.sched_jobs)
+
     def get_unscheduled_jobs_by_users(self, prioritized=False):
         with self.lock:
             return_value = defaultdict(list)
@@ -536,6 +585,7 @@ class HashTableJobContainer(JobContainer):
                 job.set_status("Scheduled")
                 self.sched_jobs[jobid] = job
                 del self.new_jobs[jobid]
+                self._fifo_remove(job)
                 #log.verbose('Job %s marked as scheduled in the job container' % (jobid))
                 return True
             else:
@@ -548,6 +598,7 @@ class HashTableJobContainer(JobContainer):
                 job = self.sched_jobs[jobid]
                 job.set_status("Unscheduled")
                 self.new_jobs[jobid] = job
+                self._fifo_add(job)
                 del self.sched_jobs[jobid]
                 #log.verbose('Job %s marked as unscheduled in the job container' % (jobid))
                 return True
@@ -575,6 +626,10 @@ class HashTableJobContainer(JobContainer):
 
             return matching_jobs
 
+    def find_unscheduled_jobs_sharing_vm(self, user, job):
+        with self.lock:
+            return [j for j in self.new_jobs.values() if j.user == user and j.can_share_vm(job)]
+
     def get_unscheduled_user_jobs_by_type(self, user, prioritized=False):
         with self.lock:
             unsched = self.get_unscheduled_jobs_by_users()
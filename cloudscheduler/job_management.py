@@ -52,6 +52,7 @@ import cloudscheduler.config as config
 from cloudscheduler.utilities import determine_path
 from cloudscheduler.utilities import get_cert_expiry_time
 from cloudscheduler.utilities import splitnstrip
+from cloudscheduler.utilities import JobRunTrackQueue
 import job_containers
 from decimal import *
 
@@ -398,6 +399,11 @@ class Job:
         """A method that will compare a job's requirements listed below with another job to see if they all match."""
         return self.req_vmtype == job.req_vmtype and self.req_cpucores == job.req_cpucores and self.req_memory == job.req_memory and self.req_storage == job.req_storage and self.req_cpuarch == job.req_cpuarch and self.req_network == job.req_network and self.user == job.user
 
+    def can_share_vm(self, job):
+        """A method that will check if two job_per_core jobs can run in slots of the same VM,
+        the per-slot memory and storage they need are compared by the packing planner."""
+        return self.job_per_core and job.job_per_core and self.user == job.user and self.req_vmtype == job.req_vmtype and self.req_cpuarch == job.req_cpuarch and self.req_network == job.req_network and self.req_imageloc == job.req_imageloc and self.req_ami == job.req_ami and self.req_hypervisor == job.req_hypervisor and self.target_clouds == job.target_clouds and self.instance_type == job.instance_type
+
     def get_vmimage_proxy_file_path(self):
         proxypath = []
         proxyfilepath= ''
@@ -481,6 +487,13 @@ class JobPool:
         self.last_query = None
         self.write_lock = threading.RLock()
 
+        # Job arrival history and run times per uservmtype for forecasting
+        self.arrival_lock = threading.Lock()
+        self.arrivals_primed = False
+        self.arrival_counts = defaultdict(int)
+        self.arrival_prototypes = {}
+        self.type_run_times = {}
+
         _schedd_wsdl  = "file://" + determine_path() \
                         + "/wsdl/condorSchedd.wsdl"
         self.condor_schedd = Client(_schedd_wsdl,
@@ -774,12 +787,13 @@ class JobPool:
             - Adds all new jobs to the system
            Keywords:
             - query_jobs - (list of Job objects) The jobs received from a condor query
+           Returns the list of jobs new to the system.
         """
         # If no jobs recvd, remove all jobs from the system (all have finished or have been removed)
         if (query_jobs == []):
             log.debug("No jobs received from job query. Removing all jobs from the system.")
             self.job_container.clear()
-            return
+            return []
 
         # Filter out any jobs in an error status (from the given job list)
         jobs_removed_due_status = 0
@@ -822,6 +836,8 @@ class JobPool:
                 new_jobs.append(job)
         query_jobs = new_jobs
 
+        self.record_arrivals(new_jobs)
+
         # Add all jobs remaining in jobs list to the Unscheduled job set (new_jobs)
         for job in query_jobs:
             if job.high_priority == 0 or  not config.high_priority_job_support:
@@ -847,6 +863,35 @@ class JobPool:
         #self.log_sched_jobs()
         #log.verbose("High Priority Jobs (high_jobs):")
         #self.log_high_jobs()
+        return new_jobs
+
+    def record_arrivals(self, new_jobs):
+        """Count newly arrived idle jobs per uservmtype. The jobs found by the
+        first query are already queued when Cloud Scheduler starts so are not
+        counted as arrivals."""
+        with self.arrival_lock:
+            if not self.arrivals_primed:
+                self.arrivals_primed = True
+                return
+            for job in new_jobs:
+                if job.job_status == self.IDLE:
+                    self.arrival_counts[job.uservmtype] += 1
+                    self.arrival_prototypes[job.uservmtype] = job
+
+    def take_arrivals(self):
+        """Returns and resets the arrival counts per uservmtype recorded
+        since the last call, and the latest job seen of each type."""
+        with self.arrival_lock:
+            arrivals = (self.arrival_counts, self.arrival_prototypes)
+            self.arrival_counts = defaultdict(int)
+            self.arrival_prototypes = {}
+        return arrivals
+
+    def get_type_run_time(self, uservmtype):
+        """Returns the average run time of recent jobs of uservmtype, 0 if unknown."""
+        if uservmtype in self.type_run_times:
+            return self.type_run_times[uservmtype].average()
+        return 0
 
     def add_new_job(self, job):
         """Add New Job
@@ -1355,8 +1400,12 @@ class JobPool:
             # have been running
             if job.job_status == self.RUNNING:
                 if int(job.jobstarttime) > 0:
+                    run_time = int(job.servertime) - int(job.jobstarttime)
                     if job.running_vm != None:
-                        job.running_vm.job_run_times.append(int(job.servertime) - int(job.jobstarttime))
+                        job.running_vm.job_run_times.append(run_time)
+                    if job.uservmtype not in self.type_run_times:
+                        self.type_run_times[job.uservmtype] = JobRunTrackQueue(job.uservmtype)
+                    self.type_run_times[job.uservmtype].append(run_time)
 
     ##
     ## JobPool Private methods (Support methods)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## MEMORY ENTRY ALLOCATOR
+##
+## Chooses which entry of a cluster's per-host 'memory' list a new VM is
+## placed on. Three policies are supported, set by memory_allocation:
+##   firstfit - the historical behaviour, an exact fit if there is one,
+##              else the first entry in the list with enough free memory
+##   bestfit  - the entry with the least free memory that still fits
+##   worstfit - the entry with the most free memory
+##
+## The free memory of the entries is kept sorted as (free, index) pairs for
+## best-fit, worst-fit and exact fit lookups, and in a max segment tree over
+## the entry indexes for first-fit, so finding an entry is logarithmic in
+## the number of hosts.
+##
+## The allocator also counts the requests that could not be placed although
+## the cluster had enough free memory in total, which along with the share of
+## free memory outside the largest entry measures how fragmented it is.
+##
+from bisect import bisect_left, insort
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+POLICIES = ("firstfit", "bestfit", "worstfit")
+
+
+def allocation_policy(policy=None):
+    """Returns the given or configured policy, falling back on firstfit."""
+    policy = (policy if policy else config.memory_allocation).lower()
+    if policy not in POLICIES:
+        log.error("Unknown memory_allocation %s, using firstfit" % policy)
+        policy = "firstfit"
+    return policy
+
+
+def select_mementry(entries, memory, policy=None, excluded=()):
+    """Pick an entry of the free memory list entries for a VM of memory MB
+    with the policy, skipping the excluded indexes. A linear scan for small
+    or short lived lists. Returns -1 if no entry fits."""
+    policy = allocation_policy(policy)
+    best = -1
+    for i in range(len(entries)):
+        if i in excluded or entries[i] < memory:
+            continue
+        if policy == "firstfit":
+            if entries[i] == memory:
+                return i
+            if best < 0:
+                best = i
+        elif best < 0 or (policy == "bestfit" and entries[i] < entries[best]) or \
+             (policy == "worstfit" and entries[i] > entries[best]):
+            best = i
+    return best
+
+
+class MemoryAllocator():
+    """Index of the free memory of the entries of a cluster's memory list.
+
+    The cluster's res_lock must be held around calls that change entries.
+    """
+
+    def __init__(self, memory, policy=None):
+        """memory - the cluster's memory list, indexed as it is now"""
+        self.policy = allocation_policy(policy)
+        self.finds = 0
+        self.failures = 0
+        self.fragmented_failures = 0
+        self.reset(memory)
+
+    def reset(self, memory):
+        """Re-index from scratch, after the memory list was replaced."""
+        self.source = memory
+        self.entries = list(memory)
+        self.total_free = sum(self.entries)
+        self.by_size = sorted([(free, i) for (i, free) in enumerate(self.entries)])
+        self.leaves = 1
+        while self.leaves < len(self.entries):
+            self.leaves *= 2
+        self.tree = [-1] * (2 * self.leaves)
+        for (i, free) in enumerate(self.entries):
+            self.tree[self.leaves + i] = free
+        for node in range(self.leaves - 1, 0, -1):
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def set(self, index, free):
+        """Set the free memory of entry index."""
+        if index < 0:
+            index += len(self.entries)
+        old = self.entries[index]
+        del self.by_size[bisect_left(self.by_size, (old, index))]
+        insort(self.by_size, (free, index))
+        self.entries[index] = free
+        self.total_free += free - old
+        node = self.leaves + index
+        self.tree[node] = free
+        node /= 2
+        while node:
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+            node /= 2
+
+    def find(self, memory):
+        """Returns the index of the entry to place a VM of memory MB on
+        according to the policy, or -1 if no entry fits."""
+        self.finds += 1
+        index = -1
+        if self.by_size and self.by_size[-1][0] >= memory:
+            if self.policy == "worstfit":
+                index = self.by_size[bisect_left(self.by_size, (self.by_size[-1][0], -1))][1]
+            else:
+                (free, index) = self.by_size[bisect_left(self.by_size, (memory, -1))]
+                if self.policy == "firstfit" and free != memory:
+                    # Leftmost entry with enough free memory
+                    node = 1
+                    while node < self.leaves:
+                        node = 2 * node if self.tree[2 * node] >= memory else 2 * node + 1
+                    index = node - self.leaves
+        if index < 0:
+            self.failures += 1
+            if self.total_free >= memory:
+                self.fragmented_failures += 1
+        return index
+
+    def largest_free(self):
+        return self.by_size[-1][0] if self.by_size else 0
+
+    def fragmentation(self):
+        """Share of the free memory outside the largest free entry, 0.0 when
+        all free memory could go to a single VM."""
+        if self.total_free <= 0:
+            return 0.0
+        return 1.0 - float(self.largest_free()) / self.total_free
+
+    def get_stats(self):
+        """Returns (entries, total free, largest free, fragmentation, finds,
+        failures, failures with enough total free memory)."""
+        return (len(self.entries), self.total_free, self.largest_free(), self.fragmentation(),
+                self.finds, self.failures, self.fragmented_failures)
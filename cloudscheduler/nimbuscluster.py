@@ -12,14 +12,141 @@ import logging
 import string
 import datetime
 import tempfile
+import threading
 import subprocess
+from collections import deque
 from subprocess import Popen
 from urlparse import urlparse
 import cloudscheduler.utilities as utilities
 from cloudscheduler.utilities import get_cert_expiry_time
+from cloudscheduler.utilities import get_or_none
+from cloudscheduler.utilities import splitnstrip
 
 log = utilities.get_cloudscheduler_logger()
 
+class NimbusCommandService():
+    """
+    Runs the workspace commands of a Nimbus cluster. Keeps the EPR file of
+    each VM for the life of the VM instead of writing one for every command,
+    runs at most max_processes workspace clients against the cluster at once,
+    and runs commands due later (the destroy following a shutdown) from
+    timer threads.
+    """
+
+    MAX_PROCESSES = 4
+
+    def __init__(self, cluster, max_processes=None):
+        self.cluster = cluster
+        self.max_processes = max_processes or self.MAX_PROCESSES
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(self.max_processes)
+        # vm id -> EPR file
+        self.eprs = {}
+        # vm id -> Timer of a command due later
+        self.timers = {}
+        self.commands_run = 0
+
+    def __getstate__(self):
+        """Override to work with pickle module."""
+        state = self.__dict__.copy()
+        del state['lock']
+        del state['slots']
+        state['timers'] = {}
+        return state
+
+    def __setstate__(self, state):
+        """Override to work with pickle module."""
+        self.__dict__ = state
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(self.max_processes)
+
+    def epr(self, vm):
+        """Returns the EPR file of vm, writing it the first time."""
+        with self.lock:
+            epr_file = self.eprs.get(vm.id)
+            if epr_file and os.path.exists(epr_file):
+                return epr_file
+            epr_file = nimbus_xml.ws_epr_factory(vm.id, vm.clusteraddr, vm.clusterport)
+            self.eprs[vm.id] = epr_file
+            return epr_file
+
+    def adopt(self, vm_id, epr_file):
+        """Keep epr_file, written by a workspace create, as the EPR of vm_id."""
+        with self.lock:
+            self.eprs[vm_id] = epr_file
+
+    def forget(self, vm):
+        """Remove the EPR file of vm, once it's gone."""
+        with self.lock:
+            epr_file = self.eprs.pop(vm.id, None)
+        if epr_file:
+            try:
+                os.remove(epr_file)
+            except OSError:
+                log.verbose("EPR %s of VM %s was already removed" % (epr_file, vm.id))
+
+    def execwait(self, cmd, env=None):
+        """Run cmd with the cluster's vm_execwait once a process slot is free."""
+        with self.slots:
+            self.commands_run += 1
+            return self.cluster.vm_execwait(cmd, env)
+
+    def execwait_all(self, commands):
+        """Run a list of (cmd, env), up to max_processes at a time, returning
+        the vm_execwait result of each, in order."""
+        results = [None] * len(commands)
+        queue = deque(enumerate(commands))
+        def work():
+            while True:
+                try:
+                    (i, (cmd, env)) = queue.popleft()
+                except IndexError:
+                    return
+                results[i] = self.execwait(cmd, env)
+        workers = [threading.Thread(target=work, name="NimbusCommand-%d" % i)
+                   for i in range(min(self.max_processes, len(commands)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
+    def later(self, vm, delay, function):
+        """Call function in delay seconds on a timer thread, unless a call
+        for vm is already due. Returns True if the call was set."""
+        with self.lock:
+            if vm.id in self.timers:
+                return False
+            timer = threading.Timer(delay, self._fire, (vm.id, function))
+            timer.setDaemon(True)
+            self.timers[vm.id] = timer
+        timer.start()
+        return True
+
+    def due(self, vm):
+        """Returns True if a call for vm is due later."""
+        with self.lock:
+            return vm.id in self.timers
+
+    def wait(self, vm=None):
+        """Wait until the call due later for vm, or every call due, has run."""
+        with self.lock:
+            if vm:
+                timers = [self.timers[vm.id]] if vm.id in self.timers else []
+            else:
+                timers = self.timers.values()
+        for timer in timers:
+            timer.join()
+
+    def _fire(self, vm_id, function):
+        try:
+            function()
+        except:
+            log.exception("Problem running delayed workspace command for VM %s" % vm_id)
+        with self.lock:
+            self.timers.pop(vm_id, None)
+
+
 class NimbusCluster(cluster_tools.ICluster):
     """
     Implements cloud management functionality with the Nimbus service as part of
@@ -31,7 +158,7 @@ class NimbusCluster(cluster_tools.ICluster):
     VM_NODES = "1"
 
     # Number of seconds to wait between executing a shutdown and a destroy.
-    # (Used in vm_destroy method)
+    # (Used in vm_destroy method, the destroy is sent from a timer thread)
     VM_SHUTDOWN = 8
 
     ERROR = 1
@@ -79,6 +206,13 @@ class NimbusCluster(cluster_tools.ICluster):
         self.scratch_attach_device = scratch_attach_device if scratch_attach_device != None else config.scratch_attach_device
         self.image_attach_device = image_attach_device if image_attach_device != None else config.image_attach_device
         self.temp_lease_storage = temp_lease_storage if temp_lease_storage != None else False
+        self.commands = NimbusCommandService(self)
+
+    def __setstate__(self, state):
+        """Override to work with pickle module."""
+        cluster_tools.ICluster.__setstate__(self, state)
+        if 'commands' not in state:
+            self.commands = NimbusCommandService(self)
 
     def get_cluster_info_short(self):
         """Returns formatted cluster information for use by cloud_status, Overloaded from baseclass to use net_slots."""
@@ -91,6 +225,48 @@ class NimbusCluster(cluster_tools.ICluster):
             output += "%-25s  %-15s  %-10s  %-10s %-10s %-10s %-10s %-10s\n" % (self.network_address, self.cloud_type, self.net_slots, self.memory, self.storageGB, self.total_cpu_cores, self.hypervisor, self.enabled)
         return output
 
+    def context_cloud_type(self):
+        return "nimbus"
+
+    def vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations):
+        args = cluster_tools.ICluster.vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations)
+        imageloc = job.req_imageloc
+        imagesplit = imageloc.split('/')
+        if '__hypervisor__' in imagesplit:
+            index = imagesplit.index('__hypervisor__')
+            imagesplit[index] = self.hypervisor
+            imageloc = '/'.join(imagesplit)
+        args.update({'vm_image':imageloc,
+                     'job_proxy_file_path':job.get_x509userproxy(),
+                     'myproxy_creds_name':job.get_myproxy_creds_name(),
+                     'myproxy_server':job.get_myproxy_server(),
+                     'myproxy_server_port':job.get_myproxy_server_port(),
+                     'proxy_non_boot':job.proxy_non_boot,
+                     'vmimage_proxy_file':job.vmimage_proxy_file,
+                     'vmimage_proxy_file_path':job.get_vmimage_proxy_file_path()})
+        return args
+
+    def fits_image(self, ami, imageloc):
+        return imageloc != ""
+
+    def fits_vm(self, network, storage, hypervisor):
+        # An undefined network means pick whatever, so always okay it
+        if network and network not in self.network_pools:
+            return False
+        if self.max_vm_storage != -1 and storage > self.max_vm_storage:
+            return False
+        return self.hypervisor in hypervisor
+
+    def fits_capacity(self, network, cpucores):
+        if self.total_cpu_cores != -1 and cpucores > self.total_cpu_cores:
+            return False
+        if network:
+            return self.net_slots.get(network, 1) > 0
+        return [slots for slots in self.net_slots.values() if slots > 0] != []
+
+    def banned_image(self, ami, imageloc):
+        return imageloc
+
     def vm_create(self, vm_name, vm_type, vm_user, vm_networkassoc, vm_cpuarch,
             vm_image, vm_mem, vm_cores, vm_storage, customization=None, vm_keepalive=0,
             job_proxy_file_path=None, myproxy_creds_name=None, myproxy_server=None, 
@@ -203,7 +379,7 @@ class NimbusCluster(cluster_tools.ICluster):
             env = {'X509_USER_PROXY':vm_proxy_file_path}
             log.debug("VM creation environment will contain:\n\tX509_USER_PROXY = %s" % (vm_proxy_file_path))
 
-        (create_return, create_out, create_err) = self.vm_execwait(ws_cmd, env)
+        (create_return, create_out, create_err) = self.commands.execwait(ws_cmd, env)
 
         if (create_return != 0):
             if create_out == "" or create_out == None:
@@ -221,11 +397,12 @@ class NimbusCluster(cluster_tools.ICluster):
                     if vm_networkassoc in self.net_slots.keys():
                         self.vm_slots -= self.net_slots[vm_networkassoc]
                         self.net_slots[vm_networkassoc] = 0 # no slots remaining
+                        self.capacity_changed()
                 create_return = -2
             elif err_type =='NotEnoughMemory' and config.adjust_insufficient_resources:
                 with self.res_lock:
                     index = self.find_mementry(vm_mem)
-                    self.memory[index] = vm_mem - 1 # may still be memory, but just not enough for this vm
+                    self.set_mementry(index, vm_mem - 1) # may still be memory, but just not enough for this vm
                 create_return = -2
             elif err_type == 'ExceedMaximumWorkspaces' or err_type == 'NotAuthorized':
                 create_return = -3
@@ -235,7 +412,7 @@ class NimbusCluster(cluster_tools.ICluster):
         log.verbose("Nimbus create command executed.")
 
         log.verbose("Deleting temporary Nimbus Metadata files")
-        _remove_files(nimbus_files)
+        _remove_files([vm_metadata, vm_deploymentrequest, vm_optional])
 
         # Find the memory entry in the Cluster 'memory' list which _create will be
         # subtracted from
@@ -253,8 +430,11 @@ class NimbusCluster(cluster_tools.ICluster):
             vm_id = re.search("Workspace created: id (\d*)", create_out).group(1)
         except:
             log.error("Couldn't find workspace id for new VM")
+            _remove_files([vm_epr])
             create_return = -3
             return create_return
+        # Keep the EPR written by the create for the VM's later commands
+        self.commands.adopt(vm_id, vm_epr)
         try:
             vm_ip = re.search("IP address: (\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})", create_out).group(1)
         except:
@@ -302,13 +482,20 @@ class NimbusCluster(cluster_tools.ICluster):
         vm -- vm to shutdown and destroy
         return_resources -- if set to false, do not return resources from VM to cluster
         shutdown_first -- if set to false, will first call a shutdown before destroying
-        """
 
-        # Create an epr for workspace.sh
-        vm_epr = nimbus_xml.ws_epr_factory(vm.id, vm.clusteraddr, vm.clusterport)
+        After a successful shutdown the VM is given VM_SHUTDOWN seconds to
+        shut down, and is then destroyed from a timer thread: the call
+        returns 0 without waiting.
+        """
         if vm.clusteraddr != self.network_address:
-            log.error("Attempting to destroy a VM on wrong cluster - vm belongs to %s, but this is %s. Abort" % (vm.clusteraddr, self.networ_address))
+            log.error("Attempting to destroy a VM on wrong cluster - vm belongs to %s, but this is %s. Abort" % (vm.clusteraddr, self.network_address))
             return -1
+        if self.commands.due(vm):
+            log.verbose("VM %s is already shutting down to be destroyed." % vm.id)
+            return 0
+
+        # Get the epr for workspace.sh
+        vm_epr = self.commands.epr(vm)
 
         if shutdown_first:
             # Create the workspace command with shutdown option
@@ -316,22 +503,69 @@ class NimbusCluster(cluster_tools.ICluster):
             log.verbose("Shutting down VM with command: " + string.join(shutdown_cmd, " "))
 
             # Execute the workspace shutdown command.
-            shutdown_return = self.vm_exec_silent(shutdown_cmd, env=vm.get_env())
+            (shutdown_return, _, _) = self.commands.execwait(shutdown_cmd, env=vm.get_env())
             if (shutdown_return != 0):
                 log.debug("(vm_destroy) - VM shutdown request failed, moving directly to destroy.")
             else:
                 log.verbose("(vm_destroy) - workspace shutdown command executed successfully.")
-                # Sleep for a few seconds to allow for proper shutdown
-                log.verbose("Waiting %ss for VM to shut down..." % self.VM_SHUTDOWN)
-                time.sleep(self.VM_SHUTDOWN)
+                # Give the VM a few seconds to shut down properly
+                log.verbose("Destroying VM %s in %ss, once it has shut down..." % (vm.id, self.VM_SHUTDOWN))
+                self.commands.later(vm, self.VM_SHUTDOWN,
+                                    lambda: self._destroy_after_shutdown(vm, return_resources, reason))
+                return 0
 
+        return self._vm_destroy_now(vm, return_resources, reason)
+
+    def vm_destroy_batch(self, vms, return_resources=True, reason=""):
+        """
+        Shut down vms, give them VM_SHUTDOWN seconds together and destroy
+        them, returning the vm_destroy return code of each once they are
+        destroyed. Nothing is left to a timer thread, as the full shutdown and
+        cloud_admin calling this report or exit right after.
+        """
+        results = [None] * len(vms)
+        to_destroy = []
+        already_due = []
+        for (i, vm) in enumerate(vms):
+            if vm.clusteraddr != self.network_address:
+                log.error("Attempting to destroy a VM on wrong cluster - vm belongs to %s, but this is %s. Abort" % (vm.clusteraddr, self.network_address))
+                results[i] = -1
+            elif self.commands.due(vm):
+                already_due.append(i)
+            else:
+                to_destroy.append(i)
+
+        shutdowns = self.commands.execwait_all([(self.vmshutdown_factory(self.commands.epr(vms[i])), vms[i].get_env())
+                                                for i in to_destroy])
+        if [shutdown_return for (shutdown_return, _, _) in shutdowns if shutdown_return == 0]:
+            log.verbose("Destroying %d VMs in %ss, once they have shut down..." % (len(to_destroy), self.VM_SHUTDOWN))
+            time.sleep(self.VM_SHUTDOWN)
+        for i in to_destroy:
+            results[i] = self._vm_destroy_now(vms[i], return_resources, reason)
+        for i in already_due:
+            # Shut down by an earlier vm_destroy, wait for its destroy
+            self.commands.wait(vms[i])
+            results[i] = 0 if vms[i] not in self.vms else self.ERROR
+        return results
+
+    def finish_destroys(self):
+        self.commands.wait()
+
+    def _destroy_after_shutdown(self, vm, return_resources, reason):
+        """The destroy due VM_SHUTDOWN seconds after a VM's shutdown."""
+        if self._vm_destroy_now(vm, return_resources, reason) != 0:
+            self.health.record_destroy(False)
+
+    def _vm_destroy_now(self, vm, return_resources, reason):
+        """Destroy vm, and return its resources if return_resources."""
+        vm_epr = self.commands.epr(vm)
 
         # Create the workspace command with destroy option as a list (priv.)
         destroy_cmd = self.vmdestroy_factory(vm_epr)
         log.verbose("Destroying VM with command: " + string.join(destroy_cmd, " "))
 
         # Execute the workspace destroy command: wait for return, stdout to log.
-        (destroy_return, destroy_out, destroy_error) = self.vm_execwait(destroy_cmd, env=vm.get_env())
+        (destroy_return, destroy_out, destroy_error) = self.commands.execwait(destroy_cmd, env=vm.get_env())
         destroy_out = destroy_out + destroy_error
 
 
@@ -348,7 +582,6 @@ class NimbusCluster(cluster_tools.ICluster):
                     destroy_error = "No Error output returned."
                 log.warning("VM %s was not correctly destroyed: %s %s %s" % (vm.id, destroy_out, destroy_error, destroy_return))
                 vm.status = "Error"
-                os.remove(vm_epr)
                 return destroy_return
 
         # Delete VM proxy
@@ -370,7 +603,7 @@ class NimbusCluster(cluster_tools.ICluster):
             self.resource_return(vm)
 
         # Delete EPR
-        os.remove(vm_epr)
+        self.commands.forget(vm)
 
 
         log.info("Destroyed VM: %s Name: %s Reason: %s" % (vm.id, vm.hostname, reason))
@@ -387,18 +620,32 @@ class NimbusCluster(cluster_tools.ICluster):
 
         Note: If VM does not appear to be running any longer, it will be destroyed.
         """
-        # Retire not actually bad, just don't want that state overwritten
-        bad_status = ("Destroyed", "NoProxy", "ExpiredProxy")
-        special_status = ("Retiring", "TempBanned", "HeldBadReqs", "HTTPFail, BrokenPipe")
-        # Create an epr for our poll command
-        vm_epr = nimbus_xml.ws_epr_factory(vm.id, vm.clusteraddr, vm.clusterport)
+        (ws_cmd, env) = self._poll_command(vm)
+        (poll_return, poll_out, poll_err) = self.commands.execwait(ws_cmd, env)
+        return self._apply_poll(vm, poll_return, poll_out, poll_err)
+
+    def vm_poll_all(self, vms):
+        """Poll vms with their workspace queries run side by side, up to the
+        command service's process limit, rather than one after the other."""
+        results = self.commands.execwait_all([self._poll_command(vm) for vm in vms])
+        return [self._apply_poll(vm, poll_return, poll_out, poll_err)
+                for (vm, (poll_return, poll_out, poll_err)) in zip(vms, results)]
+
+    def _poll_command(self, vm):
+        """Returns the workspace poll command of vm and its environment."""
+        # Get the epr for our poll command
+        vm_epr = self.commands.epr(vm)
 
         # Create workspace poll command
         ws_cmd = self.vmpoll_factory(vm_epr)
         log.verbose("Polling Nimbus with:\n%s" % string.join(ws_cmd, " "))
+        return (ws_cmd, vm.get_env())
 
-        # Execute the workspace poll (wait, retrieve return code, stdout, and stderr)
-        (poll_return, poll_out, poll_err) = self.vm_execwait(ws_cmd, env=vm.get_env())
+    def _apply_poll(self, vm, poll_return, poll_out, poll_err):
+        """Update vm from the output of its workspace poll, returning its status."""
+        # Retire not actually bad, just don't want that state overwritten
+        bad_status = ("Destroyed", "NoProxy", "ExpiredProxy")
+        special_status = ("Retiring", "TempBanned", "HeldBadReqs", "HTTPFail, BrokenPipe")
         poll_out = poll_out + poll_err
 
         with self.vms_lock:
@@ -443,8 +690,6 @@ class NimbusCluster(cluster_tools.ICluster):
                     poll_err = "No Error output returned."
                 log.warning("There was a problem polling VM %s: %s %s %s" % (vm.id, poll_out, poll_err, poll_return))
 
-        # Tidy up and return
-        os.remove(vm_epr)
         vm.lastpoll = int(time.time())
         return vm.status
 
@@ -690,6 +935,7 @@ class NimbusCluster(cluster_tools.ICluster):
             self.net_slots[vm.network] = remaining_net_slots
             if self.total_cpu_cores != -1:
                 self.total_cpu_cores = remaining_cores
+            self.capacity_changed()
 
     def resource_return(self, vm):
         """Returns the resources taken by the passed in VM to the Cluster's internal
@@ -710,3 +956,39 @@ class NimbusCluster(cluster_tools.ICluster):
             remaining_total_slots += self.net_slots[pool]
         return (self.max_slots - remaining_total_slots) / float(self.max_slots)
 
+
+def _cluster_from_config(cloud_config, section, common):
+    """Build a NimbusCluster from its section of the cloud resources config."""
+    nets = splitnstrip(",", get_or_none(cloud_config, section, "networks"))
+    if len(nets) > 1:
+        # Split the vm_slots too
+        slots = map(int, splitnstrip(",", get_or_none(cloud_config, section, "vm_slots")))
+    else:
+        slots = [int(get_or_none(cloud_config, section, "vm_slots"))]
+    net_slots = {}
+    for x in range(len(nets)):
+        net_slots[nets[x]] = slots[x]
+    total_slots = sum(slots)
+    return NimbusCluster(name = section,
+            host = get_or_none(cloud_config, section, "host"),
+            port = get_or_none(cloud_config, section, "port"),
+            cloud_type = get_or_none(cloud_config, section, "cloud_type"),
+            memory = map(int, splitnstrip(",", get_or_none(cloud_config, section, "memory"))),
+            max_vm_mem = common['max_vm_mem'],
+            cpu_archs = splitnstrip(",", get_or_none(cloud_config, section, "cpu_archs")),
+            networks = nets,
+            vm_slots = total_slots,
+            cpu_cores = int(get_or_none(cloud_config, section, "cpu_cores")),
+            storage = int(get_or_none(cloud_config, section, "storage")),
+            max_vm_storage = common['max_vm_storage'],
+            netslots = net_slots,
+            hypervisor = common['hypervisor'],
+            vm_lifetime = get_or_none(cloud_config, section, "vm_lifetime"),
+            image_attach_device = get_or_none(cloud_config, section, "image_attach_device"),
+            scratch_attach_device = get_or_none(cloud_config, section, "scratch_attach_device"),
+            boot_timeout = get_or_none(cloud_config, section, "boot_timeout"),
+            total_cpu_cores = common['total_cpu_cores'],
+            temp_lease_storage = get_or_none(cloud_config, section, "temp_lease_storage"),
+            )
+
+cluster_tools.register_cloud_type("Nimbus", _cluster_from_config)
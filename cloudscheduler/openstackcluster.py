@@ -9,9 +9,17 @@ import subprocess
 import cluster_tools
 import cloudscheduler.config as config
 import cloudscheduler.utilities as utilities
+from cloudscheduler.utilities import get_or_none
+from cloudscheduler.utilities import splitnstrip
 from cloudscheduler.job_management import _attr_list_to_dict
 
 log = utilities.get_cloudscheduler_logger()
+try:
+    import novaclient.v1_1.client as nvclient
+    import novaclient.exceptions
+    import keystoneclient.v2_0.client as ksclient
+except ImportError:
+    nvclient = None
 
 class OpenStackCluster(cluster_tools.ICluster):
     VM_STATES = {
@@ -21,6 +29,14 @@ class OpenStackCluster(cluster_tools.ICluster):
             "terminated" : "Shutdown",
             "error" : "Error",
     }
+    # Most age, in seconds, of a server listing shared by vm_poll calls
+    LISTING_MAX_AGE = 30
+    # Seconds between full listings, the listings in between only asking
+    # for the servers changed since the last one
+    FULL_SYNC_INTERVAL = 600
+    # Seconds a changes-since listing reaches back, to cover clock skew
+    CHANGES_SINCE_MARGIN = 60
+
     def __init__(self, name="Dummy Cluster", host="localhost", cloud_type="Dummy",
                  memory=[], max_vm_mem= -1, cpu_archs=[], networks=[], vm_slots=0,
                  cpu_cores=0, storage=0,
@@ -34,10 +50,7 @@ class OpenStackCluster(cluster_tools.ICluster):
                          memory=memory, max_vm_mem=max_vm_mem, cpu_archs=cpu_archs, networks=networks,
                          vm_slots=vm_slots, cpu_cores=cpu_cores,
                          storage=storage, hypervisor=hypervisor, boot_timeout=boot_timeout)
-        try:
-            import novaclient.v1_1.client as nvclient
-            import keystoneclient.v2_0.client as ksclient
-        except:
+        if nvclient == None:
                 print "Unable to import novaclient - cannot use native openstack cloudtypes"
                 sys.exit(1)
         if not security_group:
@@ -62,7 +75,32 @@ class OpenStackCluster(cluster_tools.ICluster):
         self.vm_domain_name = vm_domain_name if vm_domain_name != None else ""
         self.reverse_dns_lookup = reverse_dns_lookup in ['True', 'true', 'TRUE']
         self.placement_zone = placement_zone
+        # server id -> (status, name) as of the last sync
+        self.servers = {}
+        self.synced = 0
+        self.full_synced = 0
+        self.changes_since = True
+        # Servers of the tenant that aren't any of the cluster's VMs, id -> name
+        self.orphan_servers = {}
+
+    def __setstate__(self, state):
+        """Override to work with pickle module."""
+        cluster_tools.ICluster.__setstate__(self, state)
+        if 'servers' not in state:
+            self.servers = {}
+            self.synced = 0
+            self.full_synced = 0
+            self.changes_since = True
+            self.orphan_servers = {}
     
+    def vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations):
+        args = cluster_tools.ICluster.vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations)
+        args.update({'vm_image':job.req_ami,
+                     'instance_type':job.instance_type,
+                     'maximum_price':job.maximum_price,
+                     'securitygroup':job.req_security_group})
+        return args
+
     def vm_create(self, vm_name, vm_type, vm_user, vm_networkassoc, vm_cpuarch,
                   vm_image, vm_mem, vm_cores, vm_storage, customization=None,
                   vm_keepalive=0, instance_type="", job_per_core=False, 
@@ -70,8 +108,12 @@ class OpenStackCluster(cluster_tools.ICluster):
         """ Create a VM on OpenStack."""
         nova = self._get_creds_nova()
         if len(key_name) > 0:
-            if not nova.keypairs.findall(name=key_name):
-                key_name = ""
+            try:
+                if not nova.keypairs.findall(name=key_name):
+                    key_name = ""
+            except:
+                self.connections.failed()
+                raise
         try:
             image = vm_image[self.name]
         except:
@@ -106,7 +148,11 @@ class OpenStackCluster(cluster_tools.ICluster):
                 log.debug("No default instance type found for %s, trying single default" % self.network_address)
                 i_type = self.DEFAULT_INSTANCE_TYPE        
         
-        instance = nova.servers.create(image=image, flavor=i_type, key_name=key_name)
+        try:
+            instance = nova.servers.create(image=image, flavor=i_type, key_name=key_name)
+        except:
+            self.connections.failed()
+            raise
         #print instance
         instance_id = instance.id
         
@@ -140,8 +186,12 @@ class OpenStackCluster(cluster_tools.ICluster):
     def vm_destroy(self, vm, return_resources=True, reason=""):
         """ Destroy a VM on OpenStack."""
         nova = self._get_creds_nova()
-        instance = nova.servers.get(vm.id)
-        ret = instance.delete()
+        try:
+            instance = nova.servers.get(vm.id)
+            ret = instance.delete()
+        except:
+            self.connections.failed()
+            raise
         #print 'delete ret %s' % ret
         
         # Delete references to this VM
@@ -153,19 +203,124 @@ class OpenStackCluster(cluster_tools.ICluster):
         return 0
     def vm_poll(self, vm):
         """ Query OpenStack for status information of VMs."""
+        if time.time() - self.synced >= self.LISTING_MAX_AGE:
+            self._sync()
+        return self._update_vm(vm)
+
+    def vm_poll_all(self, vms):
+        """Sync the cluster's servers with one listing for the polling cycle
+        and update each of vms from it."""
+        self._sync()
+        return [self._update_vm(vm) for vm in vms]
+
+    def _sync(self):
+        """List the tenant's servers, only those changed since the last
+        listing where nova supports changes-since, except for a full listing
+        every FULL_SYNC_INTERVAL seconds, and report the orphan servers."""
         nova = self._get_creds_nova()
-        instance = nova.servers.get(vm.id)
+        started = time.time()
+        full = not self.changes_since or started - self.full_synced >= self.FULL_SYNC_INTERVAL
+        try:
+            if full:
+                listed = nova.servers.list(detailed=True)
+            else:
+                since = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                      time.gmtime(self.synced - self.CHANGES_SINCE_MARGIN))
+                try:
+                    listed = nova.servers.list(detailed=True, search_opts={'changes-since': since})
+                except novaclient.exceptions.BadRequest:
+                    log.info("%s doesn't support changes-since, listing all servers from now on" % self.name)
+                    self.changes_since = False
+                    full = True
+                    listed = nova.servers.list(detailed=True)
+        except:
+            self.connections.failed()
+            raise
+
+        with self.vms_lock:
+            if full:
+                self.servers = {}
+                self.full_synced = started
+            for server in listed:
+                if server.status == "DELETED":
+                    self.servers.pop(server.id, None)
+                else:
+                    self.servers[server.id] = (server.status, server.name)
+            self.synced = started
+        self._find_orphans()
+
+    def _update_vm(self, vm):
+        """Update vm from the last sync, returning its status."""
         with self.vms_lock:
-            if vm.status != self.VM_STATES.get(instance.state, "Starting"):
+            if vm.id not in self.servers:
+                # A VM created after the sync may just not be in it yet
+                if vm.initialize_time < int(self.synced) and vm.status != "Error":
+                    log.error("%s on %s doesn't seem to exist anymore, setting status to Error" % (vm.id, self.name))
+                    vm.status = "Error"
+                    vm.last_state_change = int(time.time())
+                return vm.status
+            status = self.servers[vm.id][0]
+            if vm.status != status:
 
                 vm.last_state_change = int(time.time())
-                log.debug("VM: %s on %s. Changed from %s to %s." % (vm.id, self.name, vm.status, self.VM_STATES.get(instance.state, "Starting")))
-            vm.status = instance.status
-        pass
-    
+                log.debug("VM: %s on %s. Changed from %s to %s." % (vm.id, self.name, vm.status, status))
+            vm.status = status
+            vm.lastpoll = int(time.time())
+        return vm.status
+
+    def _find_orphans(self):
+        """Note the servers of the last sync Cloud Scheduler doesn't know
+        about, logging each once."""
+        known = set([vm.id for vm in self.vms])
+        orphans = {}
+        for (server_id, (status, name)) in self.servers.items():
+            if server_id not in known:
+                if server_id not in self.orphan_servers:
+                    log.warning("Server %s (%s) on %s isn't managed by cloud scheduler" % (name, server_id, self.name))
+                orphans[server_id] = name
+        self.orphan_servers = orphans
+
     def _get_creds_ks(self):
         """Get an auth token to Keystone."""
         return ksclient.Client(username=self.username, password=self.password, auth_url=self.auth_url, tenant_name=self.tenant_name)
     def _get_creds_nova(self):
+        """Get the authenticated Nova client, reused until it expires."""
+        return self.connections.get()
+    def _connect(self):
         """Get an auth token to Nova."""
         return nvclient.Client(username=self.username, api_key=self.password, auth_url=self.auth_url, project_id=self.tenant_name)
+    def _auth_error(self, error):
+        """Returns True if error is Nova rejecting the client's token."""
+        return isinstance(error, novaclient.exceptions.Unauthorized)
+
+
+def _cluster_from_config(cloud_config, section, common):
+    """Build an OpenStackCluster from its section of the cloud resources config."""
+    return OpenStackCluster(name = section,
+            host = get_or_none(cloud_config, section, "host"),
+            cloud_type = get_or_none(cloud_config, section, "cloud_type"),
+            memory = map(int, splitnstrip(",", get_or_none(cloud_config, section, "memory"))),
+            max_vm_mem = common['max_vm_mem'],
+            cpu_archs = splitnstrip(",", get_or_none(cloud_config, section, "cpu_archs")),
+            networks = splitnstrip(",", get_or_none(cloud_config, section, "networks")),
+            vm_slots = int(get_or_none(cloud_config, section, "vm_slots")),
+            cpu_cores = int(get_or_none(cloud_config, section, "cpu_cores")),
+            storage = int(get_or_none(cloud_config, section, "storage")),
+            access_key_id = get_or_none(cloud_config, section, "access_key_id"),
+            secret_access_key = get_or_none(cloud_config, section, "secret_access_key"),
+            username = get_or_none(cloud_config, section, "username"),
+            password = get_or_none(cloud_config, section, "password"),
+            tenant_name = get_or_none(cloud_config, section, "tenant_name"),
+            auth_url = get_or_none(cloud_config, section, "auth_url"),
+            security_group = splitnstrip(",", get_or_none(cloud_config, section, "security_group")),
+            hypervisor = common['hypervisor'],
+            key_name = get_or_none(cloud_config, section, "key_name"),
+            boot_timeout = get_or_none(cloud_config, section, "boot_timeout"),
+            secure_connection = get_or_none(cloud_config, section, "secure_connection"),
+            regions = map(str, splitnstrip(",", get_or_none(cloud_config, section, "regions"))),
+            vm_domain_name = get_or_none(cloud_config, section, "vm_domain_name"),
+            reverse_dns_lookup = get_or_none(cloud_config, section, "reverse_dns_lookup"),
+            placement_zone = get_or_none(cloud_config, section, "placement_zone"),
+            )
+
+cluster_tools.register_cloud_type("OpenStackNative", _cluster_from_config)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## PLACEMENT PLANNER
+##
+## Packs the pending VM launches of a scheduling cycle against a snapshot of
+## the capacity of each cluster (VM slots, storage and per-host memory
+## entries) and decides which cluster each job should boot on.
+##
+## Two placement policies are supported:
+##   balanced - the historical behaviour, lowest cloud_score (by default the
+##              least full cluster) first
+##   bestfit  - best-fit-decreasing, jobs are packed largest first on the
+##              cluster whose memory entry they fill most tightly
+##
+## When reservation_wait is set, a job that has been unable to fit anywhere
+## for that long gets a reservation on the memory entry closest to fitting it.
+## Smaller jobs are only backfilled onto capacity outside the reservation, so
+## large jobs are not starved by a steady stream of small VMs.
+##
+## For job_per_core jobs, pack_job_per_core groups compatible pending jobs
+## into the slots of one VM and sizes the VM to the number of jobs it will
+## run, so no cores sit idle waiting for jobs that do not exist.
+##
+from __future__ import with_statement
+
+import time
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+from cloudscheduler.mem_allocator import select_mementry
+from cloudscheduler.cloud_health import cloud_score
+
+log = utilities.get_cloudscheduler_logger()
+
+
+class Reservation():
+    """A hold on a cluster memory entry, a VM slot and storage for a job."""
+    def __init__(self, job, cluster, mementry):
+        self.job_id = job.id
+        self.cluster = cluster
+        self.mementry = mementry
+        self.memory = job.req_memory
+        self.storage = job.req_storage
+
+    def __repr__(self):
+        return "Reservation of %s MB (entry %d) on %s for %s" % (self.memory, self.mementry,
+                                                                 self.cluster.name, self.job_id)
+
+
+class ClusterCapacity():
+    """Snapshot of the free capacity of a cluster, used to simulate placements."""
+    def __init__(self, cluster):
+        self.cluster = cluster
+        with cluster.res_lock:
+            self.vm_slots = cluster.vm_slots
+            self.storage = cluster.storageGB
+            self.memory = list(cluster.memory)
+
+    def find_mementry(self, memory, excluded=()):
+        """Same selection as ICluster.find_mementry on the snapshot, skipping
+        the excluded entries. Returns -1 if no entry fits."""
+        return select_mementry(self.memory, memory, self.cluster.mem_allocator.policy, excluded)
+
+    def checkout(self, memory, storage, mementry):
+        self.vm_slots -= 1
+        self.storage -= storage
+        self.memory[mementry] -= memory
+
+
+class PlacementPlanner():
+    """Plans where the pending launches of a scheduling cycle should go."""
+
+    def __init__(self, resource_pool, policy=None, reservation_wait=None):
+        self.resource_pool = resource_pool
+        self.policy = (policy if policy else config.placement_policy).lower()
+        if self.policy not in ("balanced", "bestfit"):
+            log.error("Unknown placement_policy %s, using balanced" % self.policy)
+            self.policy = "balanced"
+        self.reservation_wait = reservation_wait if reservation_wait != None else config.reservation_wait
+        self.plan = {}
+        self.reservations = {}
+        self.unplaceable_since = {}
+
+    def enabled(self):
+        """Returns True if planning changes anything over get_resourceBF."""
+        return self.policy != "balanced" or self.reservation_wait >= 0
+
+    @staticmethod
+    def job_size(job):
+        return (job.req_memory, job.req_cpucores, job.req_storage)
+
+    @staticmethod
+    def _requirement_signature(job):
+        return (job.req_network, job.req_cpuarch, job.req_memory, job.req_cpucores,
+                job.req_storage, tuple(sorted(job.req_ami.items())), job.req_imageloc,
+                tuple(job.target_clouds), tuple(job.req_hypervisor), tuple(job.blocked_clouds))
+
+    def _fitting(self, job):
+        return self.resource_pool.get_fitting_resources(job.req_network, job.req_cpuarch,
+                    job.req_memory, job.req_cpucores, job.req_storage, job.req_ami,
+                    job.req_imageloc, job.target_clouds, job.req_hypervisor, job.blocked_clouds)
+
+    def _potential(self, job):
+        return self.resource_pool.get_potential_fitting_resources(job.req_network, job.req_cpuarch,
+                    job.req_memory, job.req_storage, job.target_clouds, job.req_hypervisor,
+                    job.req_cpucores, job.blocked_clouds)
+
+    def _reserved_entries(self, cluster, job):
+        """Memory entries of cluster reserved for jobs other than job."""
+        return set([r.mementry for r in self.reservations.values()
+                    if r.cluster is cluster and r.job_id != job.id])
+
+    def _choose(self, job, capacities, candidates):
+        """Pick the cluster and memory entry for job from candidates on the
+        simulated capacities according to the policy. Returns (cluster, entry)
+        or (None, -1) if the job does not fit."""
+        best = None
+        best_key = None
+        for cluster in candidates:
+            capacity = capacities.get(cluster.name)
+            if not capacity:
+                continue
+            others = [r for r in self.reservations.values() if r.cluster is cluster and r.job_id != job.id]
+            held_slots = len(others)
+            held_storage = sum([r.storage for r in others])
+            if capacity.vm_slots - held_slots <= 0 or capacity.storage - held_storage < job.req_storage:
+                continue
+            entry = capacity.find_mementry(job.req_memory, self._reserved_entries(cluster, job))
+            if entry < 0:
+                continue
+            if self.policy == "bestfit":
+                key = (capacity.memory[entry] - job.req_memory, capacity.storage - job.req_storage,
+                       cloud_score(cluster))
+            else:
+                key = (cloud_score(cluster),)
+            if best_key == None or key < best_key:
+                best = (cluster, entry)
+                best_key = key
+        return best if best else (None, -1)
+
+    def _reserve(self, job, capacities, potential):
+        """Reserve the memory entry closest to fitting job."""
+        best = None
+        for cluster in potential:
+            capacity = capacities.get(cluster.name)
+            if not capacity:
+                continue
+            reserved = self._reserved_entries(cluster, job)
+            for i in range(len(cluster.max_mem)):
+                if i in reserved or cluster.max_mem[i] < job.req_memory:
+                    continue
+                if best == None or capacity.memory[i] > best[2]:
+                    best = (cluster, i, capacity.memory[i])
+        if best:
+            reservation = Reservation(job, best[0], best[1])
+            if job.id not in self.reservations or self.reservations[job.id].cluster is not best[0] \
+               or self.reservations[job.id].mementry != best[1]:
+                log.debug("Placement planner: %s" % reservation)
+            self.reservations[job.id] = reservation
+
+    def plan_cycle(self, jobs):
+        """Plan the placement of the given pending jobs for this cycle.
+
+        Jobs are packed largest first against a snapshot of cluster capacity.
+        Jobs that fit nowhere but could fit on an empty cluster are tracked, and
+        reserved for once they have waited longer than reservation_wait.
+        """
+        self.plan = {}
+        if not self.enabled():
+            return self.plan
+        now = time.time()
+        job_ids = set([job.id for job in jobs])
+        for job_id in self.reservations.keys():
+            if job_id not in job_ids:
+                del self.reservations[job_id]
+        for job_id in self.unplaceable_since.keys():
+            if job_id not in job_ids:
+                del self.unplaceable_since[job_id]
+
+        capacities = {}
+        for cluster in self.resource_pool.resources:
+            if cluster.enabled:
+                capacities[cluster.name] = ClusterCapacity(cluster)
+
+        ordered = sorted(jobs, key=self.job_size, reverse=True)
+        fitting_by_signature = {}
+        for job in ordered:
+            if sum([c.vm_slots for c in capacities.values()]) <= 0:
+                break
+            signature = self._requirement_signature(job)
+            if signature not in fitting_by_signature:
+                fitting_by_signature[signature] = self._fitting(job)
+            (cluster, entry) = self._choose(job, capacities, fitting_by_signature[signature])
+            if cluster:
+                capacities[cluster.name].checkout(job.req_memory, job.req_storage, entry)
+                self.plan[job.id] = cluster
+                if job.id in self.reservations:
+                    log.debug("Placement planner: reserved job %s placed on %s" % (job.id, cluster.name))
+                    del self.reservations[job.id]
+                self.unplaceable_since.pop(job.id, None)
+                continue
+            if self.reservation_wait < 0:
+                continue
+            potential = self._potential(job)
+            if not potential:
+                continue
+            since = self.unplaceable_since.setdefault(job.id, now)
+            if now - since >= self.reservation_wait:
+                self._reserve(job, capacities, potential)
+        return self.plan
+
+    def get_resources(self, job):
+        """Returns the list of clusters job may boot on, best choice first.
+
+        The planned cluster comes first, followed by the other fitting clusters
+        in policy order. Clusters where the VM would land on capacity reserved
+        for another job are left out.
+        """
+        if not self.enabled():
+            return self.resource_pool.get_resourceBF(job.req_network, job.req_cpuarch,
+                    job.req_memory, job.req_cpucores, job.req_storage, job.req_ami,
+                    job.req_imageloc, job.target_clouds, job.req_hypervisor, job.blocked_clouds)
+        fitting = self._fitting(job)
+        allowed = []
+        for cluster in fitting:
+            reserved = self._reserved_entries(cluster, job)
+            if reserved and cluster.find_mementry(job.req_memory) in reserved:
+                log.verbose("Placement planner: not backfilling %s onto reserved memory on %s" % (job.id, cluster.name))
+                continue
+            allowed.append(cluster)
+        if self.policy == "bestfit":
+            def leftover(cluster):
+                entry = cluster.find_mementry(job.req_memory)
+                return (cluster.memory[entry] - job.req_memory, cluster.storageGB - job.req_storage,
+                        cloud_score(cluster))
+            allowed.sort(key=leftover)
+        else:
+            allowed.sort(key=cloud_score)
+        planned = self.plan.get(job.id)
+        if planned in allowed:
+            allowed.remove(planned)
+            allowed.insert(0, planned)
+        return allowed
+
+    def get_reservations_info(self):
+        """Returns a formatted list of the current reservations."""
+        if not self.reservations:
+            return "No placement reservations.\n"
+        output = []
+        for reservation in self.reservations.values():
+            output.append("%s\n" % reservation)
+        return ''.join(output)
+
+
+def per_slot_share(total, cores):
+    """Returns the share of total each of cores slots needs, rounded up."""
+    if cores <= 1:
+        return total
+    return -(-total // cores)
+
+
+def vm_fits_job(vm, job):
+    """True if vm, an existing VM, has the right attributes to run job."""
+    (memory, cpucores, storage) = (job.req_memory, job.req_cpucores, job.req_storage)
+    if config.job_per_core_packing and getattr(vm, "job_per_core", False) and job.job_per_core:
+        # Packed VMs are sized per slot, each job needs one core
+        memory = per_slot_share(job.req_memory, job.req_cpucores) * vm.cpucores
+        storage = per_slot_share(job.req_storage, job.req_cpucores) * vm.cpucores
+        cpucores = min(vm.cpucores, job.req_cpucores)
+    return vm.memory >= memory and vm.network in job.req_network and vm.cpuarch == job.req_cpuarch \
+        and vm.cpucores >= cpucores and vm.storage >= storage \
+        and (vm.image == job.req_imageloc or vm.image == job.req_ami) \
+        and vm.uservmtype == job.uservmtype
+
+
+class SlotPack():
+    """The size of a job_per_core VM and the jobs chosen to fill its slots."""
+    def __init__(self, cores, memory, storage, jobs):
+        self.cores = cores
+        self.memory = memory
+        self.storage = storage
+        self.jobs = jobs
+
+    def __repr__(self):
+        return "SlotPack of %d cores, %d MB, %d GB for %s" % (self.cores, self.memory, self.storage,
+                                                              [job.id for job in self.jobs])
+
+
+def pack_job_per_core(job, candidates):
+    """Pick the jobs to run on a job_per_core VM booted for job and size it.
+
+    Keywords:
+        job        - the job the VM is being booted for, its declared VM is the
+                     largest VM the pack can use
+        candidates - pending jobs that can share a VM with job (Job.can_share_vm)
+
+    Candidates whose per-slot memory and storage fit in a slot of job's VM are
+    added, in priority order, until the VM is full. The core count is the
+    number of jobs packed, never more than any packed job declared, and the
+    memory and storage are scaled down to match, so no slot is left idle.
+    Returns a SlotPack, holding only job if it is not a job_per_core job.
+    """
+    if not job.job_per_core or job.req_cpucores <= 1:
+        return SlotPack(job.req_cpucores, job.req_memory, job.req_storage, [job])
+
+    slot_memory = per_slot_share(job.req_memory, job.req_cpucores)
+    slot_storage = per_slot_share(job.req_storage, job.req_cpucores)
+    max_cores = job.req_cpucores
+    packed = [job]
+    for other in sorted(candidates, key=lambda j: j.get_priority(), reverse=True):
+        if len(packed) >= max_cores:
+            break
+        if other.id == job.id or other.banned or other.status == other.SCHEDULED:
+            continue
+        if other.req_cpucores < len(packed) + 1:
+            continue
+        if per_slot_share(other.req_memory, other.req_cpucores) > slot_memory or \
+           per_slot_share(other.req_storage, other.req_cpucores) > slot_storage:
+            continue
+        packed.append(other)
+        max_cores = min(max_cores, other.req_cpucores)
+
+    cores = len(packed)
+    if cores == job.req_cpucores:
+        return SlotPack(job.req_cpucores, job.req_memory, job.req_storage, packed)
+    return SlotPack(cores, slot_memory * cores, slot_storage * cores, packed)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## VM POLL SCHEDULE
+##
+## Decides which VMs the VM poller polls on each cycle. Every VM has a time
+## its next poll is due, kept in a heap, so a cycle only takes the VMs that
+## are due instead of checking every VM of every cloud.
+##
+## After each poll the VM's next poll is set vm_poll_intervals[state]
+## seconds ahead (vm_poller_interval for the states not listed), varied by up
+## to vm_poll_jitter of the interval so VMs booted together spread out.
+## Events such as a VM dropping out of condor pull its next poll in to now.
+##
+## At most vm_poll_budget VMs of a cloud are taken per cycle; the others
+## stay due and, being the earliest, are taken first next cycle.
+##
+from __future__ import with_statement
+
+import time
+import heapq
+import random
+import threading
+from collections import defaultdict
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+
+class PollSchedule():
+    """Heap of the times the VMs of the clusters are next due a poll."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (due time, sequence number, vm key)
+        self.heap = []
+        # vm key -> (cluster, vm, sequence number of its live heap entry)
+        self.entries = {}
+        self.sequence = 0
+        self.deferred = 0
+
+    def interval(self, status):
+        """Seconds until the next poll of a VM in status, with jitter."""
+        interval = config.vm_poll_intervals.get(status, config.vm_poller_interval)
+        if config.vm_poll_jitter > 0:
+            interval *= 1 + random.uniform(-config.vm_poll_jitter, config.vm_poll_jitter)
+        return max(0, interval)
+
+    def _push(self, cluster, vm, due):
+        """Set the next poll of vm to due. The lock must be held."""
+        self.sequence += 1
+        self.entries[id(vm)] = (cluster, vm, self.sequence)
+        heapq.heappush(self.heap, (due, self.sequence, id(vm)))
+
+    def sync(self, clusters):
+        """Bring the schedule up to date with the VMs of clusters. VMs not
+        scheduled yet are added: new VMs, polled right away, and VMs of a
+        restored pool, polled an interval after their last poll. VMs moved to
+        another cluster, as ResourcePool.setup does when a cloud's
+        configuration changes, are polled through it from now on, and VMs no
+        longer in any of clusters are dropped."""
+        owners = {}
+        for cluster in clusters:
+            for vm in cluster.vms:
+                owners[id(vm)] = (cluster, vm)
+        with self.lock:
+            for (key, (cluster, vm, sequence)) in self.entries.items():
+                owner = owners.get(key)
+                if not owner or owner[1] is not vm:
+                    del self.entries[key]
+                elif owner[0] is not cluster:
+                    self.entries[key] = (owner[0], vm, sequence)
+            for cluster in clusters:
+                for vm in cluster.vms:
+                    if id(vm) not in self.entries:
+                        due = vm.lastpoll + self.interval(vm.status) if vm.lastpoll else 0
+                        self._push(cluster, vm, due)
+
+    def pop_due(self, now=None, budget=None):
+        """Take the VMs due a poll at now, at most budget (vm_poll_budget by
+        default, -1 for no limit) per cloud. Returns a dict of cluster to its
+        due VMs, earliest first. The VMs taken must be given back with
+        reschedule."""
+        now = now if now != None else time.time()
+        budget = budget if budget != None else config.vm_poll_budget
+        due = defaultdict(list)
+        over_budget = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                (when, sequence, key) = heapq.heappop(self.heap)
+                entry = self.entries.get(key)
+                if not entry or entry[2] != sequence:
+                    # Rescheduled or expedited since
+                    continue
+                (cluster, vm, _) = entry
+                if vm not in cluster.vms:
+                    del self.entries[key]
+                    continue
+                if budget >= 0 and len(due[cluster]) >= budget:
+                    over_budget.append((when, sequence, key))
+                    continue
+                due[cluster].append(vm)
+            for item in over_budget:
+                heapq.heappush(self.heap, item)
+            self.deferred = len(over_budget)
+        if over_budget:
+            log.verbose("Poll budget reached, %d due VMs left for the next cycle" % len(over_budget))
+        return due
+
+    def reschedule(self, cluster, vm, status, now=None):
+        """Set the next poll of vm, just polled in status."""
+        now = now if now != None else time.time()
+        with self.lock:
+            self._push(cluster, vm, now + self.interval(status))
+
+    def expedite(self, cluster, vm, reason=""):
+        """Pull the next poll of vm in to now."""
+        log.verbose("Polling VM %s early: %s" % (vm.id, reason))
+        with self.lock:
+            self._push(cluster, vm, 0)
+
+    def next_due(self, vm):
+        """Time vm is next due a poll, or None if it isn't scheduled."""
+        with self.lock:
+            entry = self.entries.get(id(vm))
+            if not entry:
+                return None
+            for (when, sequence, key) in self.heap:
+                if sequence == entry[2]:
+                    return when
+            return None
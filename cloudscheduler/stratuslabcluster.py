@@ -6,7 +6,10 @@ import os
 import ConfigParser
 import threading
 from stratuslab.Exceptions import OneException
+from stratuslab.Image import Image
 import cloudscheduler.utilities as utilities
+from cloudscheduler.utilities import get_or_none
+from cloudscheduler.utilities import splitnstrip
 import base64
 
 log = utilities.get_cloudscheduler_logger()
@@ -107,6 +110,22 @@ class StratusLabCluster(cluster_tools.ICluster):
             log.error("Contextualization file '%s' is not valid. Proceeding without contextualization..." % str(contextualization) )
 
         self.__runnerIds = {}
+
+    def context_cloud_type(self):
+        return "stratuslab"
+
+    def vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations):
+        args = cluster_tools.ICluster.vm_create_args(self, job, vm_mem, vm_cores, vm_storage, customizations)
+        args.update({'vm_image':job.req_image_id,
+                     'vm_loc':job.req_imageloc})
+        return args
+
+    def fits_image(self, ami, imageloc):
+        # Only images that can be downloaded from the Marketplace
+        return imageloc != "" and (Image.isDiskId(imageloc) or Image.isImageId(imageloc))
+
+    def banned_image(self, ami, imageloc):
+        return imageloc
      
             
     def vm_create(self, vm_name, vm_type = "CernVM", vm_user = "root", vm_networkassoc = "", vm_cpuarch = "",
@@ -292,3 +311,20 @@ class StratusLabCluster(cluster_tools.ICluster):
                 del self.__runnerIds[key]
 
 
+def _cluster_from_config(cloud_config, section, common):
+    """Build a StratusLabCluster from its section of the cloud resources config."""
+    return StratusLabCluster(name = section,
+            host = get_or_none(cloud_config, section, "host"),
+            cloud_type = get_or_none(cloud_config, section, "cloud_type"),
+            memory = map(int, splitnstrip(",", get_or_none(cloud_config, section, "memory"))),
+            max_vm_mem = common['max_vm_mem'],
+            cpu_archs = splitnstrip(",", get_or_none(cloud_config, section, "cpu_archs")),
+            networks = splitnstrip(",", get_or_none(cloud_config, section, "networks")),
+            vm_slots = int(get_or_none(cloud_config, section, "vm_slots")),
+            cpu_cores = int(get_or_none(cloud_config, section, "cpu_cores")),
+            storage = int(get_or_none(cloud_config, section, "storage")),
+            hypervisor = common['hypervisor'],
+            contextualization = get_or_none(cloud_config, section, "contextualization")
+            )
+
+cluster_tools.register_cloud_type("StratusLab", _cluster_from_config)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # utilities.py - utility functions not specific to cloud scheduler
 
+from __future__ import with_statement
 import os
 import sys
 import socket
@@ -9,6 +10,9 @@ import ConfigParser
 import subprocess
 import time
 import errno
+import resource
+import threading
+from contextlib import contextmanager
 from urlparse import urlparse
 from datetime import datetime
 import config
@@ -66,6 +70,12 @@ def splitnstrip(sep, str):
     """Return a list of items trimed of excess whitespace from a string(typically comma separated)."""
     return [x.strip() for x in str.split(sep)];
 
+def hashable(value):
+    """A dict, such as a job's ami, as a value usable in a cache key."""
+    if isinstance(value, dict):
+        return tuple(sorted(value.items()))
+    return value
+
 
 def get_globus_path(executable="grid-proxy-init"):
     """
@@ -367,3 +377,221 @@ def check_popen_timeout(process, timeout=180):
     return ret
 
 
+
+# Per-thread rusage is Linux only and not exposed by the resource module
+# before Python 3.2; fall back to process wide CPU time if unavailable.
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", 1)
+
+def thread_cpu_time():
+    """Returns the user + system CPU time in seconds used by the calling thread."""
+    try:
+        usage = resource.getrusage(RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    except (ValueError, resource.error):
+        return time.clock()
+
+class CycleProfiler():
+    """Records the wall-clock and CPU time of each named phase of a thread's
+    cycle, keeping a rolling history of the last N cycles for each phase.
+    """
+    # Upper bounds (seconds) of the histogram buckets, the last bucket is open
+    BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+    def __init__(self, name, history=None, slow_threshold=None):
+        """Initializes a new profiler.
+
+        Keywords:
+        name - the name of the thread being profiled, used in reports
+        history - number of samples kept per phase, default profile_history
+        slow_threshold - cycles taking longer (seconds) are logged with a
+                         phase breakdown, default slow_cycle_threshold
+        """
+        self.name = name
+        self.history = history if history else config.profile_history
+        self.slow_threshold = slow_threshold if slow_threshold != None else config.slow_cycle_threshold
+        self.lock = threading.Lock()
+        self.phase_wall = {}
+        self.phase_cpu = {}
+        self.phase_order = []
+        self.cycle_wall = CircleQueue(self.history)
+        self.cycle_cpu = CircleQueue(self.history)
+        self.cycles = 0
+        self.slow_cycles = 0
+        self.current = {}
+        self.cycle_start = None
+
+    def start_cycle(self):
+        """Marks the beginning of a new cycle."""
+        self.current = {}
+        self.cycle_start = (time.time(), thread_cpu_time())
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager timing the enclosed block as the named phase.
+        A phase entered more than once in a cycle accumulates its times.
+        """
+        wall_start = time.time()
+        cpu_start = thread_cpu_time()
+        try:
+            yield
+        finally:
+            wall = time.time() - wall_start
+            cpu = thread_cpu_time() - cpu_start
+            (prev_wall, prev_cpu) = self.current.get(name, (0.0, 0.0))
+            self.current[name] = (prev_wall + wall, prev_cpu + cpu)
+
+    def end_cycle(self):
+        """Marks the end of the cycle, records the phase times and logs a
+        breakdown if the cycle was slow. Returns the cycle wall-clock time.
+        """
+        if not self.cycle_start:
+            return 0
+        wall = time.time() - self.cycle_start[0]
+        cpu = thread_cpu_time() - self.cycle_start[1]
+        with self.lock:
+            self.cycles += 1
+            self.cycle_wall.append(wall)
+            self.cycle_cpu.append(cpu)
+            for name, (phase_wall, phase_cpu) in self.current.iteritems():
+                if name not in self.phase_wall:
+                    self.phase_order.append(name)
+                    self.phase_wall[name] = CircleQueue(self.history)
+                    self.phase_cpu[name] = CircleQueue(self.history)
+                self.phase_wall[name].append(phase_wall)
+                self.phase_cpu[name].append(phase_cpu)
+        if self.slow_threshold > 0 and wall > self.slow_threshold:
+            self.slow_cycles += 1
+            log = get_cloudscheduler_logger()
+            breakdown = ["%s %.2fs (cpu %.2fs)" % (name, phase_wall, phase_cpu) for name, (phase_wall, phase_cpu)
+                         in sorted(self.current.iteritems(), key=lambda x: x[1][0], reverse=True)]
+            log.warning("Slow %s cycle: %.2fs wall, %.2fs cpu. Phases: %s" % (self.name, wall, cpu, ", ".join(breakdown)))
+        self.cycle_start = None
+        return wall
+
+    @staticmethod
+    def histogram(samples):
+        """Returns the count of samples falling in each of the BUCKETS, plus
+        a final count for samples above the last bucket.
+        """
+        counts = [0 for x in range(0, len(CycleProfiler.BUCKETS) + 1)]
+        for sample in samples:
+            for i, bound in enumerate(CycleProfiler.BUCKETS):
+                if sample <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+        return counts
+
+    @staticmethod
+    def percentile(samples, pct):
+        """Returns the pct percentile (0-100) of the samples, 0 if empty."""
+        if not samples:
+            return 0
+        ordered = sorted(samples)
+        index = int(round((pct / 100.0) * (len(ordered) - 1)))
+        return ordered[index]
+
+    def get_stats(self):
+        """Returns a dict of phase name to a dict of the rolling statistics
+        for that phase, the whole cycle is reported under the 'cycle' key.
+        """
+        stats = {}
+        with self.lock:
+            phases = [("cycle", self.cycle_wall, self.cycle_cpu)]
+            phases.extend([(name, self.phase_wall[name], self.phase_cpu[name]) for name in self.phase_order])
+            for name, wall_queue, cpu_queue in phases:
+                wall = [x for x in wall_queue.get() if x != None]
+                cpu = [x for x in cpu_queue.get() if x != None]
+                if not wall:
+                    continue
+                stats[name] = {'count': len(wall),
+                               'wall_avg': sum(wall) / len(wall),
+                               'wall_p50': self.percentile(wall, 50),
+                               'wall_p95': self.percentile(wall, 95),
+                               'wall_max': max(wall),
+                               'cpu_avg': sum(cpu) / len(cpu),
+                               'cpu_max': max(cpu),
+                               'histogram': self.histogram(wall)}
+        return stats
+
+    def get_report(self):
+        """Returns a formatted report of the phase statistics and histograms."""
+        stats = self.get_stats()
+        output = []
+        output.append("%s: %d cycles, %d slow (> %ss)\n" % (self.name, self.cycles, self.slow_cycles, self.slow_threshold))
+        if not stats:
+            return ''.join(output)
+        output.append("%-32s %6s %9s %9s %9s %9s %9s %9s\n" % ("Phase", "Count", "Wall avg", "Wall p50",
+                      "Wall p95", "Wall max", "CPU avg", "CPU max"))
+        for name in ["cycle"] + self.phase_order:
+            if name not in stats:
+                continue
+            s = stats[name]
+            output.append("%-32s %6d %9.3f %9.3f %9.3f %9.3f %9.3f %9.3f\n" % (name[:32], s['count'], s['wall_avg'],
+                          s['wall_p50'], s['wall_p95'], s['wall_max'], s['cpu_avg'], s['cpu_max']))
+        output.append("Wall-clock histograms (bucket upper bounds in seconds):\n")
+        header = ["%6s" % x for x in self.BUCKETS]
+        header.append("%6s" % "inf")
+        output.append("%-32s %s\n" % ("Phase", " ".join(header)))
+        for name in ["cycle"] + self.phase_order:
+            if name not in stats:
+                continue
+            output.append("%-32s %s\n" % (name[:32], " ".join(["%6d" % x for x in stats[name]['histogram']])))
+        return ''.join(output)
+
+class EventBus():
+    """Lets threads publish named events and lets other threads sleep until
+    an event they subscribed to is published, their timeout expires, or they
+    are woken up (e.g. to shut down).
+    """
+    NEW_IDLE_JOBS = "new idle jobs"
+    VM_STATE_CHANGED = "VM state changed"
+    MACHINES_CHANGED = "machines changed"
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.subscriptions = {}
+        self.pending = {}
+        self.woken = set()
+
+    def subscribe(self, subscriber, events):
+        """Register subscriber (a name) for the given list of events."""
+        with self.condition:
+            self.subscriptions[subscriber] = set(events)
+            self.pending.setdefault(subscriber, set())
+
+    def publish(self, event):
+        """Publish an event, waking every subscriber of that event."""
+        with self.condition:
+            for subscriber, events in self.subscriptions.iteritems():
+                if event in events:
+                    self.pending[subscriber].add(event)
+            self.condition.notifyAll()
+
+    def wake(self, subscriber):
+        """Wake up subscriber if it is waiting, or make its next wait return."""
+        with self.condition:
+            self.woken.add(subscriber)
+            self.condition.notifyAll()
+
+    def wait(self, subscriber, timeout):
+        """Sleep up to timeout seconds, returning early if an event subscribed
+        to by subscriber is published or it is woken up. Returns the set of
+        events published since the last wait, empty on timeout or wake up.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                if subscriber in self.woken:
+                    self.woken.discard(subscriber)
+                    break
+                if self.pending.get(subscriber):
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            events = self.pending.get(subscriber, set())
+            self.pending[subscriber] = set()
+        return events
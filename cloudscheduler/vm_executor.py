@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## VM CREATION EXECUTOR
+##
+## Runs the VM create calls of the clouds (Nimbus subprocesses, boto calls,
+## GCE inserts, nova boots...) on a bounded pool of worker threads so that
+## they don't hold up the scheduler loop.
+##
+## At most vm_create_threads create calls run at once, and at most
+## vm_create_threads_per_cloud of them against any one cloud. Calls for a
+## cloud at its limit wait in that cloud's queue while the workers go on
+## with the other clouds, taking turns between clouds, so one slow cloud
+## can't stall the launches on the others.
+##
+## submit() returns a CreateFuture straight away. Finished futures are
+## handed back by completed(), for the caller to apply their results on
+## its own thread.
+##
+## Calls submitted with a batch key and batch function can be coalesced:
+## when a worker takes a call, the calls queued behind it for the same cloud
+## with the same key (up to MAX_BATCH) are taken with it, and the batch
+## function is called once with the list of their arguments. This is how
+## identical launches waiting on a busy cloud become one multi-instance
+## request.
+##
+from __future__ import with_statement
+
+import sys
+import threading
+from collections import defaultdict, deque
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+
+class CreateFuture():
+    """The pending result of a call submitted to a VMCreateExecutor."""
+
+    def __init__(self, cloud, function, args, tag=None, batch_key=None, batch_function=None):
+        self.cloud = cloud
+        self.function = function
+        self.args = args
+        self.tag = tag
+        self.batch_key = batch_key
+        self.batch_function = batch_function
+        self.value = None
+        self.exc_info = None
+        self.finished = threading.Event()
+
+    def run(self):
+        try:
+            self.value = self.function(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+        self.finished.set()
+
+    def set_result(self, value=None, exc_info=None):
+        """Finish the future with the part of a batch call's result for it."""
+        self.value = value
+        self.exc_info = exc_info
+        self.finished.set()
+
+    def done(self):
+        return self.finished.isSet()
+
+    def result(self, timeout=None):
+        """Returns the value returned by the call, or raises the exception it
+        raised. Waits up to timeout seconds (forever if None) for the call to
+        finish, returning None if it hasn't."""
+        self.finished.wait(timeout)
+        if not self.done():
+            return None
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+def run_batch(futures):
+    """Run the call of a single future, or the shared batch function of a
+    list of coalesced futures, which returns one value per future."""
+    if len(futures) == 1:
+        futures[0].run()
+        return
+    try:
+        values = futures[0].batch_function([future.args for future in futures])
+    except:
+        exc_info = sys.exc_info()
+        for future in futures:
+            future.set_result(exc_info=exc_info)
+        return
+    for (future, value) in zip(futures, values):
+        future.set_result(value)
+
+
+class VMCreateExecutor():
+    """Bounded pool of worker threads with a limit on the calls per cloud."""
+
+    # Most calls coalesced into one batch call
+    MAX_BATCH = 100
+
+    def __init__(self, max_workers=None, max_per_cloud=None, on_done=None):
+        """on_done - called with each future as it finishes, on the worker thread"""
+        self.max_workers = max(1, max_workers if max_workers != None else config.vm_create_threads)
+        self.max_per_cloud = max(1, max_per_cloud if max_per_cloud != None else config.vm_create_threads_per_cloud)
+        self.on_done = on_done
+        self.condition = threading.Condition()
+        self.queues = defaultdict(deque)
+        # Clouds with queued calls, in the order they get a worker
+        self.turns = deque()
+        self.running = defaultdict(int)
+        self.finished = []
+        self.workers = []
+        self.idle = 0
+        self.quit = False
+
+    def submit(self, cloud, function, args=(), tag=None, batch_key=None, batch_function=None):
+        """Queue function(*args), a create call against cloud (a name), and
+        return its CreateFuture. tag is kept on the future for the caller.
+        Queued calls with the same batch_key (not None) may instead be run
+        together by batch_function(list of args), which must return the
+        value of each call, in order."""
+        future = CreateFuture(cloud, function, args, tag, batch_key, batch_function)
+        with self.condition:
+            if self.quit:
+                raise RuntimeError("VM creation executor is shut down")
+            self.queues[cloud].append(future)
+            if cloud not in self.turns:
+                self.turns.append(cloud)
+            if self.idle == 0 and len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, name="VMCreate-%d" % len(self.workers))
+                worker.setDaemon(True)
+                self.workers.append(worker)
+                worker.start()
+            self.condition.notifyAll()
+        return future
+
+    def _next(self):
+        """Take the next queued call of a cloud under its limit, along with
+        the queued calls of that cloud it can be batched with, or None.
+        The condition must be held."""
+        for _ in range(len(self.turns)):
+            cloud = self.turns.popleft()
+            if self.running[cloud] >= self.max_per_cloud:
+                self.turns.append(cloud)
+                continue
+            queue = self.queues[cloud]
+            futures = [queue.popleft()]
+            key = futures[0].batch_key
+            if key != None:
+                for future in list(queue):
+                    if len(futures) >= self.MAX_BATCH:
+                        break
+                    if future.batch_key == key:
+                        queue.remove(future)
+                        futures.append(future)
+            if queue:
+                self.turns.append(cloud)
+            else:
+                del self.queues[cloud]
+            self.running[cloud] += 1
+            return futures
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                futures = self._next()
+                while futures == None:
+                    if self.quit and not self.queues:
+                        return
+                    self.idle += 1
+                    self.condition.wait()
+                    self.idle -= 1
+                    futures = self._next()
+            run_batch(futures)
+            cloud = futures[0].cloud
+            with self.condition:
+                self.running[cloud] -= 1
+                if not self.running[cloud]:
+                    del self.running[cloud]
+                self.finished.extend(futures)
+                self.condition.notifyAll()
+            if self.on_done:
+                for future in futures:
+                    try:
+                        self.on_done(future)
+                    except:
+                        log.exception("Problem running VM creation callback")
+
+    def completed(self):
+        """Returns the futures that finished since the last call."""
+        with self.condition:
+            finished = self.finished
+            self.finished = []
+        return finished
+
+    def in_flight(self, cloud=None):
+        """Number of calls queued, or batches of calls running, against
+        cloud if given."""
+        with self.condition:
+            if cloud != None:
+                return len(self.queues.get(cloud, ())) + self.running.get(cloud, 0)
+            return sum([len(queue) for queue in self.queues.values()]) + sum(self.running.values())
+
+    def shutdown(self, wait=True):
+        """Stop taking calls. The queued calls are still run; if wait, returns
+        once they have all finished."""
+        with self.condition:
+            self.quit = True
+            self.condition.notifyAll()
+        if wait:
+            for worker in list(self.workers):
+                worker.join()
+
+
+class VMLaunch():
+    """A VM being created for a job, tried on each of its fitting resources
+    in turn until one of them creates it.
+
+    job        - the job the VM is for
+    resources  - the fitting resources, in the order to try them
+    pack       - the SlotPack the VM is sized for, if any
+    sharing    - other jobs marked scheduled to run on the VM's other slots
+    prelaunch  - True for a VM booted ahead of forecast demand
+    """
+
+    def __init__(self, job, resources, pack=None, sharing=[], prelaunch=False):
+        self.job = job
+        self.resources = list(resources)
+        self.remaining = [resource for resource in resources if resource != None]
+        self.pack = pack
+        self.sharing = list(sharing)
+        self.prelaunch = prelaunch
+        self.customizations = None
+        self.resource = None
+        self.create_ret = None
+        if pack:
+            (self.memory, self.cores, self.storage) = (pack.memory, pack.cores, pack.storage)
+        else:
+            (self.memory, self.cores, self.storage) = (job.req_memory, job.req_cpucores, job.req_storage)
+
+    def cpu_slots(self):
+        """Number of job slots the VM will have."""
+        return self.cores if self.job.job_per_core and self.cores > 0 else 1
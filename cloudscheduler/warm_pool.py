@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## WARM VM POOL
+##
+## Keeps a few idle, registered VMs of each uservmtype on each cloud alive for
+## a while after their jobs are gone, instead of shutting them down straight
+## away, so a job of the same type arriving shortly after does not pay for a
+## full VM boot.
+##
+## At most warm_pool_size VMs are held per uservmtype and cloud, each for at
+## most warm_pool_hold_time seconds. The idle time of held VMs is charged
+## against warm_pool_budget VM-hours per day; once it is spent no more VMs
+## are held until the next day.
+##
+from __future__ import with_statement
+
+import time
+import threading
+from collections import defaultdict
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+from cloudscheduler.placement import vm_fits_job
+
+log = utilities.get_cloudscheduler_logger()
+
+
+class WarmPool():
+    """Tracks the idle VMs held back from shutdown for reuse."""
+
+    # Length of the period warm_pool_budget applies to
+    BUDGET_PERIOD = 24 * 60 * 60
+
+    def __init__(self, size=None, hold_time=None, budget=None):
+        self.size = size if size != None else config.warm_pool_size
+        self.hold_time = hold_time if hold_time != None else config.warm_pool_hold_time
+        self.budget = budget if budget != None else config.warm_pool_budget
+        self.lock = threading.RLock()
+        # (uservmtype, cloud name) -> {vm id: (vm, time held from)}
+        self.held = defaultdict(dict)
+        # ids of VMs whose hold ran out, which are not held again
+        self.released = set()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.spent = 0.0
+        self.period_start = time.time()
+        self.last_update = None
+
+    def enabled(self):
+        return self.size > 0
+
+    def budget_left(self):
+        """Returns True if idle VM time may still be spent this period."""
+        return self.budget < 0 or self.spent < self.budget * 3600
+
+    def hold(self, vm, cluster, now=None):
+        """Returns True if vm should be kept alive as a warm VM rather than
+        shut down. Only registered idle VMs are held."""
+        if not self.enabled() or not vm.idle_start or vm.override_status == "Retiring":
+            return False
+        now = now if now != None else time.time()
+        key = (vm.uservmtype, cluster.name)
+        with self.lock:
+            if vm.id in self.held[key]:
+                if now - self.held[key][vm.id][1] < self.hold_time and self.budget_left():
+                    return True
+                log.verbose("Releasing warm %s VM %s on %s" % (vm.uservmtype, vm.id, cluster.name))
+                del self.held[key][vm.id]
+                self.released.add(vm.id)
+                return False
+            if vm.id in self.released or len(self.held[key]) >= self.size or not self.budget_left():
+                return False
+            log.verbose("Holding %s VM %s on %s in the warm pool" % (vm.uservmtype, vm.id, cluster.name))
+            self.held[key][vm.id] = (vm, now)
+            return True
+
+    def claim(self, job, targets=None):
+        """Take a warm VM of the job's uservmtype, if any, for job to run on.
+        Only VMs that can run the job, on one of targets (the names of the
+        job's target clouds, any cloud if None) and not on one of the job's
+        blocked clouds, are taken. Returns True if one was found."""
+        if not self.enabled():
+            return False
+        with self.lock:
+            for (key, vms) in self.held.iteritems():
+                if key[0] != job.uservmtype or key[1] in job.blocked_clouds:
+                    continue
+                if targets != None and key[1] not in targets:
+                    continue
+                for (vm_id, (vm, since)) in vms.items():
+                    if vm.idle_start and vm.override_status != "Retiring" and vm_fits_job(vm, job):
+                        del vms[vm_id]
+                        self.hits[job.uservmtype] += 1
+                        log.debug("Warm pool hit: job %s will run on %s VM %s on %s" %
+                                  (job.id, job.uservmtype, vm.id, key[1]))
+                        return True
+            return False
+
+    def record_miss(self, uservmtype):
+        """Count a VM booted because no warm VM of uservmtype was available."""
+        if self.enabled():
+            with self.lock:
+                self.misses[uservmtype] += 1
+
+    def update(self, resource_pool, now=None):
+        """Charge the idle time of held VMs against the budget, and drop held
+        VMs that picked up a job by themselves (a hit), or are gone."""
+        now = now if now != None else time.time()
+        with self.lock:
+            if now - self.period_start >= self.BUDGET_PERIOD:
+                self.spent = 0.0
+                self.period_start = now
+            elapsed = 0 if self.last_update == None else now - self.last_update
+            self.last_update = now
+            for (key, vms) in self.held.items():
+                cluster = resource_pool.get_cluster(key[1])
+                for (vm_id, (vm, since)) in vms.items():
+                    if not cluster or vm not in cluster.vms or vm.override_status == "Retiring":
+                        del vms[vm_id]
+                    elif not vm.idle_start:
+                        self.hits[key[0]] += 1
+                        del vms[vm_id]
+                    else:
+                        self.spent += elapsed
+                if not vms:
+                    del self.held[key]
+            vm_ids = set([vm.id for c in resource_pool.resources for vm in c.vms])
+            self.released &= vm_ids
+
+    def get_warm_pool_info(self):
+        """Returns a formatted report of the warm pool and its hit rate."""
+        with self.lock:
+            if not self.enabled():
+                return "The warm VM pool is disabled.\n"
+            output = ["Warm VM pool: %d VMs held, %.2f of %s VM-hours used today\n" %
+                      (sum([len(vms) for vms in self.held.values()]), self.spent / 3600,
+                       self.budget if self.budget >= 0 else "unlimited")]
+            output.append("%-40s %-20s %6s\n" % ("UserVMType", "Cloud", "Held"))
+            for (key, vms) in sorted(self.held.items()):
+                output.append("%-40s %-20s %6d\n" % (key[0], key[1], len(vms)))
+            output.append("%-40s %8s %8s %9s\n" % ("UserVMType", "Hits", "Misses", "Hit Rate"))
+            for uservmtype in sorted(set(self.hits.keys()) | set(self.misses.keys())):
+                hits = self.hits[uservmtype]
+                misses = self.misses[uservmtype]
+                output.append("%-40s %8d %8d %8.1f%%\n" % (uservmtype, hits, misses,
+                              100.0 * hits / (hits + misses) if hits + misses else 0.0))
+            return ''.join(output)
@@ -19,6 +19,17 @@ log = utilities.get_cloudscheduler_logger()
 
 held, sys.stderr = sys.stderr, StringIO() # Hide stderr
 
+def load_cloud_scheduler():
+    """Import the cloud_scheduler script as a module, to test its threads."""
+    import imp
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    try:
+        return imp.load_source("cloud_scheduler_main",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), "cloud_scheduler"))
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+
 class ConfigParserSetsCorrectValues(unittest.TestCase):
 
     def setUp(self):
@@ -230,6 +241,86 @@ class Utilities(unittest.TestCase):
         match = match_host_with_condor_host("condor.host", "slot1@condor")
         self.assertTrue(match)
 
+    def test_cycle_profiler(self):
+        from cloudscheduler.utilities import CycleProfiler
+
+        profiler = CycleProfiler("Test", history=3, slow_threshold=0)
+        for i in range(0, 5):
+            profiler.start_cycle()
+            with profiler.phase("first"):
+                pass
+            with profiler.phase("second"):
+                pass
+            with profiler.phase("second"):
+                pass
+            profiler.end_cycle()
+
+        stats = profiler.get_stats()
+        self.assertEqual(5, profiler.cycles)
+        self.assertEqual(3, stats["cycle"]["count"])
+        self.assertEqual(3, stats["first"]["count"])
+        self.assertEqual(3, stats["second"]["count"])
+        self.assertEqual(3, sum(stats["second"]["histogram"]))
+        self.assertEqual([0, 2, 0, 0, 0, 0, 0, 0, 0, 1],
+                         CycleProfiler.histogram([0.05, 0.1, 500]))
+        self.assertTrue("second" in profiler.get_report())
+
+    def test_event_bus(self):
+        from cloudscheduler.utilities import EventBus
+
+        bus = EventBus()
+        bus.subscribe("Scheduler", [EventBus.NEW_IDLE_JOBS])
+        bus.publish(EventBus.MACHINES_CHANGED)
+        self.assertEqual(set(), bus.wait("Scheduler", 0.1))
+
+        bus.publish(EventBus.NEW_IDLE_JOBS)
+        bus.publish(EventBus.NEW_IDLE_JOBS)
+        self.assertEqual(set([EventBus.NEW_IDLE_JOBS]), bus.wait("Scheduler", 10))
+
+        bus.wake("Scheduler")
+        self.assertEqual(set(), bus.wait("Scheduler", 10))
+
+    def test_customization_cache(self):
+        from cloudscheduler.cluster_tools import ICluster
+        from cloudscheduler.customization_cache import CustomizationCache
+
+        (fd, path) = tempfile.mkstemp()
+        os.write(fd, "#!/bin/sh\n")
+        os.close(fd)
+        cache = CustomizationCache()
+        try:
+            # A file is read again only once it changes
+            content = cache.read_file(path)
+            self.assertTrue(content is cache.read_file(path))
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+            open(path, "w").write("#!/bin/bash\n")
+            os.utime(path, (1000, 1000))
+            self.assertEqual("#!/bin/bash\n", cache.read_file(path))
+            self.assertEqual(1, len(cache.blobs))
+
+            # A URL is fetched again after the TTL, and the old copy used if that fails
+            url = "file://" + path
+            self.assertTrue(cache.fetch_url(url, now=1000) is cache.read_file(path))
+            os.remove(path)
+            self.assertEqual("#!/bin/bash\n", cache.fetch_url(url, now=1001))
+            failed = 1000 + cloudscheduler.config.userdata_cache_ttl
+            self.assertEqual("#!/bin/bash\n", cache.fetch_url(url, now=failed))
+            self.assertRaises(Exception, cache.fetch_url, "file://" + path + ".missing")
+            # and while it is down it is only tried again every RETRY_INTERVAL
+            open(path, "w").write("#!/bin/zsh\n")
+            self.assertEqual("#!/bin/bash\n", cache.fetch_url(url, now=failed + cache.RETRY_INTERVAL - 1))
+            self.assertEqual("#!/bin/zsh\n", cache.fetch_url(url, now=failed + cache.RETRY_INTERVAL))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+        # The user data assembled from the same customizations is reused
+        cluster = ICluster()
+        customization = [(content, "/etc/condor/admin_userdata_test", True)]
+        user_data = cluster.vm_userdata(customization)
+        self.assertTrue(user_data is cluster.vm_userdata(list(customization)))
+        self.assertEqual(cloudscheduler.nimbus_xml.ws_optional(customization), user_data)
+
 class ResourcePoolSetup(unittest.TestCase):
 
     def setUp(self):
@@ -305,6 +396,625 @@ class ResourcePoolSetup(unittest.TestCase):
                 found_cluster1 = True
         self.assertTrue(found_cluster1)
 
+    def test_fit_index(self):
+        from cloudscheduler.cluster_tools import VM
+
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+        def fitting(memory, targets=[], blocked=[]):
+            return self.test_pool.get_fitting_resources(self.networks0, self.cpu_archs0, memory, 1, 10,
+                        "", "http://example.com/img.gz", targets, ['xen'], blocked)
+
+        self.assertEqual([cluster0, cluster1], fitting(2048))
+        self.assertEqual([], fitting(4096))
+        self.assertEqual([cluster1], fitting(1024, targets=[self.cloud_name1]))
+        self.assertEqual([cluster1], fitting(1024, blocked=[self.cloud_name0]))
+
+        # Checking out resources updates the index
+        vm = VM(id="vm0", network=self.networks0, memory=1536, mementry=0, storage=10)
+        cluster0.resource_checkout(vm)
+        self.assertEqual([cluster0, cluster1], fitting(512))
+        self.assertEqual([cluster1], fitting(1024))
+        cluster0.resource_return(vm)
+        self.assertEqual([cluster0, cluster1], fitting(1024))
+
+        cluster1.enabled = False
+        self.assertEqual([cluster0], fitting(1024))
+        self.test_pool.banned_job_resource["http://example.com/img.gz"] = [self.cloud_name0]
+        self.assertEqual([], fitting(1024))
+
+    def test_fit_index_after_unpickle(self):
+        import pickle
+        from cloudscheduler.cluster_tools import VM
+
+        cluster = self.test_pool.get_cluster(self.cloud_name0)
+        vm = VM(id="vm0", network=self.networks0, memory=512, mementry=0, storage=10)
+        cluster.resource_checkout(vm)
+        cluster.vms.append(vm)
+
+        # A cluster restored from persistence isn't in any fit index
+        copy = pickle.loads(pickle.dumps(cluster))
+        self.assertEqual(None, copy.fit_index)
+        copy.resource_return(copy.vms[0])
+        self.assertEqual(self.memory0, copy.memory[0])
+
+    def test_fit_index_rebuild_during_checkout(self):
+        import threading
+        import time
+
+        cluster = self.test_pool.get_cluster(self.cloud_name0)
+        holding = threading.Event()
+        go = threading.Event()
+        def checkout():
+            # A create worker changing the cluster's resources, as
+            # resource_checkout does, while the pool is reconfigured
+            with cluster.res_lock:
+                holding.set()
+                go.wait(5)
+                cluster.set_mementry(0, cluster.memory[0] - 512)
+        worker = threading.Thread(target=checkout)
+        rebuild = threading.Thread(target=self.test_pool.fit_index.rebuild, args=(self.test_pool.resources,))
+        for thread in (worker, rebuild):
+            thread.setDaemon(True)
+        worker.start()
+        holding.wait(5)
+        rebuild.start()
+        time.sleep(0.1)
+        go.set()
+        worker.join(5)
+        rebuild.join(5)
+        self.assertFalse(worker.isAlive() or rebuild.isAlive())
+        i = self.test_pool.fit_index.bits[id(cluster)]
+        self.assertEqual(self.memory0 - 512, self.test_pool.fit_index.free_memory[i])
+
+    def test_cloud_health_ranking(self):
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+        def ranked():
+            return self.test_pool.get_resourceBF(self.networks0, self.cpu_archs0, 1024, 1, 10,
+                        "", "http://example.com/img.gz", [], ['xen'], [])
+
+        # cluster1 is fuller, but cluster0 fails half its creates
+        cluster1.vm_slots -= 10
+        cluster0.health.record_create(30, True)
+        cluster0.health.record_create(30, False)
+        cluster1.health.record_create(30, True)
+        cluster1.health.record_registered(270)
+        self.assertEqual(1, cluster0.health.create_failures)
+        self.assertAlmostEqual(5.0, cluster1.health.boot_minutes())
+        self.assertEqual([cluster0, cluster1], ranked())
+
+        saved = cloudscheduler.config.cloud_rank_failure_weight
+        cloudscheduler.config.cloud_rank_failure_weight = 1.0
+        try:
+            self.assertEqual([cluster1, cluster0], ranked())
+            cloudscheduler.config.cloud_rank_boot_weight = 1.0
+            self.assertEqual([cluster0, cluster1], ranked())
+        finally:
+            cloudscheduler.config.cloud_rank_failure_weight = saved
+            cloudscheduler.config.cloud_rank_boot_weight = 0.0
+        self.assertTrue(self.cloud_name1 in self.test_pool.get_cloud_health_info())
+
+    def test_vm_create_executor(self):
+        import threading
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.vm_executor import VMCreateExecutor
+
+        # A reservation holds resources until the VM created under it takes them over
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        reservation = cluster0.reserve(1024, 10, "user:sl6", "user")
+        self.assertEqual(self.vm_slots0 - 1, cluster0.vm_slots)
+        self.assertEqual(1, self.test_pool.get_vm_count_user("user"))
+        with cluster0.holding(reservation):
+            mementry = cluster0.find_mementry(1024)
+            cluster0.resource_checkout(VM(id="vm0", network=self.networks0, memory=1024,
+                                       mementry=mementry, storage=10))
+        self.assertEqual([], cluster0.reservations)
+        self.assertEqual(self.vm_slots0 - 1, cluster0.vm_slots)
+        self.assertEqual([1024], cluster0.memory)
+        with cluster0.holding(cluster0.reserve(1024, 10)):
+            self.assertEqual([0], cluster0.memory)
+        self.assertEqual([1024], cluster0.memory)
+        self.assertEqual(None, cluster0.reserve(2048, 10))
+
+        # A slow cloud only holds up its own creates
+        gate = threading.Event()
+        executor = VMCreateExecutor(max_workers=3, max_per_cloud=1)
+        slow = [executor.submit(self.cloud_name0, gate.wait, (5,)) for i in range(2)]
+        fast = [executor.submit(self.cloud_name1, abs, (-i,), tag=i) for i in range(3)]
+        self.assertEqual([0, 1, 2], [future.result(5) for future in fast])
+        self.assertEqual([0, 1, 2], [future.tag for future in fast])
+        self.assertFalse(slow[1].done())
+        self.assertEqual(2, executor.in_flight(self.cloud_name0))
+        failed = executor.submit(self.cloud_name1, int, ("x",))
+        self.assertRaises(ValueError, failed.result, 5)
+        gate.set()
+        executor.shutdown()
+        self.assertTrue(slow[1].done())
+        self.assertEqual(6, len(executor.completed()))
+        self.assertEqual(0, executor.in_flight())
+
+    def test_nimbus_commands(self):
+        import threading
+        from cloudscheduler.cluster_tools import VM
+
+        cluster = self.test_pool.get_cluster(self.cloud_name0)
+        commands = []
+        destroyed = threading.Event()
+        def execwait(cmd, env=None):
+            commands.append(cmd)
+            if "--destroy" in cmd:
+                destroyed.set()
+            return (0, "State: Running", "")
+        cluster.vm_execwait = execwait
+        vms = [VM(id=str(i), clusteraddr=cluster.network_address, network=self.networks0,
+                  memory=512, mementry=0) for i in range(3)]
+        for vm in vms:
+            cluster.resource_checkout(vm)
+            cluster.vms.append(vm)
+
+        # Polls run through the service, reusing each VM's EPR file
+        self.assertEqual(["Running"] * 3, cluster.vm_poll_all(vms))
+        eprs = dict(cluster.commands.eprs)
+        self.assertEqual(["Running"] * 3, cluster.vm_poll_all(vms))
+        self.assertEqual(eprs, cluster.commands.eprs)
+        self.assertEqual(set([cmd[2] for cmd in commands]), set(eprs.values()))
+
+        # The destroy follows the shutdown without holding up the caller,
+        # and is waited for before exiting
+        cluster.VM_SHUTDOWN = 0.1
+        self.assertEqual(0, cluster.vm_destroy(vms[0]))
+        self.assertTrue(vms[0] in cluster.vms)
+        self.assertEqual(0, cluster.vm_destroy(vms[0]))
+        cluster.finish_destroys()
+        self.assertTrue(destroyed.isSet())
+        self.assertFalse(vms[0] in cluster.vms)
+        self.assertEqual(1, len([cmd for cmd in commands if "--shutdown" in cmd]))
+        self.assertFalse(os.path.exists(eprs["0"]))
+
+        # A batch, as for a full shutdown, only returns once destroyed
+        self.assertEqual(0, cluster.vm_destroy(vms[1]))
+        self.assertEqual([0, 0], cluster.vm_destroy_batch(vms[1:]))
+        self.assertEqual([], cluster.vms)
+        self.assertEqual(3, len([cmd for cmd in commands if "--shutdown" in cmd]))
+        self.assertEqual(3, len([cmd for cmd in commands if "--destroy" in cmd]))
+        self.assertEqual({}, cluster.commands.eprs)
+
+    def test_cloud_type_registry(self):
+        from cloudscheduler import cluster_tools
+        Job = cloudscheduler.job_management.Job
+
+        class ThirdPartyCluster(cluster_tools.ICluster):
+            def fits_image(self, ami, imageloc):
+                return imageloc.startswith("thirdparty://")
+
+        def from_config(cloud_config, section, common):
+            return ThirdPartyCluster(name=section, cloud_type="ThirdParty", memory=[4096],
+                                     max_vm_mem=common['max_vm_mem'], networks=["private"],
+                                     vm_slots=int(cloud_config.get(section, "vm_slots")), cpu_cores=4, storage=100)
+        cluster_tools.register_cloud_type("ThirdParty", from_config)
+
+        cloud_config = ConfigParser.RawConfigParser()
+        cloud_config.add_section("thirdparty")
+        cloud_config.set("thirdparty", "cloud_type", "thirdparty")
+        cloud_config.set("thirdparty", "vm_slots", "2")
+        cluster = cloudscheduler.cloud_management.ResourcePool._cluster_from_config(cloud_config, "thirdparty")
+        self.assertTrue(isinstance(cluster, ThirdPartyCluster))
+        self.assertEqual(2, cluster.vm_slots)
+        self.test_pool.add_resource(cluster)
+
+        def fitting(imageloc):
+            return self.test_pool.get_fitting_resources(self.networks0, self.cpu_archs0, 3072, 1, 10,
+                        "", imageloc, [], ['xen'], [])
+        self.assertEqual([cluster], fitting("thirdparty://img"))
+        self.assertEqual([], fitting("http://example.com/img.gz"))
+
+        job = Job(GlobalJobId="host#1.0#1", VMLoc="thirdparty://img", VMNetwork=self.networks0, VMMem=3072)
+        customizations = []
+        args = cluster.vm_create_args(job, 3072, 1, 10, customizations)
+        self.assertEqual(3072, args['vm_mem'])
+        self.assertEqual([("ThirdParty", "/var/lib/cloud_type")], customizations)
+
+    def test_memory_allocator(self):
+        import random
+        from cloudscheduler.mem_allocator import MemoryAllocator, select_mementry
+
+        memory = [1024, 4096, 2048, 2048]
+        self.assertEqual(2, MemoryAllocator(memory, "firstfit").find(2048))
+        self.assertEqual(1, MemoryAllocator(memory, "firstfit").find(1500))
+        self.assertEqual(2, MemoryAllocator(memory, "bestfit").find(1500))
+        self.assertEqual(1, MemoryAllocator(memory, "worstfit").find(1500))
+
+        allocator = MemoryAllocator(memory, "firstfit")
+        allocator.set(1, 512)
+        self.assertEqual(2, allocator.find(1500))
+        self.assertEqual(-1, allocator.find(3000))
+        (entries, free, largest, fragmentation, finds, failures, fragmented) = allocator.get_stats()
+        self.assertEqual((4, 5632, 2048, 2, 1, 1), (entries, free, largest, finds, failures, fragmented))
+        self.assertAlmostEqual(1 - 2048.0 / 5632, fragmentation)
+
+        # The indexed lookups agree with a plain scan of the list
+        for policy in ("firstfit", "bestfit", "worstfit"):
+            entries = [random.randint(0, 8) * 256 for i in range(37)]
+            allocator = MemoryAllocator(entries, policy)
+            for i in range(200):
+                index = random.randint(0, len(entries) - 1)
+                entries[index] = random.randint(0, 8) * 256
+                allocator.set(index, entries[index])
+                request = random.randint(0, 9) * 256
+                self.assertEqual(select_mementry(entries, request, policy), allocator.find(request))
+
+        self.assertTrue(self.cloud_name0 in self.test_pool.get_memory_fragmentation_info())
+
+    def test_cluster_lookup_tables(self):
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+        self.assertEqual(self.cloud_name0, cluster0.name)
+        self.assertEqual(None, self.test_pool.get_cluster("missing"))
+
+        self.test_pool.set_cloud_aliases({"both": [self.cloud_name0, self.cloud_name1],
+                                          "one": [self.cloud_name1, "missing"]})
+        self.assertEqual(set([cluster0, cluster1]),
+                         set(self.test_pool.filter_resources_by_names(["both", self.cloud_name1])))
+        self.assertEqual([cluster1], self.test_pool.filter_resources_by_names(["one"]))
+        self.assertEqual([cluster0], self.test_pool.filter_resources_by_names([self.cloud_name0]))
+
+        # Reloading the aliases replaces the alias table
+        self.test_pool.set_cloud_aliases({})
+        self.assertEqual([], self.test_pool.filter_resources_by_names(["one"]))
+
+    def test_potential_fit_cache(self):
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+        def potential(memory):
+            return self.test_pool.get_potential_fitting_resources(self.networks0, self.cpu_archs0, memory, 10)
+
+        self.assertEqual([cluster0, cluster1], potential(2048))
+        self.assertTrue(self.test_pool.resourcePF(self.networks0, self.cpu_archs0, 2048, 10))
+        self.assertFalse(self.test_pool.resourcePF(self.networks0, self.cpu_archs0, 4096, 10))
+
+        # Results are reused until the configuration generation changes
+        cluster0.enabled = False
+        self.assertEqual([cluster0, cluster1], potential(2048))
+        self.test_pool.enable_cluster(self.cloud_name0)
+        self.test_pool.disable_cluster(self.cloud_name1)
+        self.assertEqual([cluster0], potential(2048))
+        self.test_pool.disable_cluster(self.cloud_name0)
+        self.assertEqual([], potential(2048))
+        self.assertFalse(self.test_pool.resourcePF(self.networks0, self.cpu_archs0, 2048, 10))
+
+    def test_placement_planner(self):
+        from cloudscheduler.placement import PlacementPlanner
+        Job = cloudscheduler.job_management.Job
+
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+        cluster0.set_mementry(0, 1024)
+        big = Job(GlobalJobId="host#1.0#1", VMLoc="http://example.com/img.gz",
+                  VMNetwork=self.networks0, VMCPUArch=self.cpu_archs0, VMMem=2048)
+        small = Job(GlobalJobId="host#2.0#1", VMLoc="http://example.com/img.gz",
+                    VMNetwork=self.networks0, VMCPUArch=self.cpu_archs0, VMMem=1024)
+
+        # Best-fit-decreasing puts the big job on the only cloud it fits and
+        # the small one in the 1024MB gap left on the other.
+        planner = PlacementPlanner(self.test_pool, policy="bestfit", reservation_wait=-1)
+        plan = planner.plan_cycle([small, big])
+        self.assertEqual(cluster1, plan[big.id])
+        self.assertEqual(cluster0, plan[small.id])
+        self.assertEqual([cluster0, cluster1], planner.get_resources(small))
+
+        # The big job cannot fit anywhere, so it reserves the emptiest memory
+        # entry and the small job is not backfilled onto it.
+        cluster1.set_mementry(0, 1536)
+        planner = PlacementPlanner(self.test_pool, policy="balanced", reservation_wait=0)
+        planner.plan_cycle([small, big])
+        self.assertEqual(cluster1, planner.reservations[big.id].cluster)
+        self.assertEqual([cluster0], planner.get_resources(small))
+        self.assertTrue("on %s for %s" % (cluster1.name, big.id) in planner.get_reservations_info())
+
+    def test_demand_forecaster(self):
+        from cloudscheduler.forecast import DemandForecaster
+        Job = cloudscheduler.job_management.Job
+
+        job_pool = cloudscheduler.job_management.JobPool("testpool", condor_query_type="local")
+        forecaster = DemandForecaster(job_pool, self.test_pool, window=600, max_prelaunch=2)
+        jobs = [Job(GlobalJobId="host#1.%d#1" % i, ProcId=i, JobStatus=1, VMType="sl6")
+                for i in range(10)]
+        uservmtype = jobs[0].uservmtype
+
+        # Jobs queued at startup are not arrivals
+        job_pool.record_arrivals(jobs)
+        job_pool.record_arrivals(jobs)
+        start = forecaster.window_start
+        forecaster.update(now=start + 600)
+        self.assertAlmostEqual(3.0, forecaster.predictions[uservmtype])
+        # No VMs of the type exist, so the pre-launch is capped by the budget
+        requests = forecaster.get_prelaunch_requests(now=start + 600)
+        self.assertEqual([(jobs[-1], 2)], requests)
+        forecaster.record_prelaunch(uservmtype, now=start + 600)
+        forecaster.record_prelaunch(uservmtype, now=start + 600)
+        self.assertEqual([], forecaster.get_prelaunch_requests(now=start + 700))
+
+        job_pool.record_arrivals(jobs[:3])
+        forecaster.update(now=start + 1200)
+        score = forecaster.scores[uservmtype]
+        self.assertEqual(2, score.windows)
+        self.assertEqual(13, score.actual)
+        self.assertAlmostEqual(1 - 10.0 / 13, score.accuracy())
+        self.assertTrue(uservmtype in forecaster.get_forecast_info())
+
+    def test_warm_pool(self):
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.warm_pool import WarmPool
+        Job = cloudscheduler.job_management.Job
+
+        cluster = self.test_pool.get_cluster(self.cloud_name0)
+        vms = [VM(id="vm%d" % i, vmtype="sl6", user="user", network="private", cpuarch="x86_64",
+                  image="http://example.com/sl6.img", memory=1024, cpucores=1) for i in range(3)]
+        cluster.vms.extend(vms)
+        vms[0].idle_start = vms[1].idle_start = 1000
+        def make_job(**kwargs):
+            attrs = dict(GlobalJobId="host#1.0#1", Owner="user", VMType="sl6", VMNetwork="private",
+                         VMCPUArch="x86_64", VMLoc="http://example.com/sl6.img", VMMem=512)
+            attrs.update(kwargs)
+            return Job(**attrs)
+        warm_pool = WarmPool(size=1, hold_time=300, budget=-1)
+
+        # Only registered VMs are held, and only size of them per type and cloud
+        self.assertFalse(warm_pool.hold(vms[2], cluster, now=1000))
+        self.assertTrue(warm_pool.hold(vms[0], cluster, now=1000))
+        self.assertFalse(warm_pool.hold(vms[1], cluster, now=1000))
+        self.assertTrue(warm_pool.hold(vms[0], cluster, now=1200))
+        self.assertFalse(warm_pool.hold(vms[0], cluster, now=1400))
+        self.assertFalse(warm_pool.hold(vms[0], cluster, now=1400))
+
+        job = make_job()
+        self.assertTrue(warm_pool.hold(vms[1], cluster, now=1400))
+        # Held VMs that can't run the job, or are on clouds it can't use, aren't taken
+        self.assertFalse(warm_pool.claim(make_job(VMMem=2048)))
+        self.assertFalse(warm_pool.claim(make_job(VMLoc="http://example.com/other.img")))
+        self.assertFalse(warm_pool.claim(job, targets=[self.cloud_name1]))
+        blocked = make_job()
+        blocked.blocked_clouds.append(self.cloud_name0)
+        self.assertFalse(warm_pool.claim(blocked))
+        self.assertTrue(warm_pool.claim(job, targets=[self.cloud_name0]))
+        self.assertFalse(warm_pool.claim(job))
+        warm_pool.record_miss(job.uservmtype)
+        self.assertEqual(1, warm_pool.hits[job.uservmtype])
+        self.assertEqual(1, warm_pool.misses[job.uservmtype])
+
+        # A held VM that picks up a job by itself is a hit
+        self.assertTrue(warm_pool.hold(vms[1], cluster, now=1500))
+        vms[1].idle_start = None
+        cluster.vms.remove(vms[0])
+        warm_pool.update(self.test_pool, now=1600)
+        self.assertEqual(2, warm_pool.hits[job.uservmtype])
+        self.assertFalse(warm_pool.held)
+        self.assertFalse(warm_pool.released)
+
+    def test_warm_pool_target_aliases(self):
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.warm_pool import WarmPool
+        Job = cloudscheduler.job_management.Job
+        cloud_scheduler = load_cloud_scheduler()
+
+        cluster = self.test_pool.get_cluster(self.cloud_name0)
+        vm = VM(id="vm0", vmtype="sl6", user="user", network="private", cpuarch="x86_64",
+                image="http://example.com/sl6.img", memory=1024, cpucores=1)
+        vm.idle_start = 1000
+        cluster.vms.append(vm)
+        self.test_pool.warm_pool = WarmPool(size=1, hold_time=300, budget=-1)
+        self.assertTrue(self.test_pool.warm_pool.hold(vm, cluster, now=1000))
+        self.test_pool.alias_targets = {"theirs": frozenset([self.cloud_name1]),
+                                        "ours": frozenset([self.cloud_name0])}
+
+        scheduled = []
+        class JobPool():
+            def schedule(self, job):
+                scheduled.append(job)
+        class Planner():
+            def get_resources(self, job):
+                return []
+        scheduler = cloud_scheduler.Scheduler.__new__(cloud_scheduler.Scheduler)
+        scheduler.resource_pool = self.test_pool
+        scheduler.job_pool = JobPool()
+        scheduler.planner = Planner()
+        scheduler.profiler = utilities.CycleProfiler("Scheduler")
+
+        # The scheduler resolves the job's target aliases for the warm pool
+        job = Job(GlobalJobId="host#1.0#1", Owner="user", VMType="sl6", VMNetwork="private",
+                  VMCPUArch="x86_64", VMLoc="http://example.com/sl6.img", VMMem=512)
+        job.target_clouds = ["theirs"]
+        self.assertFalse(scheduler.sched_resource_create_track(job.user, job))
+        self.assertEqual([], scheduled)
+        job.target_clouds = ["ours"]
+        self.assertTrue(scheduler.sched_resource_create_track(job.user, job))
+        self.assertEqual([job], scheduled)
+
+    def test_destroy_executor(self):
+        import threading
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.destroy_executor import VMDestroyExecutor
+
+        cluster = self.test_pool.get_cluster(self.cloud_name0)
+        vms = [VM(id="vm%d" % i) for i in range(3)]
+        cluster.vms.extend(vms)
+        release = threading.Event()
+        attempts = {}
+        running = [0, 0]
+        def vm_destroy(vm, return_resources=True, reason=""):
+            running[0] += 1
+            running[1] = max(running)
+            release.wait(5)
+            running[0] -= 1
+            attempts[vm.id] = attempts.get(vm.id, 0) + 1
+            # vm0 is destroyed, vm1 on its second try, vm2 never
+            if vm.id == "vm0" or (vm.id == "vm1" and attempts[vm.id] == 2):
+                cluster.vms.remove(vm)
+                return 0
+            return 1
+        cluster.vm_destroy = vm_destroy
+        backoff = cloudscheduler.config.destroy_retry_backoff
+        cloudscheduler.config.destroy_retry_backoff = 0.01
+        try:
+            destroyer = VMDestroyExecutor(max_workers=2, max_per_cloud=1)
+            tasks = [destroyer.destroy(cluster, vm, retries=1) for vm in vms]
+            # A VM is only queued once
+            self.assertEqual(None, destroyer.destroy(cluster, vms[0]))
+            self.assertTrue(destroyer.is_pending(cluster, vms[0]))
+            release.set()
+            self.assertEqual([0, 0, 1], [task.wait(5) for task in tasks])
+            self.assertEqual({"vm0": 1, "vm1": 2, "vm2": 2}, attempts)
+            # Only one destroy ran at a time on the one cloud
+            self.assertEqual(1, running[1])
+
+            # vm2 was given up on, and is only tried again when asked to
+            self.assertEqual([vms[2]], [task.vm for task in destroyer.get_dead_letters()])
+            self.assertTrue("vm2" in destroyer.get_destroy_info())
+            self.assertEqual(None, destroyer.destroy(cluster, vms[2]))
+            task = destroyer.destroy(cluster, vms[2], retries=0, retry_dead=True)
+            self.assertEqual(1, task.wait(5))
+            self.assertEqual(3, attempts["vm2"])
+            self.assertEqual(0, destroyer.in_flight())
+            destroyer.shutdown()
+        finally:
+            cloudscheduler.config.destroy_retry_backoff = backoff
+
+    def test_shutdown_cluster_all(self):
+        import threading
+        from cloudscheduler.cluster_tools import VM
+
+        cluster = self.test_pool.get_cluster(self.cloud_name0)
+        vms = [VM(id="vm%d" % i) for i in range(3)]
+        cluster.vms.extend(vms)
+        release = threading.Event()
+        def vm_destroy(vm, return_resources=True, reason=""):
+            release.wait(5)
+            cluster.vms.remove(vm)
+            return 0
+        batches = []
+        def vm_destroy_batch(vms, return_resources=True, reason=""):
+            batches.append(list(vms))
+            for vm in vms:
+                cluster.vms.remove(vm)
+            return [0] * len(vms)
+        cluster.vm_destroy = vm_destroy
+        cluster.vm_destroy_batch = vm_destroy_batch
+
+        # The VM the destroyer is busy with isn't destroyed a second time
+        task = self.test_pool.destroyer.destroy(cluster, vms[0])
+        output = self.test_pool.shutdown_cluster_all(self.cloud_name0)
+        self.assertEqual([vms[1:]], batches)
+        self.assertTrue("VM vm0 is already being destroyed." in output)
+        self.assertTrue("VM vm2 has been Destroyed." in output)
+        release.set()
+        self.assertEqual(0, task.wait(5))
+        self.assertEqual([], cluster.vms)
+        self.test_pool.destroyer.shutdown()
+
+    def test_destroy_executor_spot_vms(self):
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.destroy_executor import VMDestroyExecutor
+
+        cluster = self.test_pool.get_cluster(self.cloud_name0)
+        # Unfulfilled spot requests, which all have an empty id
+        vms = [VM(id="") for i in range(2)]
+        cluster.vms.extend(vms)
+        def vm_destroy(vm, return_resources=True, reason=""):
+            # The request is fulfilled while it is being destroyed
+            vm.id = "i-%d" % vms.index(vm)
+            cluster.vms.remove(vm)
+            return 0
+        cluster.vm_destroy = vm_destroy
+        destroyer = VMDestroyExecutor(max_workers=1, max_per_cloud=1)
+        tasks = [destroyer.destroy(cluster, vm) for vm in vms]
+        self.assertTrue(None not in tasks)
+        self.assertEqual([0, 0], [task.wait(5) for task in tasks])
+        self.assertEqual(0, destroyer.in_flight())
+        self.assertFalse(destroyer.is_pending(cluster, vms[0]))
+        destroyer.shutdown()
+
+    def test_poll_schedule(self):
+        from cloudscheduler.cluster_tools import VM, ICluster
+        from cloudscheduler.poll_schedule import PollSchedule
+
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+        vms = [VM(id="vm%d" % i) for i in range(4)]
+        cluster0.vms.extend(vms[:3])
+        cluster1.vms.append(vms[3])
+        vms[2].lastpoll = 1000
+        vms[2].status = "Running"
+        jitter = cloudscheduler.config.vm_poll_jitter
+        cloudscheduler.config.vm_poll_jitter = 0
+        try:
+            schedule = PollSchedule()
+            schedule.sync([cluster0, cluster1])
+            self.assertEqual(1900, schedule.next_due(vms[2]))
+
+            # New VMs are due at once, at most budget of them per cloud
+            due = schedule.pop_due(now=1000, budget=1)
+            self.assertEqual([vms[0]], due[cluster0])
+            self.assertEqual([vms[3]], due[cluster1])
+            self.assertEqual(1, schedule.deferred)
+            due = schedule.pop_due(now=1000, budget=1)
+            self.assertEqual({cluster0: [vms[1]]}, dict(due))
+
+            # Polled VMs come due again after the interval of their state
+            schedule.reschedule(cluster0, vms[0], "Starting", now=1000)
+            schedule.reschedule(cluster0, vms[1], "Error", now=1000)
+            self.assertEqual(1120, schedule.next_due(vms[0]))
+            self.assertEqual(1000 + cloudscheduler.config.vm_poller_interval, schedule.next_due(vms[1]))
+            self.assertEqual([vms[1]], schedule.pop_due(now=1100, budget=-1)[cluster0])
+
+            # An expedited VM is due straight away, and gone VMs are dropped
+            schedule.expedite(cluster0, vms[2], "test")
+            cluster1.vms.remove(vms[3])
+            schedule.reschedule(cluster1, vms[3], "Running", now=1000)
+            self.assertEqual({cluster0: [vms[2], vms[0]]}, dict(schedule.pop_due(now=2000, budget=-1)))
+            self.assertEqual(None, schedule.next_due(vms[3]))
+
+            # A VM moved to a new cluster object is polled through it, and
+            # the VMs of clusters no longer in the pool are dropped
+            new_cluster0 = ICluster(name=self.cloud_name0)
+            new_cluster0.vms = [vms[0]]
+            schedule.sync([new_cluster0])
+            self.assertEqual(None, schedule.next_due(vms[1]))
+            schedule.expedite(cluster0, vms[0])
+            schedule.sync([new_cluster0])
+            self.assertEqual({new_cluster0: [vms[0]]}, dict(schedule.pop_due(now=3000, budget=-1)))
+        finally:
+            cloudscheduler.config.vm_poll_jitter = jitter
+
+    def test_poll_failure(self):
+        from cloudscheduler.cluster_tools import VM
+        cloud_scheduler = load_cloud_scheduler()
+
+        cluster = self.test_pool.get_cluster(self.cloud_name0)
+        vms = [VM(id="vm%d" % i) for i in range(2)]
+        cluster.vms.extend(vms)
+        polls = []
+        def vm_poll_all(vms):
+            polls.append(list(vms))
+            raise IOError("connection reset")
+        cluster.vm_poll_all = vm_poll_all
+        class EventBus():
+            VM_STATE_CHANGED = "vm_state_changed"
+            def publish(self, event):
+                pass
+        poller = cloud_scheduler.VMPoller.__new__(cloud_scheduler.VMPoller)
+        (poller.resource_pool, poller.job_pool, poller.event_bus) = (self.test_pool, None, EventBus())
+
+        # VMs whose poll failed stay scheduled, to be polled again
+        poller.poll_all_machines()
+        self.assertEqual([vms], polls)
+        for vm in vms:
+            self.assertTrue(self.test_pool.poll_schedule.next_due(vm) != None)
+            self.assertEqual("Starting", vm.status)
+            self.test_pool.poll_schedule.expedite(cluster, vm)
+        poller.poll_all_machines()
+        self.assertEqual([vms, vms], polls)
+
 
     def tearDown(self):
         os.remove(self.configfilename)
@@ -448,6 +1158,627 @@ Problem: Problem querying resource properties: ; nested exception is:
         expired_proxy = NimbusCluster._extract_state(nimbus_expired_proxy)
         self.assertEqual("ExpiredProxy", expired_proxy)
 
+class FakeEC2Connection():
+    """Stand-in for a boto EC2 connection holding a few instances, returning
+    describe results in pages of page_size."""
+
+    class Reservation():
+        def __init__(self, instances):
+            self.instances = instances
+
+    class Page(list):
+        next_token = None
+
+    def __init__(self, instances, spot_requests, page_size=2):
+        self.instances = instances
+        self.spot_requests = spot_requests
+        self.page_size = page_size
+        self.calls = 0
+
+    def _page(self, items, next_token):
+        start = int(next_token or 0)
+        page = self.Page(items[start:start + self.page_size])
+        if start + self.page_size < len(items):
+            page.next_token = str(start + self.page_size)
+        return page
+
+    def get_all_instances(self, filters={}, next_token=None):
+        self.calls += 1
+        found = [self.Reservation([self.instances[i]]) for i in filters['instance-id'] if i in self.instances]
+        return self._page(found, next_token)
+
+    def get_all_spot_instance_requests(self, filters={}):
+        self.calls += 1
+        return [self.spot_requests[i] for i in filters['spot-instance-request-id'] if i in self.spot_requests]
+
+    def get_image(self, ami):
+        self.calls += 1
+        connection = self
+        class Image():
+            def run(self, min_count, max_count, **kwargs):
+                connection.calls += 1
+                started = [FakeEC2Connection.Instance("i-%d" % (len(connection.instances) + i), "pending")
+                           for i in range(max_count)]
+                for instance in started:
+                    connection.instances[instance.id] = instance
+                return FakeEC2Connection.Reservation(started)
+        return Image()
+
+    def terminate_instances(self, instance_ids=[]):
+        self.calls += 1
+        for i in instance_ids:
+            self.instances[i].state = "terminated"
+
+    class Instance():
+        def __init__(self, id, state):
+            self.id = id
+            self.state = state
+            self.public_dns_name = id + ".example.com"
+
+class EC2ClusterTests(unittest.TestCase):
+
+    def test_vm_poll_all(self):
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.ec2cluster import EC2Cluster
+
+        class Instance():
+            def __init__(self, id, state):
+                self.id = id
+                self.state = state
+                self.public_dns_name = id + ".example.com"
+
+        class SpotRequest():
+            def __init__(self, id, instance_id):
+                self.id = id
+                self.instance_id = instance_id
+                self.state = "active" if instance_id else "open"
+                self.status = None
+
+        connection = FakeEC2Connection(
+            dict([("i-%d" % i, Instance("i-%d" % i, "running" if i % 2 else "pending")) for i in range(5)]),
+            {"sir-1": SpotRequest("sir-1", "i-4"), "sir-2": SpotRequest("sir-2", None)})
+        cluster = EC2Cluster(name="ec2", cloud_type="AmazonEC2", memory=[8192], vm_slots=10,
+                             access_key_id="key", secret_access_key="secret")
+        cluster._get_connection = lambda: connection
+
+        vms = [VM(id="i-%d" % i) for i in range(4)]
+        vms.append(VM(id="i-gone"))
+        vms.append(VM(id="", spot_id="sir-1"))
+        vms.append(VM(id="", spot_id="sir-2"))
+        for vm in vms:
+            vm.status = "Starting"
+        states = cluster.vm_poll_all(vms)
+
+        # One spot request call and three pages of instances, not one call per VM
+        self.assertEqual(4, connection.calls)
+        self.assertEqual(["Starting", "Running", "Starting", "Running", "Error", "Starting", "Starting"], states)
+        self.assertEqual("i-4", vms[5].id)
+        self.assertEqual("i-1.example.com", vms[1].hostname)
+        self.assertEqual("", vms[6].id)
+
+    def test_spot_interruptions(self):
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.ec2cluster import EC2Cluster
+
+        class Status():
+            def __init__(self, code):
+                self.code = code
+
+        class SpotRequest():
+            def __init__(self, id, state, code, instance_id=None):
+                self.id = id
+                self.state = state
+                self.status = Status(code)
+                self.instance_id = instance_id
+
+        requests = {"sir-1": SpotRequest("sir-1", "active", "fulfilled", "i-1"),
+                    "sir-2": SpotRequest("sir-2", "active", "marked-for-termination", "i-2"),
+                    "sir-3": SpotRequest("sir-3", "open", "price-too-low"),
+                    "sir-4": SpotRequest("sir-4", "cancelled", "canceled-before-fulfillment")}
+        connection = FakeEC2Connection({}, requests)
+        cluster = EC2Cluster(name="ec2", cloud_type="AmazonEC2", memory=[8192], vm_slots=10,
+                             access_key_id="key", secret_access_key="secret")
+        cluster._get_connection = lambda: connection
+        cluster.vms = [VM(id="", spot_id="sir-%d" % i) for i in range(1, 5)]
+        cluster.vms.append(VM(id="i-9"))
+
+        # All the spot requests in one call, the interruption reported once
+        self.assertEqual([cluster.vms[1]], cluster.vm_poll_interruptions())
+        self.assertEqual(1, connection.calls)
+        self.assertEqual(["i-1", "i-2", "", ""], [vm.id for vm in cluster.vms[:4]])
+        self.assertEqual("Interrupted", cluster.vms[1].override_status)
+        self.assertEqual("Error", cluster.vms[3].status)
+        self.assertEqual([], cluster.vm_poll_interruptions())
+        self.assertEqual(2, connection.calls)
+
+        # Polling reuses the fresh snapshot
+        self.assertEqual("Starting", cluster.vm_poll_all([cluster.vms[2]])[0])
+        self.assertEqual(2, connection.calls)
+
+    def test_poll_interrupted_vms(self):
+        import time
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.ec2cluster import EC2Cluster
+        from cloudscheduler.poll_schedule import PollSchedule
+        from cloudscheduler.destroy_executor import VMDestroyExecutor
+        cloud_scheduler = load_cloud_scheduler()
+
+        class Status():
+            code = "marked-for-termination"
+        class SpotRequest():
+            id = "sir-1"
+            state = "active"
+            status = Status()
+            instance_id = "i-1"
+        connection = FakeEC2Connection({"i-1": FakeEC2Connection.Instance("i-1", "running")},
+                                       {"sir-1": SpotRequest()})
+        cluster = EC2Cluster(name="ec2", cloud_type="AmazonEC2", memory=[8192], vm_slots=10,
+                             access_key_id="key", secret_access_key="secret")
+        cluster._get_connection = lambda: connection
+        vm = VM(id="i-1", spot_id="sir-1")
+        vm.status = "Starting"
+        cluster.vms = [vm]
+        destroys = []
+        def vm_destroy(vm, return_resources=True, reason=""):
+            destroys.append(vm)
+            return cluster.ERROR
+        cluster.vm_destroy = vm_destroy
+
+        class ResourcePool():
+            resources = [cluster]
+            poll_schedule = PollSchedule()
+            destroyer = VMDestroyExecutor(max_workers=1)
+        class JobContainer():
+            def get_scheduled_jobs(self):
+                return []
+        class JobPool():
+            job_container = JobContainer()
+        class EventBus():
+            VM_STATE_CHANGED = "vm_state_changed"
+            def publish(self, event):
+                pass
+        poller = cloud_scheduler.VMPoller.__new__(cloud_scheduler.VMPoller)
+        (poller.resource_pool, poller.job_pool, poller.event_bus) = (ResourcePool(), JobPool(), EventBus())
+
+        retries = cloudscheduler.config.destroy_retries
+        cloudscheduler.config.destroy_retries = 0
+        try:
+            # The interrupted VM's destroy fails and is given up on...
+            poller.poll_all_machines()
+            self.assertEqual("Interrupted", vm.override_status)
+            self.assertEqual("Running", vm.status)
+            for i in range(50):
+                if poller.resource_pool.destroyer.get_dead_letters():
+                    break
+                time.sleep(0.1)
+            self.assertEqual([vm], [task.vm for task in poller.resource_pool.destroyer.get_dead_letters()])
+            # ...but the VM is still polled, and destroyed again when due
+            connection.instances["i-1"].state = "terminated"
+            poller.resource_pool.poll_schedule.expedite(cluster, vm)
+            poller.poll_all_machines()
+            self.assertEqual("Shutdown", vm.status)
+            poller.resource_pool.destroyer.shutdown()
+            self.assertEqual([vm, vm], destroys)
+        finally:
+            cloudscheduler.config.destroy_retries = retries
+
+    def test_connection_reuse(self):
+        import pickle
+        import threading
+        import boto.exception
+        from cloudscheduler.ec2cluster import EC2Cluster
+
+        cluster = EC2Cluster(name="ec2", cloud_type="AmazonEC2", memory=[8192], vm_slots=10,
+                             access_key_id="key", secret_access_key="secret")
+        made = []
+        def connect():
+            made.append(object())
+            return made[-1]
+        cluster._connect = connect
+
+        connection = cluster._get_connection()
+        self.assertTrue(connection is cluster._get_connection())
+        cluster.connections.failed(boto.exception.EC2ResponseError(500, "Server Error"))
+        self.assertTrue(connection is cluster._get_connection())
+        cluster.connections.failed(boto.exception.EC2ResponseError(401, "Unauthorized"))
+        self.assertFalse(connection is cluster._get_connection())
+
+        saved = cloudscheduler.config.connection_lifetime
+        cloudscheduler.config.connection_lifetime = 1
+        try:
+            cluster.connections.local.created -= 2
+            cluster._get_connection()
+        finally:
+            cloudscheduler.config.connection_lifetime = saved
+        self.assertEqual((5, 3, 0, 1, 1), cluster.connections.get_stats()[:5])
+
+        # Every thread uses a client of its own
+        connection = cluster._get_connection()
+        others = []
+        def use():
+            others.append(cluster._get_connection())
+            others.append(cluster._get_connection())
+        thread = threading.Thread(target=use)
+        thread.start()
+        thread.join()
+        self.assertTrue(others[0] is others[1])
+        self.assertFalse(others[0] is connection)
+        self.assertTrue(connection is cluster._get_connection())
+        # An authentication error seen by one thread drops them all
+        cluster.connections.failed(boto.exception.EC2ResponseError(401, "Unauthorized"))
+        self.assertFalse(connection is cluster._get_connection())
+
+        del cluster._connect
+        copy = pickle.loads(pickle.dumps(cluster))
+        self.assertEqual(None, getattr(copy.connections.local, 'client', None))
+        self.assertEqual(5, copy.connections.connects)
+
+    def test_vm_create_batch(self):
+        import threading
+        from cloudscheduler.ec2cluster import EC2Cluster
+        from cloudscheduler.vm_executor import VMCreateExecutor
+
+        connection = FakeEC2Connection({}, {})
+        cluster = EC2Cluster(name="ec2", cloud_type="AmazonEC2", memory=[8192], vm_slots=10,
+                             access_key_id="key", secret_access_key="secret")
+        cluster._get_connection = lambda: connection
+        args = dict(vm_name="vm", vm_type="user:sl6", vm_user="user", vm_networkassoc="public",
+                    vm_cpuarch="x86", vm_image={"ec2": "ami-1"}, vm_mem=1024, vm_cores=1,
+                    vm_storage=0, instance_type={"ec2": "m1.small"})
+        spot = dict(args, maximum_price=10)
+        self.assertEqual(cluster.vm_batch_key(args), cluster.vm_batch_key(dict(args, vm_user="other")))
+        self.assertEqual(None, cluster.vm_batch_key(spot))
+
+        # Three identical launches are one run call, each mapped to its VM
+        results = cluster.vm_create_batch([dict(args, vm_user="user%d" % i) for i in range(3)])
+        self.assertEqual([0, 0, 0], results)
+        self.assertEqual(2, connection.calls)
+        self.assertEqual(["i-0", "i-1", "i-2"], [vm.id for vm in cluster.vms])
+        self.assertEqual(["user0", "user1", "user2"], [vm.user for vm in cluster.vms])
+        self.assertEqual(7, cluster.vm_slots)
+
+        # and their terminations one terminate call
+        self.assertEqual([0, 0, 0], cluster.vm_destroy_batch(list(cluster.vms)))
+        self.assertEqual(3, connection.calls)
+        self.assertEqual([], cluster.vms)
+        self.assertEqual(10, cluster.vm_slots)
+        self.assertEqual("terminated", connection.instances["i-1"].state)
+
+        # A batch that fails unexpectedly leaves its VMs to be destroyed again
+        cluster.vm_create_batch([args, args])
+        vms = list(cluster.vms)
+        cluster._get_connection = lambda: None
+        self.assertEqual([cluster.ERROR] * 2, cluster.vm_destroy_batch(vms))
+        self.assertEqual(vms, cluster.vms)
+        self.assertEqual(8, cluster.vm_slots)
+        # and a VM destroyed meanwhile is skipped, not returned twice
+        cluster._get_connection = lambda: connection
+        cluster.vm_destroy(vms[0])
+        self.assertEqual([0, 0], cluster.vm_destroy_batch(vms))
+        self.assertEqual([], cluster.vms)
+        self.assertEqual(10, cluster.vm_slots)
+
+        # The executor coalesces same-key launches queued behind a busy cloud
+        gate = threading.Event()
+        batches = []
+        def batch(calls):
+            batches.append(calls)
+            return [n for (n,) in calls]
+        executor = VMCreateExecutor(max_workers=2, max_per_cloud=1)
+        busy = executor.submit("ec2", gate.wait, (5,))
+        queued = [executor.submit("ec2", abs, (n,), batch_key="same", batch_function=batch) for n in range(3)]
+        other = executor.submit("ec2", abs, (-1,), batch_key="other", batch_function=batch)
+        gate.set()
+        executor.shutdown()
+        self.assertEqual([0, 1, 2, 1], [future.result(5) for future in queued + [other]])
+        self.assertEqual([[(0,), (1,), (2,)]], batches)
+        self.assertTrue(busy.result(5))
+
+class FakeGCEService():
+    """Stand-in for the GCE API client, listing a zone's instances in pages
+    of page_size."""
+
+    class Request():
+        def __init__(self, response):
+            self.response = response
+
+        def execute(self, http=None):
+            return self.response
+
+    def __init__(self, instances, page_size=2):
+        self.instances_listed = instances
+        self.page_size = page_size
+        self.calls = 0
+
+    def instances(self):
+        return self
+
+    def list(self, project=None, filter=None, zone=None, pageToken=None):
+        self.calls += 1
+        start = int(pageToken or 0)
+        response = {'items': self.instances_listed[start:start + self.page_size]}
+        if start + self.page_size < len(self.instances_listed):
+            response['nextPageToken'] = str(start + self.page_size)
+        return self.Request(response)
+
+class GoogleComputeEngineClusterTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler import cluster_tools
+        from cloudscheduler.googlecluster import GoogleComputeEngineCluster
+        # Without a project the cluster skips authorizing with Google
+        self.cluster = GoogleComputeEngineCluster(name="gce")
+        cluster_tools.ICluster.__init__(self.cluster, name="gce", memory=[8192], vm_slots=10)
+        self.cluster.project_id = "project"
+        self.cluster.auth_http = None
+
+    def test_vm_poll_all(self):
+        from cloudscheduler.cluster_tools import VM
+
+        def instance(n, status):
+            return {'id': str(n), 'name': "gce-cs-vm%d" % n, 'status': status,
+                    'networkInterfaces': [{'accessConfigs': [{'natIP': "10.0.0.%d" % n}]}]}
+        service = FakeGCEService([instance(n, "RUNNING") for n in range(4)] + [{'id': "9", 'name': "other"}])
+        self.cluster.gce_service = service
+        self.cluster.vms = [VM(id=str(n), name="gce-cs-vm%d" % n) for n in (0, 1, 2, 5)]
+        for vm in self.cluster.vms:
+            vm.initialize_time -= 10
+
+        # One paginated listing for the cycle, shared by the polls after it
+        states = self.cluster.vm_poll_all(self.cluster.vms)
+        self.assertEqual(3, service.calls)
+        self.assertEqual(["RUNNING", "RUNNING", "RUNNING", "Error"], states)
+        self.assertEqual("10.0.0.1", self.cluster.vms[1].ipaddress)
+        self.assertEqual({'3': "gce-cs-vm3"}, self.cluster.unmanaged_instances)
+        self.assertEqual("RUNNING", self.cluster.vm_poll(self.cluster.vms[0]))
+        self.assertEqual(3, service.calls)
+
+        # A VM booted since the listing isn't taken for gone
+        new_vm = VM(id="6", name="gce-cs-vm6")
+        self.assertEqual("Starting", self.cluster.vm_poll(new_vm))
+
+    def test_operation_watcher(self):
+        import time
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.googlecluster import OperationWatcher
+
+        statuses = {}
+        class Service():
+            def zoneOperations(self):
+                return self
+            def instances(self):
+                return self
+            def get(self, project=None, operation=None, zone=None):
+                return operation
+            def delete(self, project=None, instance=None, zone=None):
+                if instance in gone:
+                    return NotFound()
+                return FakeGCEService.Request({'name': "delete-" + instance, 'zone': "zones/z", 'status': "PENDING"})
+        class NotFound(Exception):
+            class resp():
+                status = 404
+            def execute(self, http=None):
+                raise self
+        gone = set()
+        class Batch():
+            def __init__(self):
+                self.requests = []
+            def add(self, request, callback=None, request_id=None):
+                self.requests.append((request, callback, request_id))
+            def execute(self, http=None):
+                for (name, callback, request_id) in self.requests:
+                    callback(request_id, statuses[name], None)
+        batches = []
+        def new_batch():
+            batches.append(Batch())
+            return batches[-1]
+        self.cluster.gce_service = Service()
+        self.cluster._new_batch = new_batch
+
+        done = []
+        watcher = OperationWatcher(self.cluster, interval=60, timeout=30)
+        for name in ("a", "b", "c"):
+            statuses[name] = {'name': name, 'status': "RUNNING"}
+            watcher.watch({'name': name, 'zone': "zones/z", 'status': "PENDING"},
+                          lambda operation, error: done.append((operation['name'], error)))
+        watcher.watch({'name': "d", 'status': "DONE"}, lambda operation, error: done.append(("d", error)))
+        self.assertEqual([("d", None)], done)
+
+        # All pending operations in one batch, each finished on its own
+        statuses["a"] = {'name': "a", 'status': "DONE"}
+        statuses["b"] = {'name': "b", 'status': "DONE", 'error': {'errors': [{'message': "quota"}]}}
+        watcher.tick()
+        self.assertEqual(1, len(batches))
+        self.assertEqual(3, len(batches[0].requests))
+        self.assertEqual([("a", None), ("b", "quota"), ("d", None)], sorted(done))
+        watcher.pending["c"] = (watcher.pending["c"][0], watcher.pending["c"][1], time.time() - 60)
+        watcher.tick()
+        self.assertEqual(("c", "timed out after 30 seconds"), done[-1])
+        self.assertEqual({}, watcher.pending)
+
+        # A destroy returns without waiting for its operation, keeping the VM
+        # until the delete is done
+        self.cluster.operations = watcher
+        vm = VM(id="1", name="gce-cs-vm1", mementry=0)
+        self.cluster.vms = [vm]
+        self.assertEqual(0, self.cluster.vm_destroy(vm, return_resources=False))
+        self.assertEqual([vm], self.cluster.vms)
+        self.assertTrue("delete-gce-cs-vm1" in watcher.pending)
+        self.assertEqual(0, self.cluster.vm_destroy(vm, return_resources=False))
+
+        # A failed delete leaves the VM in Error, even when listed, to be destroyed again
+        statuses["delete-gce-cs-vm1"] = {'name': "delete-gce-cs-vm1", 'status': "DONE",
+                                         'error': {'errors': [{'message': "busy"}]}}
+        watcher.tick()
+        self.assertEqual([vm], self.cluster.vms)
+        self.assertEqual("Error", self.cluster._update_vm(vm, {'status': "RUNNING"}, time.time()))
+        statuses["delete-gce-cs-vm1"] = {'name': "delete-gce-cs-vm1", 'status': "DONE"}
+        self.assertEqual(0, self.cluster.vm_destroy(vm, return_resources=False))
+        watcher.tick()
+        self.assertEqual([], self.cluster.vms)
+
+        # An instance deleted outside the scheduler is removed, not retried
+        vm = VM(id="2", name="gce-cs-vm2", mementry=0)
+        self.cluster.vms = [vm]
+        gone.add("gce-cs-vm2")
+        self.assertEqual(0, self.cluster.vm_destroy(vm, return_resources=False))
+        self.assertEqual([], self.cluster.vms)
+        self.assertFalse("gce-cs-vm2" in self.cluster.deleting)
+
+    def test_vm_destroy_keeps_vm_until_deleted(self):
+        import time
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.googlecluster import OperationWatcher
+
+        operations = {}
+        class Service():
+            def zoneOperations(self):
+                return self
+            def instances(self):
+                return self
+            def get(self, project=None, operation=None, zone=None):
+                return operation
+            def delete(self, project=None, instance=None, zone=None):
+                if instance == "gce-cs-vm2":
+                    return Refused()
+                return FakeGCEService.Request({'name': "delete-" + instance, 'zone': "zones/z", 'status': "PENDING"})
+        class Refused():
+            def execute(self, http=None):
+                raise Exception("backend error")
+        class Batch():
+            def __init__(self):
+                self.requests = []
+            def add(self, request, callback=None, request_id=None):
+                self.requests.append((request, callback, request_id))
+            def execute(self, http=None):
+                for (name, callback, request_id) in self.requests:
+                    callback(request_id, operations[name], None)
+        self.cluster.gce_service = Service()
+        self.cluster._new_batch = Batch
+        self.cluster.operations = OperationWatcher(self.cluster, interval=60, timeout=30)
+        vms = [VM(id=str(n), name="gce-cs-vm%d" % n, memory=1024, mementry=0) for n in (1, 2)]
+        for vm in vms:
+            self.cluster.resource_checkout(vm)
+            self.cluster.vms.append(vm)
+
+        # The VM and its resources stay until the delete operation is done,
+        # polls in the meantime leaving it be
+        self.assertEqual(0, self.cluster.vm_destroy(vms[0]))
+        self.assertEqual(vms, self.cluster.vms)
+        self.assertEqual(8, self.cluster.vm_slots)
+        self.assertEqual("STOPPING", self.cluster._update_vm(vms[0], {'status': "STOPPING"}, time.time()))
+        operations["delete-gce-cs-vm1"] = {'name': "delete-gce-cs-vm1", 'status': "RUNNING"}
+        self.cluster.operations.tick()
+        self.assertEqual(vms, self.cluster.vms)
+        operations["delete-gce-cs-vm1"] = {'name': "delete-gce-cs-vm1", 'status': "DONE"}
+        self.cluster.operations.tick()
+        self.assertEqual([vms[1]], self.cluster.vms)
+        self.assertEqual(9, self.cluster.vm_slots)
+
+        # A refused delete keeps the VM, to be destroyed again
+        self.assertEqual(self.cluster.ERROR, self.cluster.vm_destroy(vms[1]))
+        self.assertEqual([vms[1]], self.cluster.vms)
+        self.assertFalse("gce-cs-vm2" in self.cluster.deleting)
+        self.assertEqual(9, self.cluster.vm_slots)
+
+class FakeNovaClient():
+    """Stand-in for the Nova client, listing servers by id, only those in
+    changed for a changes-since listing unless it is rejected."""
+
+    class BadRequest(Exception):
+        pass
+
+    class Server():
+        def __init__(self, id, status):
+            self.id = id
+            self.status = status
+            self.name = "vm-" + id
+
+    def __init__(self):
+        self.servers = self
+        self.listed = {}
+        self.changed = {}
+        self.reject_changes_since = False
+        self.calls = []
+
+    def list(self, detailed=False, search_opts=None):
+        self.calls.append(search_opts)
+        if search_opts:
+            if self.reject_changes_since:
+                raise self.BadRequest()
+            return self.changed.values()
+        return self.listed.values()
+
+class OpenStackClusterTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler import openstackcluster
+        self.nvclient = openstackcluster.nvclient
+        self.novaclient = getattr(openstackcluster, "novaclient", None)
+        # Neither client need be installed, the cluster only talks to the fake
+        openstackcluster.nvclient = FakeNovaClient
+        openstackcluster.novaclient = FakeNovaClient
+        FakeNovaClient.exceptions = FakeNovaClient
+        self.nova = FakeNovaClient()
+        self.cluster = openstackcluster.OpenStackCluster(name="openstack", memory=[8192], vm_slots=10,
+                                                         access_key_id="key", secret_access_key="secret")
+        self.cluster._get_creds_nova = lambda: self.nova
+
+    def tearDown(self):
+        from cloudscheduler import openstackcluster
+        openstackcluster.nvclient = self.nvclient
+        if self.novaclient:
+            openstackcluster.novaclient = self.novaclient
+        else:
+            del openstackcluster.novaclient
+
+    def test_vm_poll_all(self):
+        import time
+        from cloudscheduler.cluster_tools import VM
+
+        for n in range(4):
+            self.nova.listed[str(n)] = FakeNovaClient.Server(str(n), "ACTIVE")
+        self.nova.listed["9"] = FakeNovaClient.Server("9", "ACTIVE")
+        self.cluster.vms = [VM(id=str(n)) for n in (0, 1, 2, 5)]
+        for vm in self.cluster.vms:
+            vm.initialize_time -= 10
+
+        # The first listing is a full one, the missing VM is in Error and the
+        # server nobody launched an orphan
+        states = self.cluster.vm_poll_all(self.cluster.vms)
+        self.assertEqual([None], self.nova.calls)
+        self.assertEqual(["ACTIVE", "ACTIVE", "ACTIVE", "Error"], states)
+        self.assertEqual({'3': "vm-3", '9': "vm-9"}, self.cluster.orphan_servers)
+
+        # The next only asks for the servers changed since, with a margin
+        self.cluster.synced -= 100
+        synced = self.cluster.synced
+        self.nova.changed["1"] = FakeNovaClient.Server("1", "SHUTOFF")
+        self.nova.changed["3"] = FakeNovaClient.Server("3", "DELETED")
+        states = self.cluster.vm_poll_all(self.cluster.vms)
+        since = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(synced - self.cluster.CHANGES_SINCE_MARGIN))
+        self.assertEqual({'changes-since': since}, self.nova.calls[-1])
+        self.assertEqual(["ACTIVE", "SHUTOFF", "ACTIVE", "Error"], states)
+        self.assertTrue("3" not in self.cluster.servers)
+        self.assertEqual({'9': "vm-9"}, self.cluster.orphan_servers)
+
+        # A deployment rejecting changes-since is listed in full from then on
+        self.nova.reject_changes_since = True
+        del self.nova.listed["3"]
+        del self.nova.listed["9"]
+        calls = len(self.nova.calls)
+        self.cluster.vm_poll_all(self.cluster.vms)
+        self.assertEqual([{'changes-since': self.nova.calls[calls]['changes-since']}, None], self.nova.calls[calls:])
+        self.assertFalse(self.cluster.changes_since)
+        self.assertEqual({}, self.cluster.orphan_servers)
+        self.cluster.vm_poll_all(self.cluster.vms)
+        self.assertEqual(None, self.nova.calls[-1])
+        self.assertEqual(calls + 3, len(self.nova.calls))
+
+        # A VM booted since the listing isn't taken for gone
+        new_vm = VM(id="6")
+        self.assertEqual("Starting", self.cluster.vm_poll(new_vm))
+
 class ResourcePoolTests(unittest.TestCase):
 
     def test_condor_status_to_machine_list(self):
@@ -2287,6 +3618,88 @@ xmlns:condor="urn:condor">
         job_pool = cloudscheduler.job_management.JobPool("testpool", condor_query_type="soap")
         self.assertEqual(job_pool.job_query, job_pool.job_query_SOAP)
 
+    def test_unscheduled_jobs_fifo(self):
+        from cloudscheduler.job_containers import HashTableJobContainer
+        Job = cloudscheduler.job_management.Job
+
+        container = HashTableJobContainer()
+        for (cluster, proc) in [(12, 0), (3, 1), (3, 0), (20, 0)]:
+            container.add_job(Job(GlobalJobId="host#%d.%d#1" % (cluster, proc),
+                                  ClusterId=cluster, ProcId=proc))
+
+        fifo = [job.id for job in container.get_unscheduled_jobs_fifo()]
+        self.assertEqual(["host#3.0#1", "host#3.1#1", "host#12.0#1", "host#20.0#1"], fifo)
+
+        container.schedule_job("host#3.0#1")
+        fifo = [job.id for job in container.get_unscheduled_jobs_fifo(2)]
+        self.assertEqual(["host#3.1#1", "host#12.0#1"], fifo)
+        self.assertEqual([], container.get_unscheduled_jobs_fifo(0))
+        self.assertEqual(1, container.num_scheduled_jobs())
+
+        container.unschedule_job("host#3.0#1")
+        container.remove_job_by_id("host#12.0#1")
+        fifo = [job.id for job in container.get_unscheduled_jobs_fifo()]
+        self.assertEqual(["host#3.0#1", "host#3.1#1", "host#20.0#1"], fifo)
+
+    def test_scheduler_fifo(self):
+        from cloudscheduler.job_containers import HashTableJobContainer
+        Job = cloudscheduler.job_management.Job
+        cloud_scheduler = load_cloud_scheduler()
+
+        container = HashTableJobContainer()
+        jobs = [Job(GlobalJobId="host#%d.0#1" % n, ClusterId=n, ProcId=0) for n in range(5)]
+        for job in jobs:
+            container.add_job(job)
+        jobs[0].banned = jobs[1].banned = True
+        class ResourcePool():
+            vm_machine_list = []
+            def __init__(self, slots):
+                self.slots = slots
+            def vm_slots_total(self):
+                return self.slots
+            def get_vm_hostname_index(self):
+                return None
+        class JobPool():
+            job_container = container
+        tried = []
+        scheduler = cloud_scheduler.Scheduler.__new__(cloud_scheduler.Scheduler)
+        scheduler.job_pool = JobPool()
+        scheduler.profiler = utilities.CycleProfiler("Scheduler")
+        scheduler.sched_resource_create_track = lambda user, job: tried.append(job) or True
+
+        # Banned jobs at the front of the queue don't keep the ones behind
+        # them, past the lookahead, from getting the free slots
+        scheduler.resource_pool = ResourcePool(2)
+        scheduler.scheduler_fifo()
+        self.assertEqual(jobs[2:4], tried)
+        del tried[:]
+        scheduler.resource_pool = ResourcePool(0)
+        scheduler.scheduler_fifo()
+        self.assertEqual([], tried)
+
+    def test_pack_job_per_core(self):
+        from cloudscheduler.job_containers import HashTableJobContainer
+        from cloudscheduler.placement import pack_job_per_core
+        Job = cloudscheduler.job_management.Job
+
+        def make_job(proc, cores, memory, vmtype="sl6"):
+            return Job(GlobalJobId="host#1.%d#1" % proc, ProcId=proc, VMType=vmtype,
+                       VMCPUCores=cores, VMMem=memory, VMStorage=cores, VMJobPerCore=True)
+        container = HashTableJobContainer()
+        lead = make_job(0, 8, 8192)
+        for job in [lead, make_job(1, 4, 4096), make_job(2, 8, 4096),
+                    make_job(3, 2, 4096), make_job(4, 8, 8192, "other")]:
+            container.add_job(job)
+
+        # The 2048MB per core job and the other VMType are left out, and the
+        # VM is shrunk to one 1024MB core per packed job.
+        pack = pack_job_per_core(lead, container.find_unscheduled_jobs_sharing_vm(lead.user, lead))
+        self.assertEqual(3, pack.cores)
+        self.assertEqual(3 * 1024, pack.memory)
+        self.assertEqual(3, pack.storage)
+        self.assertEqual(lead, pack.jobs[0])
+        self.assertEqual(set(["host#1.1#1", "host#1.2#1"]), set([job.id for job in pack.jobs[1:]]))
+
 class GetOrNoneTests(unittest.TestCase):
 
     def setUp(self):